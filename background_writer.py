@@ -0,0 +1,87 @@
+'''
+Bounded background writer shared by mesh_export and mask_export.
+
+Every kind of output (e.g. 'meshes') has one writer per process: a daemon thread that runs write jobs from a
+queue of at most max_pending, so that encoding and writing overlap the pipeline while the arrays waiting to be
+written stay bounded. What happens when the queue is full, skipping the job or waiting for room, is up to the
+caller (see offer and put). A forked process starts its own writer, since threads are not forked. Call flush
+before a process exits to wait for the jobs that are still queued.
+'''
+
+import os, queue, threading
+
+# kind of output to (pid, BackgroundWriter)
+writers = {}
+
+
+class BackgroundWriter:
+    def __init__(self, max_pending:int) -> None:
+        '''
+        Background thread that runs write jobs. At most max_pending jobs wait in its queue.
+        '''
+        self.jobs = queue.Queue(maxsize=max_pending)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def offer(self, description:str, function, *args) -> bool:
+        '''
+        Queues function(*args) without waiting. Returns False (and queues nothing) if the queue is full. The
+        arguments must not be modified afterwards. description names the output in error messages.
+        '''
+        try:
+            self.jobs.put_nowait((description, function, args))
+        except queue.Full:
+            return False
+        return True
+
+    def put(self, description:str, function, *args):
+        '''
+        Queues function(*args), waiting for room in the queue if it is full.
+        '''
+        self.jobs.put((description, function, args))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                description, function, args = job
+                function(*args)
+            except Exception as error:
+                print('Could not write {}: {!r}'.format(description, error))
+            finally:
+                self.jobs.task_done()
+
+    def flush(self):
+        '''
+        Waits until every queued job has run.
+        '''
+        self.jobs.join()
+
+    def close(self):
+        '''
+        Runs the queued jobs and stops the thread.
+        '''
+        self.jobs.put(None)
+        self.thread.join()
+
+
+def writer(kind:str, max_pending:int) -> BackgroundWriter:
+    '''
+    Returns this process's writer of the kind of output, starting it if there is none yet.
+    '''
+    pid, current = writers.get(kind, (None, None))
+    if pid != os.getpid():
+        current = BackgroundWriter(max_pending)
+        writers[kind] = (os.getpid(), current)
+    return current
+
+
+def flush(kind:str):
+    '''
+    Waits for this process's queued jobs of the kind of output, if it has any.
+    '''
+    pid, current = writers.get(kind, (None, None))
+    if pid == os.getpid():
+        current.flush()
@@ -0,0 +1,264 @@
+'''
+Resumable batch runner for whole datasets.
+
+Every (image, ground truth) pair becomes one job on a process pool. The number of cases processed at once is
+capped by the memory that is available, so a large dataset keeps every core busy without swapping. Each
+finished case is written to a JSON results manifest as soon as it completes (to a temporary file that is then
+renamed, so the manifest is never left half written), and cases already in the manifest are skipped, so an
+interrupted sweep picks up where it stopped.
+
+For large unlabelled datasets, stream runs the cases one after another in this process instead, while a
+small thread pool reads the next few scans from disk, so that loading overlaps with the segmentation and no
+more than a bounded number of scans is ever in memory.
+'''
+
+import collections, itertools, json, os, tempfile, traceback
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+
+import nibabel as nib
+import numpy as np
+
+import reader, dtype_policy, evaluation, hessian_filters, mesh_export, mask_export, instrumentation
+
+# Memory of one case in bytes per voxel of its scan for the volume, its masks and the float32 filter
+# responses of the bronchial and lesion stages that are alive at the same time, besides the working memory of
+# the Sato and Frangi filters themselves (see case_memory).
+BYTES_PER_VOXEL = 64
+MANIFEST_VERSION = 1
+
+
+def available_memory() -> int:
+    '''
+    Returns the memory in bytes that new processes can use without swapping.
+    '''
+    try:
+        with open('/proc/meminfo') as file:
+            for line in file:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+
+
+def case_memory(path:str) -> int:
+    '''
+    Returns an estimate of the peak memory in bytes needed to process the scan at path, from its header only:
+    its arrays and the working memory of the Sato and Frangi filters (the --filter-memory limit if there is
+    one, otherwise that of filtering the whole volume).
+    '''
+    voxels = int(np.prod(nib.load(path).shape))
+    working = hessian_filters.settings()['memory_limit']
+    if working is None:
+        working = voxels * hessian_filters.WORKING_BYTES_PER_VOXEL
+    return voxels * BYTES_PER_VOXEL + working
+
+
+def concurrency_limit(paths:list, workers_per_case:int=1, memory=None) -> int:
+    '''
+    Returns how many cases can be processed at once: as many as fit in the available memory next to each
+    other (at least one), and no more than there are cores for.
+
+    Args:
+      paths:list - image paths of the cases to run
+      workers_per_case:int - worker processes each case uses for its own parallel stages
+      memory: bytes available (defaults to available_memory())
+    '''
+    if memory is None:
+        memory = available_memory()
+    largest = max(case_memory(path) for path in paths)
+    by_memory = max(memory // max(largest, 1), 1)
+    by_cores = max((os.cpu_count() or 1) // max(workers_per_case, 1), 1)
+    return int(min(by_memory, by_cores, len(paths)))
+
+
+class Manifest:
+    def __init__(self, path:str) -> None:
+        '''
+        Results manifest of a batch run, stored as JSON at path. Cases are keyed by image path.
+        '''
+        self.path = path
+        self.cases = {}
+        if os.path.isfile(path):
+            with open(path) as file:
+                self.cases = json.load(file).get('cases', {})
+
+    def completed(self, image:str) -> bool:
+        return self.cases.get(image, {}).get('status') == 'done'
+
+    def record(self, image:str, result:dict):
+        '''
+        Records the result of a case and writes the manifest to disk.
+        '''
+        self.cases[image] = result
+        self.write()
+
+    def write(self):
+        '''
+        Writes the manifest to a temporary file next to it and renames it into place.
+        '''
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as file:
+                json.dump({'version': MANIFEST_VERSION, 'cases': self.cases}, file, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def confusion(self) -> list:
+        '''
+        Returns the confusion counts of every completed case that has ground truth, in image path order.
+        '''
+        return [evaluation.ConfusionCounts.from_dict(self.cases[image]['confusion']) for image in sorted(self.cases)
+                if self.completed(image) and 'confusion' in self.cases[image]]
+
+    def results(self, key:str) -> list:
+        '''
+        Returns the value of key for every completed case, in image path order.
+        '''
+        return [self.cases[image][key] for image in sorted(self.cases) if self.completed(image)]
+
+
+def run_case(image:str, truth, number:int, footprint_size:int, two_d:bool, policy:str, options:dict, mesh:dict=None, profile:dict=None, filters:dict=None, masks:dict=None) -> dict:
+    '''
+    Worker: runs the pipeline on one case and returns its volumes (or the error if it failed). Meshes and
+    masks the case queued for writing are written before it returns.
+    '''
+    dtype_policy.set_policy(policy)
+    if mesh is not None:
+        mesh_export.configure(**mesh)
+    if masks is not None:
+        mask_export.configure(**masks)
+    if profile is not None:
+        instrumentation.configure(**profile)
+    if filters is not None:
+        hessian_filters.configure(**filters)
+    try:
+        with instrumentation.case(image):
+            read = reader.Reader(image, number, footprint_size, truth, two_d=two_d, **options)
+    except Exception as error:
+        return {'status': 'failed', 'truth': truth, 'error': repr(error), 'traceback': traceback.format_exc()}
+    finally:
+        mesh_export.flush()
+        mask_export.flush()
+    result = {'status': 'done', 'truth': truth,
+              'lung_volume': float(read.lung_volume),
+              'lesion_volume': float(read.lesion_volume),
+              'no_processing_lesion_volume': float(read.no_processing_lesion_volume)}
+    if read.confusion is not None:
+        # confusion counts of the whole case (see evaluation.py), from which the dataset metrics are computed
+        result['confusion'] = read.confusion.total().as_dict()
+        result['evaluation'] = {name: float(value) for name, value in read.confusion.total().metrics().items()}
+    stack = getattr(read, 'stack', None)
+    if stack is not None:
+        # per-slice results of a 2D case (areas in mm^2, DSC null for slices without ground truth)
+        result['slice_numbers'] = [int(number) for number in stack.numbers]
+        result['slice_lesion_areas'] = stack.lesion_areas.tolist()
+        result['slice_dice'] = [None if np.isnan(dice) else float(dice) for dice in stack.dice]
+    return result
+
+
+def prefetch(items, load, depth:int=2):
+    '''
+    Yields (item, future) for every item, where the future holds load(item). A pool of depth threads loads
+    the next depth items while the caller works on the current one, so at most depth + 1 loaded items are
+    alive at once. Exceptions raised by load are raised by future.result().
+
+    Args:
+      items: iterable of items to load (consumed lazily)
+      load: function of one item
+      depth:int - number of items to load ahead
+    '''
+    depth = max(depth, 1)
+    items = iter(items)
+    with ThreadPoolExecutor(max_workers=depth) as pool:
+        pending = collections.deque((item, pool.submit(load, item)) for item in itertools.islice(items, depth))
+        while pending:
+            item, future = pending.popleft()
+            for following in itertools.islice(items, 1):
+                pending.append((following, pool.submit(load, following)))
+            yield item, future
+            # drop the reference so the loaded volume can be freed before the next one is yielded
+            future = None
+
+
+def stream(images, manifest:Manifest, footprint_size:int, depth:int=2, mmap:bool=False, **options):
+    '''
+    Runs the cases (without ground truth) one at a time, loading the next depth scans on background threads,
+    and yields (image, result) as each case finishes. Results are recorded in the manifest as they arrive and
+    cases that are already completed are skipped without being loaded.
+
+    Args:
+      images: iterable of image paths (consumed lazily)
+      manifest:Manifest - results manifest to resume from and write to
+      footprint_size:int - footprint size of the lesion stage
+      depth:int - number of scans to load ahead
+      mmap:bool - memory-map the scans (see reader.load_file)
+      options: passed on to reader.Reader (workers, cache, ...)
+    '''
+    pending = (image for image in images if not manifest.completed(image))
+    load = lambda image: reader.load_file(image, mmap)
+    for number, (image, future) in enumerate(prefetch(pending, load, depth)):
+        try:
+            with instrumentation.case(image):
+                with instrumentation.stage('reader.wait_for_load'):
+                    loaded = future.result()
+                read = reader.Reader(image, number, footprint_size, None, mmap=mmap, loaded=loaded, **options)
+            result = {'status': 'done', 'truth': None,
+                      'lung_volume': float(read.lung_volume),
+                      'lesion_volume': float(read.lesion_volume),
+                      'no_processing_lesion_volume': float(read.no_processing_lesion_volume)}
+        except Exception as error:
+            result = {'status': 'failed', 'truth': None, 'error': repr(error), 'traceback': traceback.format_exc()}
+        read = future = loaded = None
+        manifest.record(image, result)
+        yield image, result
+    mesh_export.flush()
+    mask_export.flush()
+
+
+def run(images:list, truths:list, manifest:Manifest, footprint_size:int, two_d:bool=False, jobs=None, **options) -> Manifest:
+    '''
+    Runs every case that is not yet completed in the manifest on a process pool, recording each result as
+    soon as it arrives. Failed cases are recorded too, and are retried on the next run.
+
+    Args:
+      images:list - image paths
+      truths:list - ground truth paths in the same order (or None for each case without one)
+      manifest:Manifest - results manifest to resume from and write to
+      footprint_size:int - footprint size of the lesion stage
+      two_d:bool - whether the cases are stacks of 2D slices
+      jobs: number of cases to run at once (defaults to concurrency_limit)
+      options: passed on to reader.Reader (workers, cache, mmap, ...)
+    '''
+    pending = [(number, image, truth) for number, (image, truth) in enumerate(zip(images, truths))
+               if not manifest.completed(image)]
+    print('{} of {} cases already completed.'.format(len(images) - len(pending), len(images)))
+    if not pending:
+        return manifest
+    if jobs is None:
+        jobs = concurrency_limit([image for _, image, _ in pending], options.get('workers', 1))
+    jobs = max(min(jobs, len(pending)), 1)
+    print('Processing {} cases, {} at a time...'.format(len(pending), jobs))
+    policy = dtype_policy.POLICY.name
+    mesh = mesh_export.settings()
+    profile = instrumentation.settings()
+    filters = hessian_filters.settings()
+    masks = mask_export.settings()
+    if jobs == 1:
+        for number, image, truth in pending:
+            manifest.record(image, run_case(image, truth, number, footprint_size, two_d, policy, options, mesh, profile, filters, masks))
+            print('Finished case ' + image)
+        return manifest
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = {pool.submit(run_case, image, truth, number, footprint_size, two_d, policy, options, mesh, profile, filters, masks): image
+                   for number, image, truth in pending}
+        for future in as_completed(futures):
+            image = futures[future]
+            manifest.record(image, future.result())
+            print('Finished case ' + image)
+    return manifest
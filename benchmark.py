@@ -0,0 +1,260 @@
+'''
+Benchmark suite of the segmentation stages on synthetic chest CT phantoms (see phantom.py).
+
+For every size, a phantom is generated and Lung, BronchialTree (with its preprocessing, Sato and CEF steps)
+and the lesion stage are run on it in turn, timed through the instrumentation module. Every stage is reported
+with its wall time (the fastest of --repeat runs), its throughput in voxels per second and, from one extra run
+with tracemalloc on, the peak of its allocations. The Dice coefficient of the lesion segmentation against the
+phantom's lesions is reported too, with the number of lesion voxels, so a change that is faster but segments
+differently shows up.
+
+Results can be saved as a baseline and compared against one: a stage that is slower or needs more memory than
+the baseline by more than the tolerance, or a changed Dice coefficient or lesion voxel count, is a regression,
+and the script then exits with status 1. Baselines depend on the machine they were recorded on, so none is
+shipped with the repository: record one with --save-baseline before making changes. Everything runs offline:
+the phantoms are generated and the airway morphometry table is built in.
+
+    python benchmark.py --fast                          # the small phantom only, in seconds
+    python benchmark.py --sizes small medium large      # larger phantoms
+    python benchmark.py --fast --save-baseline benchmark_baseline.json
+'''
+
+import argparse, json, os, platform, sys, tempfile, time
+
+import numpy as np
+
+import phantom, bronchial_tree, lesion, hessian_filters, instrumentation, mesh_export, dtype_policy
+import volume as volume_pipeline
+
+BASELINE_PATH = 'benchmark_baseline.json'
+FAST_SIZES = ('small',)
+DEFAULT_SIZES = ('small', 'medium')
+TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.25
+# differences below these are noise, whatever the tolerance
+MIN_SECONDS = 0.05
+MIN_MEGABYTES = 4
+DICE_TOLERANCE = 1e-3
+FOOTPRINT_SIZE = 3
+
+# Weibel's symmetric airway model (generations 0-6), in the format of resources/morphometry.txt
+MORPHOMETRY = '''0 1 12.0 1.8 0 0 2.54 30.5 30.5
+1 2 4.76 1.22 33 20 2.33 11.3 41.8
+2 4 1.90 0.83 34 31 2.13 3.9 45.7
+3 8 0.76 0.56 22 43 2.00 1.5 47.2
+4 16 1.27 0.45 20 39 2.48 3.5 50.7
+5 32 1.07 0.35 18 39 3.11 3.3 54.0
+6 64 0.90 0.28 19 40 3.96 3.6 57.6
+'''
+
+# reported stages and the instrumentation paths they are recorded under
+STAGES = (
+    ('lung', 'case/lung'),
+    ('bronchial_tree', 'case/bronchial_tree'),
+    ('preprocessing', 'case/bronchial_tree/bronchial_tree.preprocessing'),
+    ('sato', 'case/bronchial_tree/bronchial_tree.hessian_analysis'),
+    ('cef', 'case/bronchial_tree/bronchial_tree.cavity_enhancement_filter'),
+    ('multires_cef', 'case/bronchial_tree/bronchial_tree.multiresolution_cef'),
+    ('lesion', 'case/lesion'),
+    ('total', 'case'),
+)
+
+
+def run_pipeline(volume, truth, spacing, name:str, workers:int=1, multiresolution:int=1, crop:bool=True):
+    '''
+    Runs the lung, bronchial tree and lesion stages on a volume as Volume.process_volume does (see
+    volume.segment_lungs_and_airway), and returns (records, lesions, airway): the instrumentation records of
+    the run, the LesionStage and the BronchialTree.
+    '''
+    records = []
+    voxel_x, voxel_y, voxel_z = spacing
+    with instrumentation.case(name, records=records):
+        _, airway, box, frame = volume_pipeline.segment_lungs_and_airway(volume, voxel_x, voxel_y, voxel_z, workers=workers, multiresolution=multiresolution, crop=crop)
+        with instrumentation.stage('lesion', volume=volume[box]):
+            lesions = lesion.LesionStage(name, volume[box], airway.lung_mask, airway.cef_volume, voxel_x, voxel_y, voxel_z, FOOTPRINT_SIZE, 0, truth=truth, frame=frame)
+    return records, lesions, airway
+
+
+def stage_results(runs:list, voxels:int, memory_records=None) -> dict:
+    '''
+    Returns the wall time (fastest run), throughput and peak traced memory of every reported stage.
+    '''
+    results = {}
+    for label, path in STAGES:
+        times = [record['wall_s'] for records in runs for record in records if record['stage'] == path]
+        if not times:
+            continue
+        wall = min(times)
+        results[label] = {'wall_s': wall, 'voxels_per_s': voxels / wall if wall > 0 else float('inf')}
+        if memory_records is not None:
+            peaks = [record['traced_peak_mb'] for record in memory_records if record['stage'] == path and 'traced_peak_mb' in record]
+            if peaks:
+                results[label]['peak_mb'] = max(peaks)
+    return results
+
+
+def benchmark(size:str, repeat:int=3, workers:int=1, memory:bool=True, seed:int=0, multiresolution:int=1, crop:bool=True) -> dict:
+    '''
+    Benchmarks one phantom size and returns its results.
+
+    Args:
+      size:str - a key of phantom.SIZES
+      repeat:int - number of timed runs (the fastest is reported)
+      workers:int - worker processes of the lung and CEF stages
+      memory:bool - whether to make an extra run with tracemalloc on to measure peak memory
+      seed:int - seed of the phantom
+      multiresolution:int - downsampling factor of the coarse-to-fine CEF (1 for full resolution); its
+                            output is then also compared against the full-resolution filter
+      crop:bool - run the bronchial tree and lesion stages on the bounding box of the lungs
+    '''
+    shape = phantom.SIZES[size]
+    print('Generating {} phantom {}...'.format(size, 'x'.join(str(n) for n in shape)))
+    started = time.perf_counter()
+    volume, truth, spacing = phantom.chest_phantom(shape, seed=seed)
+    generation = time.perf_counter() - started
+    name = 'phantom_{}.nii'.format(size)
+
+    runs = []
+    for i in range(max(repeat, 1)):
+        print('Run {} of {}...'.format(i + 1, repeat))
+        records, lesions, airway = run_pipeline(volume, truth, spacing, name, workers, multiresolution, crop)
+        runs.append(records)
+    dice = lesions.processed.dice_coeff
+    memory_records = None
+    if memory:
+        print('Measuring peak memory...')
+        previous = instrumentation.settings()
+        instrumentation.configure(previous['directory'], trace_allocations=True)
+        try:
+            memory_records, _, _ = run_pipeline(volume, truth, spacing, name, workers, multiresolution, crop)
+        finally:
+            instrumentation.configure(**previous)
+    result = {'shape': list(shape), 'voxels': int(volume.size), 'spacing': list(spacing), 'generation_s': generation,
+              'dice': None if dice is None else float(dice), 'lesion_voxels': int(lesions.processed.total_lesion_voxels), 'stages': stage_results(runs, volume.size, memory_records)}
+    if airway.multiresolution > 1:
+        print('Comparing against the full-resolution filter...')
+        reference = bronchial_tree.BronchialTree(airway.volume, airway.lung_segmentations, spacing[0], spacing[1], 0, cef_workers=workers)
+        result['multiresolution'] = dict(bronchial_tree.multiresolution_error(reference.cef_volume, airway.cef_volume),
+                                         factor=multiresolution, refined_fraction=airway.refined_fraction)
+    return result
+
+
+def machine() -> dict:
+    return {'platform': platform.platform(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'processor': platform.processor() or platform.machine(), 'cpus': os.cpu_count()}
+
+
+def compare(results:dict, baseline:dict, tolerance:float=TOLERANCE, memory_tolerance:float=MEMORY_TOLERANCE) -> list:
+    '''
+    Returns the regressions of results against a baseline, as messages. Sizes and stages missing from either
+    are skipped.
+    '''
+    regressions = []
+    for size, result in results['sizes'].items():
+        reference = baseline.get('sizes', {}).get(size)
+        if reference is None:
+            print('No baseline for size {}.'.format(size))
+            continue
+        if result['dice'] is not None and reference.get('dice') is not None and abs(result['dice'] - reference['dice']) > DICE_TOLERANCE:
+            regressions.append('{}: Dice changed from {:.4f} to {:.4f}'.format(size, reference['dice'], result['dice']))
+        if reference.get('lesion_voxels') is not None and result['lesion_voxels'] != reference['lesion_voxels']:
+            regressions.append('{}: {} lesion voxels, baseline {}'.format(size, result['lesion_voxels'], reference['lesion_voxels']))
+        for label, stage in result['stages'].items():
+            expected = reference['stages'].get(label)
+            if expected is None:
+                continue
+            wall, limit = stage['wall_s'], expected['wall_s'] * (1 + tolerance)
+            if wall > limit and wall - expected['wall_s'] > MIN_SECONDS:
+                regressions.append('{} {}: {:.3f} s, baseline {:.3f} s (+{:.0%})'.format(size, label, wall, expected['wall_s'], wall / expected['wall_s'] - 1))
+            if 'peak_mb' in stage and 'peak_mb' in expected:
+                peak, limit = stage['peak_mb'], expected['peak_mb'] * (1 + memory_tolerance)
+                if peak > limit and peak - expected['peak_mb'] > MIN_MEGABYTES:
+                    regressions.append('{} {}: peak {:.1f} MB, baseline {:.1f} MB'.format(size, label, peak, expected['peak_mb']))
+    return regressions
+
+
+def print_results(results:dict, baseline=None):
+    for size, result in results['sizes'].items():
+        reference = (baseline or {}).get('sizes', {}).get(size, {}).get('stages', {})
+        dice = 'n/a' if result['dice'] is None else '{:.4f}'.format(result['dice'])
+        print('\n{} {} ({:.1f} M voxels), Dice {}, {} lesion voxels'.format(size, 'x'.join(str(n) for n in result['shape']), result['voxels'] / 1e6, dice, result['lesion_voxels']))
+        print('{:<16}{:>10}{:>14}{:>12}{:>12}'.format('stage', 'seconds', 'Mvoxels/s', 'peak MB', 'vs base'))
+        for label, stage in result['stages'].items():
+            peak = '{:.1f}'.format(stage['peak_mb']) if 'peak_mb' in stage else '-'
+            change = '-'
+            if label in reference:
+                change = '{:+.0%}'.format(stage['wall_s'] / reference[label]['wall_s'] - 1)
+            print('{:<16}{:>10.3f}{:>14.2f}{:>12}{:>12}'.format(label, stage['wall_s'], stage['voxels_per_s'] / 1e6, peak, change))
+        if 'multiresolution' in result:
+            error = result['multiresolution']
+            print('multi-resolution x{}: {:.1%} refined, airway Dice {:.4f}, max error {:.2%}, mean error {:.3%}'.format(
+                error['factor'], error['refined_fraction'], error['airway_dice'], error['max_error'], error['mean_error']))
+
+
+def write_json(path:str, data:dict):
+    directory = os.path.dirname(os.path.abspath(path))
+    os.makedirs(directory, exist_ok=True)
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description='Benchmark the segmentation stages on synthetic chest CT phantoms.')
+    parser.add_argument('--fast', action='store_true', help='only the small phantom, with one timed run (for every change)')
+    parser.add_argument('--sizes', nargs='+', choices=list(phantom.SIZES), help='phantom sizes to run (default: {})'.format(' '.join(DEFAULT_SIZES)))
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per size, the fastest is reported (default: 3)')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='worker processes of the lung and CEF stages')
+    parser.add_argument('--multiresolution', type=int, default=1, help='run the CEF coarse-to-fine with this factor and report its error')
+    parser.add_argument('--no-crop', action='store_true', help='run the later stages on the whole phantom, not the bounding box of the lungs')
+    parser.add_argument('--filter-memory', type=float, default=None, help='working memory limit of the Sato and Frangi filters in GB')
+    parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc run that measures peak memory')
+    parser.add_argument('--baseline', default=BASELINE_PATH, help='baseline to compare against (default: {}, if it exists)'.format(BASELINE_PATH))
+    parser.add_argument('--save-baseline', metavar='FILE', help='write the results as a new baseline')
+    parser.add_argument('--output', metavar='FILE', help='write the results as JSON')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='allowed relative slowdown (default: {})'.format(TOLERANCE))
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE, help='allowed relative growth of peak memory (default: {})'.format(MEMORY_TOLERANCE))
+    parser.add_argument('--dtype-policy', default='compact', choices=list(dtype_policy.POLICIES))
+    args = parser.parse_args(argv)
+
+    sizes = args.sizes or (FAST_SIZES if args.fast else DEFAULT_SIZES)
+    repeat = 1 if args.fast and args.repeat == 3 else args.repeat
+    dtype_policy.set_policy(args.dtype_policy)
+    mesh_export.configure(format='none')
+    hessian_filters.configure(None if args.filter_memory is None else int(args.filter_memory * 1024**3))
+    with tempfile.TemporaryDirectory() as directory:
+        bronchial_tree.MORPHOMETRY_PATH = os.path.join(directory, 'morphometry.txt')
+        with open(bronchial_tree.MORPHOMETRY_PATH, 'w') as file:
+            file.write(MORPHOMETRY)
+        results = {'machine': machine(), 'dtype_policy': args.dtype_policy, 'workers': args.workers, 'repeat': repeat,
+                   'multiresolution': args.multiresolution, 'filter_memory': args.filter_memory, 'crop': not args.no_crop,
+                   'sizes': {size: benchmark(size, repeat, args.workers, not args.no_memory, multiresolution=args.multiresolution, crop=not args.no_crop)
+                            for size in sizes}}
+
+    baseline = None
+    if args.baseline and os.path.isfile(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+    print_results(results, baseline)
+    if args.output:
+        write_json(args.output, results)
+    if args.save_baseline:
+        write_json(args.save_baseline, results)
+        print('\nSaved baseline to ' + args.save_baseline)
+        return 0
+    if baseline is None:
+        print('\nNo baseline to compare against (record one with --save-baseline).')
+        return 0
+    if baseline.get('machine', {}).get('platform') != results['machine']['platform']:
+        print('\nWarning: the baseline was recorded on a different machine ({}).'.format(baseline.get('machine', {}).get('platform')))
+    regressions = compare(results, baseline, args.tolerance, args.memory_tolerance)
+    if regressions:
+        print('\nRegressions against {}:'.format(args.baseline))
+        for regression in regressions:
+            print('  ' + regression)
+        return 1
+    print('\nNo regressions against {}.'.format(args.baseline))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
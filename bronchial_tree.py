@@ -13,58 +13,188 @@ At a high level, the algorithm works as follows:
 The result should be a segmentation of the bronchus region.
 '''
 
-import statistics, math, sys, pickle
-from skimage.filters import unsharp_mask, sato
+import statistics, math, sys, os, pickle, functools
+from skimage.filters import unsharp_mask, threshold_otsu
 from skimage import util
-from skimage.transform import rescale
+from skimage.transform import rescale, resize
 
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
-import helper_functions
+import helper_functions, cavity_enhancement, hessian_filters, dtype_policy, evaluation, morphology, stage_file, instrumentation
+
+UNSHARP_RADIUS = 5
+UNSHARP_AMOUNT = 2
+SATO_SIGMAS = range(1, 3)
+MORPHOMETRY_PATH = 'resources/morphometry.txt'
+# multi-resolution mode: voxels whose coarse CEF response is above this fraction of its Otsu threshold are
+# refined at full resolution
+CANDIDATE_THRESHOLD = 1.0
+
+
+def calculate_per_tube(row):
+    row_list = row.tolist()
+    num_tubes = row_list[1]
+    total_area_mm = row_list[6]*100
+    return total_area_mm / num_tubes
+
+
+@instrumentation.timed('load_bronchial_segmentation')
+def load_bronchial_segmentation(path:str):
+    '''
+    Returns a precomputed CEF volume: memory-mapped from a stage_file.py file if path is one or has been
+    converted to one (the same path with its extension), otherwise unpickled from a .p file of earlier
+    versions, which stacked the slices of the Hessian volume in reverse order.
+    '''
+    converted = os.path.splitext(path)[0] + stage_file.EXTENSION
+    for candidate in (path, converted):
+        if stage_file.is_stage_file(candidate):
+            return stage_file.read(candidate)[0]['cef_volume']
+    print('Unpickling {}; convert it with python stage_file.py {} to load it faster and safely.'.format(path, path))
+    cef_volume = pd.read_pickle(path)
+    if cef_volume.ndim > 2:
+        cef_volume = cef_volume[:, :, ::-1]
+    return cef_volume
+
+
+@functools.lru_cache(maxsize=None)
+def read_morphometry(path:str):
+    '''
+    Reads and converts the airway morphometry table. The table is parsed once per process and shared by every
+    BronchialTree (which gets a copy).
+    '''
+    data = pd.read_csv(path, sep=" ", header=None)
+    data.columns = ["generation", "num_tubes", "length_cm", "diameter_cm", "branching_angle", "gravity_angle", "total_area_cm^2", 'volume_cm^3', 'cumulative_volume_cm^3']
+    # convert to mm from cm
+    data["total_area_cm^2"] = data["total_area_cm^2"].apply(lambda x: x*100)
+    data['length_cm'] = data['length_cm'].apply(lambda x: x*10)
+    data['diameter_cm'] = data['diameter_cm'].apply(lambda x: x*10)
+    # convert diameter to radius
+    data['diameter_cm'] = data['diameter_cm'].apply(lambda x: x/2)
+    data.rename(columns={'generation':'generation', "num_tubes":'num_tubes', "length_cm":'length_mm', "diameter_cm":"radius_mm", "branching_angle":'branching_angle',
+     "gravity_angle":'gravity_angle', "total_area_cm^2":"average_area_per_tube_mm^2", 'volume_cm^3':'volume_mL', 'cumulative_volume_cm^3':'cumulative_volume_mL'}, inplace=True)
+    # stats for total area and volume measurements
+    # calculate area per tube
+    data['average_area_per_tube_mm^2'] = data.apply(calculate_per_tube, axis=1)
+    return data
+
+
+def coarse_radii(radii, factor:int) -> list:
+    '''
+    Returns the radii (in voxels) that the coarse level of the multi-resolution mode evaluates, in coarse
+    voxels: those of the large generations, which still span at least two voxels after downsampling by factor.
+    If there are none, every radius is mapped to the coarse grid.
+    '''
+    coarse = sorted({int(round(r / factor)) for r in radii if r >= 2 * factor})
+    return coarse or sorted({max(int(round(r / factor)), 1) for r in radii})
+
+
+def airway_mask(cef_volume):
+    '''
+    Returns the airway mask that the lesion stage derives from a CEF response (see
+    helper_functions.create_grayscale_mask): the voxels at or above its Otsu threshold.
+    '''
+    return cef_volume >= threshold_otsu(cef_volume)
+
+
+def multiresolution_error(reference, approximation) -> dict:
+    '''
+    Returns how far a multi-resolution CEF response is from the full-resolution reference: the largest and
+    mean absolute differences relative to the largest reference response, the fraction of voxels that differ,
+    and the Dice coefficient between the airway masks the lesion stage thresholds the two into.
+    '''
+    difference = np.abs(np.asarray(approximation, dtype=np.float64) - reference)
+    scale = float(np.abs(reference).max()) or 1.0
+    airways = evaluation.confusion_counts(airway_mask(approximation), airway_mask(reference))
+    return {'max_error': float(difference.max()) / scale,
+            'mean_error': float(difference.mean()) / scale,
+            'changed_fraction': float(np.count_nonzero(difference)) / difference.size,
+            'airway_dice': float(airways.metrics()['dice'])}
+
 
 class BronchialTree():
-    def __init__(self, volume, lung_segmentations, x_mm, y_mm, number, demo=False, bronchial_segmentation='') -> None:
+    def __init__(self, volume, lung_segmentations, x_mm, y_mm, number, demo=False, bronchial_segmentation='', restrict_to_lung=True, dilate_lung_mask=True, cef_workers=1, cache=None, volume_digest=None, stacked=False, multiresolution:int=1) -> None:
+        '''
+        stacked: volume is a stack of independent 2D images along its last axis (see SliceStack in volume.py).
+                 Every stage then treats each image as the 2D mode would on its own, but in one pass.
+        multiresolution:int - downsampling factor of the coarse level of the CEF (see multiresolution_cef),
+                 1 to filter at full resolution only. Only used for 3D volumes restricted to the lung.
+        '''
         self.number = number
+        self.stacked = stacked
+        self.multiresolution = multiresolution if multiresolution > 1 and volume.ndim == 3 and not stacked and restrict_to_lung else 1
+        # fraction of the filtered voxels that the multi-resolution mode computed at full resolution
+        self.refined_fraction = 1.0
+        self.cache = cache
+        self.volume_digest = volume_digest
+        self.cef_workers = cef_workers
+        self.restrict_to_lung = restrict_to_lung
+        self.dilate_lung_mask = dilate_lung_mask
         self.volume = volume
-        self.lung_vol = np.dstack(lung_segmentations)
+        # the segmented lungs of Lung.segmentations, slices along the last axis (a single slice for 2D)
+        self.lung_vol = lung_segmentations
+        self.lung_segmentations = lung_segmentations
 
         self.lung_mask = self.create_lung_mask()
         self.x_mm = x_mm
         self.y_mm = y_mm
-        if len(self.volume.shape) > 2:
-            self.slices = helper_functions.create_slices(self.volume)
-        else:
-            self.slices = [self.volume]
-        self.morphometry_path = 'resources/morphometry.txt'
+        self.morphometry_path = MORPHOMETRY_PATH
         self.morphometry_info = self.read_in_morphometry_info()
         self.avg_radii = self.calculate_radii_per_generation()
+        preprocessing_params = {'unsharp_radius': UNSHARP_RADIUS, 'unsharp_amount': UNSHARP_AMOUNT}
+        if stacked:
+            preprocessing_params['stacked'] = True
+        hessian_params = dict(preprocessing_params, sato_sigmas=list(SATO_SIGMAS))
+        cef_params = dict(hessian_params, avg_radii=sorted(self.avg_radii), restrict_to_lung=restrict_to_lung, dilate_lung_mask=dilate_lung_mask)
+        if self.multiresolution > 1:
+            cef_params.update(multiresolution=self.multiresolution, candidate_threshold=CANDIDATE_THRESHOLD)
         print('Begin bronchial tree preprocessing step ...')
-        self.preprocessed_slices, self.preprocessed_volume = self.preprocessing()
+        self.preprocessed_volume = self.cached_stage('preprocessed', self.preprocessing, preprocessing_params)
         print('Begin bronchial tree Hessian analysis ...')
-        self.hessian_slices, self.hessian_volume = self.hessian_analysis()
+        self.hessian_volume = self.cached_stage('hessian', self.hessian_analysis, hessian_params)
         if demo and bronchial_segmentation != '':
-            self.cef_volume = pd.read_pickle(bronchial_segmentation)
-            cef_slices = helper_functions.create_slices(self.cef_volume)
-            plt.imshow(cef_slices[len(cef_slices)//2], cmap='gray')
+            self.cef_volume = load_bronchial_segmentation(bronchial_segmentation)
+            plt.imshow(self.cef_volume[:, :, self.cef_volume.shape[2]//2] if self.cef_volume.ndim > 2 else self.cef_volume, cmap='gray')
             plt.title('Bronchial Segmentation')
             plt.show()
         else:
             if len(self.volume.shape) > 2:
                 print('Begin bronchial tree cavity enhancement filter ...')
-                self.cef_volume = self.cavity_enhancement_filter()
-            else:
-                self.cef_volume = self.hessian_volume
-                self.cef_volume = self.cavity_enhancement_filter()
+            cef = self.multiresolution_cef if self.multiresolution > 1 else self.cavity_enhancement_filter
+            self.cef_volume = self.cached_stage('cef', cef, cef_params)
 
 
+    def cached_stage(self, stage, compute, params):
+        '''
+        Returns compute(), loading it from (or storing it in) the stage cache when there is one. params
+        must include the parameters of every earlier stage the result depends on.
+        '''
+        if self.cache is None:
+            return compute()
+        key = self.cache.key(stage, self.volume_digest, voxel=(self.x_mm, self.y_mm), **params)
+        return self.cache.get_or_compute(key, lambda: {'volume': compute()})['volume']
+
     def create_lung_mask(self):
-        # binary threshold
+        # binary threshold (per image for a stack of 2D images)
+        if self.stacked:
+            binary = np.empty(self.lung_vol.shape, dtype=bool)
+            for i in range(self.lung_vol.shape[2]):
+                binary[:, :, i] = helper_functions.create_binary_mask(self.lung_vol[:, :, i])
+            return binary
         binary = helper_functions.create_binary_mask(self.lung_vol)
         return binary       
 
 
+    def cef_lung_mask(self):
+        '''
+        Returns the lung mask aligned with the Hessian volume: in 2D the single mask slice, otherwise the
+        mask itself, as every stage keeps the slice order of the scan.
+        '''
+        if len(self.hessian_volume.shape) == 2:
+            return self.lung_mask[:, :, 0]
+        return self.lung_mask
+
     def calculate_radii_per_generation(self):
         morphometry_radii = self.morphometry_info.loc[:, ['generation', 'radius_mm']]
         grouped_radii = morphometry_radii.groupby('generation')['radius_mm'].apply(list)
@@ -79,59 +209,41 @@ class BronchialTree():
         return list(set(average_radii))
 
     def calculate_per_tube(self, row):
-        row_list = row.tolist()
-        num_tubes = row_list[1]
-        total_area_mm = row_list[6]*100
-        return total_area_mm / num_tubes
+        return calculate_per_tube(row)
 
     def read_in_morphometry_info(self):
-        data = pd.read_csv(self.morphometry_path, sep=" ", header=None)
-        data.columns = ["generation", "num_tubes", "length_cm", "diameter_cm", "branching_angle", "gravity_angle", "total_area_cm^2", 'volume_cm^3', 'cumulative_volume_cm^3']
-        # convert to mm from cm
-        data["total_area_cm^2"] = data["total_area_cm^2"].apply(lambda x: x*100)
-        data['length_cm'] = data['length_cm'].apply(lambda x: x*10)
-        data['diameter_cm'] = data['diameter_cm'].apply(lambda x: x*10)
-        # convert diameter to radius
-        data['diameter_cm'] = data['diameter_cm'].apply(lambda x: x/2)
-        data.rename(columns={'generation':'generation', "num_tubes":'num_tubes', "length_cm":'length_mm', "diameter_cm":"radius_mm", "branching_angle":'branching_angle',
-         "gravity_angle":'gravity_angle', "total_area_cm^2":"average_area_per_tube_mm^2", 'volume_cm^3':'volume_mL', 'cumulative_volume_cm^3':'cumulative_volume_mL'}, inplace=True)
-        # stats for total area and volume measurements
-        # calculate area per tube
-        data['average_area_per_tube_mm^2'] = data.apply(self.calculate_per_tube, axis=1)
-        return data
+        return read_morphometry(self.morphometry_path).copy()
 
+    @instrumentation.timed('bronchial_tree.preprocessing')
     def preprocessing(self):
         '''
         The preprocessing step defined in the paper is to use an unsharp mask. No radius or amount were
         defined in the paper. The values herein are based on manual tuning.
         '''
-        if len(self.slices) > 1:
-            preprocessed_slices = []
-            for i in reversed(range(len(self.slices))):
-                unsharp = unsharp_mask(self.slices[i], radius=5, amount=2)
-                preprocessed_slices.append(unsharp)
-            preprocessed_volume = np.dstack(preprocessed_slices)
-        else:
-            unsharp = unsharp_mask(self.volume, radius=5, amount=2)
-            return None, unsharp
-        return preprocessed_slices, preprocessed_volume
-
+        if self.volume.ndim == 2:
+            return unsharp_mask(dtype_policy.POLICY.filter_input(self.volume), radius=UNSHARP_RADIUS, amount=UNSHARP_AMOUNT, preserve_range=True)
+        # slice by slice (also for a 3D scan), each slice written into the preprocessed volume in place
+        preprocessed_volume = None
+        for i in range(self.volume.shape[2]):
+            unsharp = unsharp_mask(dtype_policy.POLICY.filter_input(self.volume[:, :, i]), radius=UNSHARP_RADIUS, amount=UNSHARP_AMOUNT, preserve_range=True)
+            if preprocessed_volume is None:
+                preprocessed_volume = np.empty(self.volume.shape, dtype=unsharp.dtype)
+            preprocessed_volume[:, :, i] = unsharp
+        return preprocessed_volume
+
+    @instrumentation.timed('bronchial_tree.hessian_analysis')
     def hessian_analysis(self):
         '''
-        Returns slices (for viewing) and volume (for viewing and further processing) that have had a Hessian
-        matrix applied to it in which the function is a Gaussian filter.
+        Returns the volume that has had a Hessian matrix applied to it in which the function is a Gaussian
+        filter.
         '''
-
-        if self.preprocessed_volume is not None:
-            hessian_vol = sato(self.preprocessed_volume, sigmas=range(1, 3), black_ridges=False)
-            return None, hessian_vol
-        else:
-            hessian_vol = sato(self.preprocessed_volume, sigmas=range(1, 3), black_ridges=False)
-            hessian_slices = []
-            for i in range(len(self.preprocessed_slices)):
-                hessian_img = sato(self.preprocessed_slices[i], sigmas=range(1, 3), black_ridges=False)
-                hessian_slices.append(hessian_img)
-        return hessian_slices, hessian_vol
+        if self.stacked:
+            # every image of the stack is filtered on its own, into the Hessian volume in place
+            hessian_vol = np.empty(self.preprocessed_volume.shape, dtype=hessian_filters.float_dtype(self.preprocessed_volume.dtype))
+            for i in range(self.preprocessed_volume.shape[2]):
+                hessian_filters.sato(self.preprocessed_volume[:, :, i], sigmas=SATO_SIGMAS, black_ridges=False, out=hessian_vol[:, :, i])
+            return hessian_vol
+        return hessian_filters.sato(self.preprocessed_volume, sigmas=SATO_SIGMAS, black_ridges=False)
 
     def is_in_bounds(self, x:int, y:int, z:int)->bool:
         '''
@@ -223,14 +335,66 @@ class BronchialTree():
             l_term = first_term - second_term + third_term
         return l_term
 
+    @instrumentation.timed('bronchial_tree.cavity_enhancement_filter')
     def cavity_enhancement_filter(self):
         '''
         Cavity Enhancement Filter (Hirano, Tachibana, and Kido 2011) finds the bronchial
-        wall, which helps mitigate the Partial Volume Effect (PVE). 
+        wall, which helps mitigate the Partial Volume Effect (PVE). The filter is evaluated by the
+        vectorized engine in cavity_enhancement.py, only within the lung (dilated by the largest radius)
+        unless restrict_to_lung is False, and on cef_workers processes.
+        '''
+        if self.restrict_to_lung:
+            return cavity_enhancement.cavity_enhancement_filter(self.hessian_volume, self.avg_radii, mask=self.cef_lung_mask(), dilate_mask=self.dilate_lung_mask, workers=self.cef_workers, stacked=self.stacked)
+        return cavity_enhancement.cavity_enhancement_filter(self.hessian_volume, self.avg_radii, workers=self.cef_workers, stacked=self.stacked)
 
-        TODO: Limit this to only be called within the lung.
+    @instrumentation.timed('bronchial_tree.multiresolution_cef')
+    def multiresolution_cef(self):
+        '''
+        Coarse-to-fine Cavity Enhancement Filter. The preprocessed volume is downsampled by the
+        multiresolution factor, and the Sato filter and the CEF (with the radii of the large generations, see
+        coarse_radii) run on it to find candidate airway voxels: those whose coarse response is above
+        CANDIDATE_THRESHOLD times its Otsu threshold within the lung. Only a band around the candidates (the
+        upsampled candidates dilated by the factor) is filtered at full resolution, with every radius, so
+        there the response is exactly that of cavity_enhancement_filter. Elsewhere in the lung the coarse
+        response is used, upsampled and scaled to the full-resolution response by a least-squares fit over
+        the band. multiresolution_error measures the difference to the full-resolution filter. The mode is
+        experimental: outside the band the error has no bound, and only a full-resolution run measures it.
+        '''
+        factor = self.multiresolution
+        mask = self.cef_lung_mask()
+        candidates = cavity_enhancement.candidate_mask(mask, max(self.avg_radii) if self.dilate_lung_mask else 0)
+        radii = coarse_radii(self.avg_radii, factor)
+        # coarse level
+        coarse_volume = rescale(self.preprocessed_volume, 1 / factor, anti_aliasing=True, preserve_range=True)
+        coarse_hessian = hessian_filters.sato(dtype_policy.POLICY.filter_input(coarse_volume), sigmas=SATO_SIGMAS, black_ridges=False)
+        coarse_mask = rescale(mask.astype(np.float32), 1 / factor, order=1, anti_aliasing=False) > 0
+        # dilated to cover every full-resolution candidate
+        coarse_candidates = cavity_enhancement.candidate_mask(coarse_mask, math.ceil(max(self.avg_radii) / factor) if self.dilate_lung_mask else 0)
+        if not coarse_candidates.any():
+            return self.cavity_enhancement_filter()
+        coarse = cavity_enhancement.cavity_enhancement_filter(coarse_hessian, radii, mask=coarse_candidates, workers=self.cef_workers)
+        threshold = CANDIDATE_THRESHOLD * threshold_otsu(coarse[coarse_candidates])
+        # fine level, in the band around the candidates
+        band = resize(coarse >= threshold, mask.shape, order=0, anti_aliasing=False)
+        band = morphology.binary_dilation(band, morphology.ball(factor, 'chessboard')) & candidates
+        self.refined_fraction = np.count_nonzero(band) / max(np.count_nonzero(candidates), 1)
+        print('Refining {:.1%} of the lung at full resolution ...'.format(self.refined_fraction))
+        cef_volume = cavity_enhancement.cavity_enhancement_filter(self.hessian_volume, self.avg_radii, mask=band, workers=self.cef_workers)
+        upsampled = resize(coarse, mask.shape, order=1, preserve_range=True, anti_aliasing=False).astype(cef_volume.dtype)
+        denominator = float(np.sum(np.square(upsampled[band], dtype=np.float64)))
+        scale = float(np.dot(cef_volume[band].astype(np.float64), upsampled[band])) / denominator if denominator > 0 else 1.0
+        outside = candidates & ~band
+        cef_volume[outside] = scale * upsampled[outside]
+        return cef_volume
+
+    def cavity_enhancement_filter_reference(self):
+        '''
+        Per-voxel reference implementation of the Cavity Enhancement Filter. This is very slow (> 25 hours
+        for a 3D scan) and is kept only to check the vectorized engine against. Every voxel reads the
+        unfiltered Hessian volume and the result is written to a copy.
         '''
-        if self.preprocessed_slices is not None:
+        cef_volume = self.hessian_volume.copy()
+        if self.hessian_volume.ndim > 2:
             cols, rows, plane = self.hessian_volume.shape
 
             for c in range(cols-1):
@@ -250,7 +414,7 @@ class BronchialTree():
                                                 if difference > max_difference_p_l:
                                                     max_difference_p_l = difference
                                     max_differences.append(max_difference_p_l)
-                        self.hessian_volume[c, r, p] = sum(max_differences)
+                        cef_volume[c, r, p] = sum(max_differences)
         else:
             cols, rows = self.hessian_volume.shape
             for c in range(cols-1):
@@ -268,9 +432,9 @@ class BronchialTree():
                                         if difference > max_difference_p_l:
                                             max_difference_p_l = difference
                             max_differences.append(max_difference_p_l)
-                    self.hessian_volume[c, r] = sum(max_differences)
+                    cef_volume[c, r] = sum(max_differences)
                     
-        return self.hessian_volume
+        return cef_volume
 
 
 
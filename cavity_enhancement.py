@@ -0,0 +1,237 @@
+'''
+Vectorized Cavity Enhancement Filter (Hirano, Tachibana, and Kido 2011).
+
+The per-voxel loop in BronchialTree visits each voxel, each of the 3^n directions and each (r_1, r_2) pair
+of radii, with its own bounds checks. Here the same P and L terms are computed for one (direction, r_1, r_2)
+combination at a time as shifted copies of the whole Hessian volume, and the bounds checks become boolean
+masks over those copies.
+
+The boundary behaviour of the loop is reproduced exactly:
+- only the upper bound of an index is checked, so an offset that runs past the end of an axis is invalid,
+- an offset that runs below zero wraps around to the other end of the axis (negative numpy indexing),
+- the last index of every axis is not filtered and keeps its Hessian value.
+
+The filter can also be restricted to a (lung) mask, in which case it is only evaluated at a compact list of
+candidate coordinates and every other voxel of the output is 0.
+
+A stack of independent 2D images (stacked along the last axis) can be filtered in one call with stacked=True:
+every image is filtered exactly as the 2D loop would filter it on its own, with no offsets along the stack.
+
+The voxels are evaluated a slab of planes along the last (z) axis at a time, so the working memory (about 100
+bytes per evaluated voxel) is bounded by the slab rather than the volume. For large volumes the slabs can run
+on a process pool (workers > 1), with the input and output shared between processes through shared_arrays.
+'''
+
+import itertools, multiprocessing, sys
+
+import numpy as np
+import scipy.ndimage as ndimage
+
+import shared_arrays, morphology
+
+DIRECTION_OFFSETS = (-1, 0, 1)
+# In float32 this underflows to 0, which selects exactly the same (r_1, r_2) pairs: no positive float32 is smaller.
+FLOAT_MIN = sys.float_info.min
+# most voxels a single process evaluates at once (about 200 MB of working memory)
+SLAB_VOXELS = 2**21
+
+
+def directions(ndim:int, stacked:bool=False) -> list:
+    '''
+    Returns every (i, j[, k]) direction in the order the reference loop visits them. For a stack of 2D
+    images the offset along the stack axis is always 0.
+    '''
+    if stacked:
+        return [direction + (0,) for direction in itertools.product(DIRECTION_OFFSETS, repeat=ndim - 1)]
+    return list(itertools.product(DIRECTION_OFFSETS, repeat=ndim))
+
+
+def interior_coordinates(shape, start:int=0, stop=None, stacked:bool=False) -> tuple:
+    '''
+    Returns open-grid coordinates of every voxel the reference loop filters (all but the last index per axis,
+    or per image axis for a stack), optionally limited to the planes [start, stop) of the last axis.
+    '''
+    end = shape[-1] if stacked else shape[-1] - 1
+    last = end if stop is None else min(stop, end)
+    ranges = [slice(0, n - 1) for n in shape[:-1]] + [slice(start, last)]
+    return tuple(np.ogrid[tuple(ranges)])
+
+
+def candidate_mask(mask, dilation:int=0, stacked:bool=False):
+    '''
+    Returns the interior voxels of the mask, optionally after dilating the mask by a chessboard radius so
+    that voxels just outside it are evaluated too.
+
+    Args:
+      mask: 2D or 3D boolean array with the same shape as the Hessian volume
+      dilation:int - dilation radius in voxels (0 for none)
+      stacked:bool - the last axis indexes independent 2D images, which are dilated separately
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    if dilation > 0 and stacked:
+        # a chessboard ball is a square, so the in-plane dilation is a separable maximum filter
+        mask = ndimage.maximum_filter(mask, size=(2*dilation + 1,)*(mask.ndim - 1) + (1,))
+    elif dilation > 0:
+        mask = morphology.binary_dilation(mask, morphology.ball(dilation, 'chessboard'))
+    else:
+        mask = mask.copy()
+    for axis in range(mask.ndim - 1 if stacked else mask.ndim):
+        mask[(slice(None),)*axis + (-1,)] = False
+    return mask
+
+
+def candidate_coordinates(candidates, start:int=0, stop=None) -> tuple:
+    '''
+    Returns the coordinates (as returned by np.nonzero) of the candidate voxels, optionally limited to the
+    planes [start, stop) of the last axis.
+    '''
+    coordinates = list(np.nonzero(candidates[..., start:stop]))
+    coordinates[-1] += start
+    return tuple(coordinates)
+
+
+def shifted(hessian_volume, coordinates, offsets):
+    '''
+    Returns the Hessian values at coordinates + offsets and a mask of which of those are in bounds.
+
+    Args:
+      hessian_volume: 2D or 3D array
+      coordinates: tuple of integer index arrays (one per axis) that broadcast together
+      offsets: tuple of integer offsets (one per axis)
+    '''
+    indices = []
+    valid = True
+    for axis, (coords, offset) in enumerate(zip(coordinates, offsets)):
+        size = hessian_volume.shape[axis]
+        index = coords + offset
+        valid = np.logical_and(valid, index < size)
+        # negative indices wrap around, exactly as they do when indexing with a negative int
+        indices.append(index % size)
+    return hessian_volume[tuple(indices)], valid
+
+
+def evaluate(hessian_volume, coordinates, radii, stacked:bool=False):
+    '''
+    Returns the CEF response at the given coordinates.
+
+    For each direction d the response is the maximum over (r_1, r_2) of L - P, where
+    L = I(x - d*r_1) - 2*I(x) + I(x + d*r_2) and P = |I(x - d*r_1) - I(x + d*r_2)|, counting only pairs with
+    both ends in bounds and L > sys.float_info.min. The responses of all directions are summed.
+
+    Args:
+      hessian_volume: 2D or 3D array
+      coordinates: tuple of integer index arrays (one per axis) that broadcast together
+      radii: iterable of int radii
+      stacked:bool - the last axis indexes independent 2D images
+    '''
+    centre = hessian_volume[coordinates]
+    total = np.zeros(centre.shape, dtype=np.result_type(hessian_volume.dtype, np.float32))
+    for direction in directions(hessian_volume.ndim, stacked):
+        max_difference = np.full(centre.shape, FLOAT_MIN, dtype=total.dtype)
+        # the far-side terms do not depend on r_1, so gather them once per direction
+        thirds = [shifted(hessian_volume, coordinates, tuple(d*r_2 for d in direction)) for r_2 in radii]
+        for r_1 in radii:
+            first, first_valid = shifted(hessian_volume, coordinates, tuple(-d*r_1 for d in direction))
+            l_partial = first - 2*centre
+            for third, third_valid in thirds:
+                l_term = l_partial + third
+                p_term = np.abs(first - third)
+                difference = l_term - p_term
+                use = first_valid & third_valid & (l_term > FLOAT_MIN) & (difference > max_difference)
+                np.copyto(max_difference, difference, where=use)
+        total += max_difference
+    return total
+
+
+def evaluate_slab(hessian_spec, output_spec, candidates_spec, radii, start:int, stop:int, stacked:bool=False):
+    '''
+    Worker: evaluates the planes [start, stop) of the last axis, reading the Hessian volume and the candidate
+    mask from shared memory and writing into the shared output. Each slab only reads its own planes plus a
+    halo of max(radii) planes on either side (and the wrapped-around planes at the low edge that the
+    reference loop reads), and since the whole input is shared no halo has to be copied.
+    '''
+    hessian = shared_arrays.SharedArray.attach(hessian_spec)
+    output = shared_arrays.SharedArray.attach(output_spec)
+    candidates = None
+    try:
+        if candidates_spec is None:
+            coordinates = interior_coordinates(hessian.shape, start, stop, stacked)
+        else:
+            candidates = shared_arrays.SharedArray.attach(candidates_spec)
+            coordinates = candidate_coordinates(candidates.array, start, stop)
+        output.array[coordinates] = evaluate(hessian.array, coordinates, radii, stacked)
+    finally:
+        hessian.close()
+        output.close()
+        if candidates is not None:
+            candidates.close()
+    return stop - start
+
+
+def evaluate_parallel(hessian_volume, out, candidates, radii, workers:int, slabs_per_worker:int=4, stacked:bool=False):
+    '''
+    Evaluates the filter on a process pool, splitting the volume into z-slabs (slabs along the last axis).
+    The input, candidate mask and output live in shared memory, so no volume is pickled. Every voxel is
+    computed exactly as in a single-process run, so the results are identical.
+    '''
+    with shared_arrays.SharedArray.copy_of(hessian_volume) as hessian, \
+            shared_arrays.SharedArray.copy_of(out) as output:
+        shared_candidates = None if candidates is None else shared_arrays.SharedArray.copy_of(candidates)
+        try:
+            candidates_spec = None if shared_candidates is None else shared_candidates.spec
+            jobs = [(hessian.spec, output.spec, candidates_spec, radii, start, stop, stacked)
+                    for start, stop in shared_arrays.slabs(hessian_volume.shape[-1], workers * slabs_per_worker)]
+            with multiprocessing.Pool(processes=workers) as pool:
+                pool.starmap(evaluate_slab, jobs, chunksize=1)
+        finally:
+            if shared_candidates is not None:
+                shared_candidates.close()
+        out[...] = output.array
+    return out
+
+
+def cavity_enhancement_filter(hessian_volume, radii, mask=None, dilate_mask=False, out=None, workers:int=1, stacked:bool=False):
+    '''
+    Returns the CEF response of the Hessian volume.
+
+    Without a mask every interior voxel is filtered and the last index of each axis keeps its Hessian value,
+    as in the reference loop. With a mask the filter is only evaluated at the interior voxels of the mask and
+    every other voxel is 0.
+
+    Args:
+      hessian_volume: 2D or 3D array (output of the Hessian analysis)
+      radii: iterable of int radii (average radius per airway generation, in voxels)
+      mask: optional boolean array, same shape as hessian_volume, of the voxels to evaluate (e.g. the lung)
+      dilate_mask: if True, the mask is first dilated by the largest radius
+      out: optional preallocated output array, same shape as hessian_volume
+      workers:int - number of worker processes (1 runs in this process)
+      stacked:bool - hessian_volume is a stack of independent 2D images along its last axis, each filtered
+                     (and its mask dilated) on its own
+    '''
+    hessian_volume = np.asarray(hessian_volume)
+    radii = list(radii)
+    dtype = np.result_type(hessian_volume.dtype, np.float32)
+    if mask is None:
+        candidates = None
+        if out is None:
+            out = np.empty(hessian_volume.shape, dtype=dtype)
+        out[...] = hessian_volume
+    else:
+        if mask.shape != hessian_volume.shape:
+            raise ValueError('Mask shape {} does not match Hessian volume shape {}.'.format(mask.shape, hessian_volume.shape))
+        candidates = candidate_mask(mask, max(radii) if dilate_mask else 0, stacked)
+        if out is None:
+            out = np.zeros(hessian_volume.shape, dtype=dtype)
+        else:
+            out[...] = 0
+
+    if workers > 1:
+        return evaluate_parallel(hessian_volume, out, candidates, radii, workers, stacked=stacked)
+    # the same z-slabs as the parallel path, so only one slab's working memory is held at a time
+    for start, stop in shared_arrays.slabs(hessian_volume.shape[-1], -(-hessian_volume.size // SLAB_VOXELS)):
+        if candidates is None:
+            coordinates = interior_coordinates(hessian_volume.shape, start, stop, stacked)
+        else:
+            coordinates = candidate_coordinates(candidates, start, stop)
+        out[coordinates] = evaluate(hessian_volume, coordinates, radii, stacked)
+    return out
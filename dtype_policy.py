@@ -0,0 +1,60 @@
+'''
+Pipeline-wide policy for the dtypes that volumes are stored and computed in.
+
+The 'compact' policy (the default) keeps Hounsfield Units as int16 (or whatever integer type the scan was
+stored in), computes filter responses (unsharp mask, sato, CEF, frangi) in float32 and keeps masks as bool.
+The 'legacy' policy reproduces the original behaviour, where everything apart from the masks is float64.
+
+The policy is process-wide: set it once with set_policy before the pipeline runs. Worker processes that are
+forked afterwards inherit it.
+'''
+
+import numpy as np
+
+
+class DtypePolicy:
+    def __init__(self, name:str, filter_dtype, hu_dtype) -> None:
+        self.name = name
+        self.filter_dtype = np.dtype(filter_dtype)
+        self.hu_dtype = np.dtype(hu_dtype)
+
+    def voxels(self, array):
+        '''
+        Returns voxel data (HU or ground-truth labels) in the policy's dtypes. Integer data that fits in
+        hu_dtype stays integer; anything else is converted to filter_dtype. No copy is made if the data
+        already has the right dtype.
+        '''
+        array = np.asanyarray(array)
+        if np.issubdtype(self.hu_dtype, np.integer) and np.issubdtype(array.dtype, np.integer):
+            if np.can_cast(array.dtype, self.hu_dtype):
+                return array
+            info = np.iinfo(self.hu_dtype)
+            if array.size == 0 or (array.min() >= info.min and array.max() <= info.max):
+                return array.astype(self.hu_dtype)
+        if np.issubdtype(self.hu_dtype, np.integer):
+            return array.astype(self.filter_dtype, copy=False)
+        return array.astype(self.hu_dtype, copy=False)
+
+    def filter_input(self, array):
+        '''
+        Returns the array in filter_dtype, without a copy if it already is.
+        '''
+        return np.asarray(array).astype(self.filter_dtype, copy=False)
+
+
+COMPACT = DtypePolicy('compact', np.float32, np.int16)
+LEGACY = DtypePolicy('legacy', np.float64, np.float64)
+POLICIES = {policy.name: policy for policy in (COMPACT, LEGACY)}
+
+POLICY = COMPACT
+
+
+def set_policy(name:str):
+    '''
+    Sets the process-wide dtype policy ('compact' or 'legacy').
+    '''
+    global POLICY
+    if name not in POLICIES:
+        raise ValueError('Unknown dtype policy {}, expected one of {}.'.format(name, sorted(POLICIES)))
+    POLICY = POLICIES[name]
+    return POLICY
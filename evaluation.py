@@ -0,0 +1,192 @@
+'''
+Evaluation of binary segmentations against ground truth.
+
+The confusion counts come from three counts only: of the prediction, of the truth and of their
+intersection. The false positives, false negatives and true negatives follow from those and the number of
+voxels, and every metric (Dice, IoU, sensitivity, precision, volume error) is derived from the counts. Over a
+whole array the masks are packed into bits (8 voxels per byte) and the counts are population counts of the
+packed bytes; per slice, each count is one reduction of the boolean mask over the other axes.
+
+Counts can be kept per slice (and summed into the case), summed over the cases of a dataset (micro average)
+or turned into metrics per case and averaged (macro average). candidate_counts scores many candidate masks
+against one truth at once, e.g. the same segmentation at several thresholds.
+'''
+
+import numpy as np
+from skimage.filters import threshold_otsu
+
+METRICS = ('dice', 'iou', 'sensitivity', 'precision', 'volume_error')
+
+# number of set bits of every byte, for numpy versions without np.bitwise_count
+POPCOUNT_TABLE = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(packed, axis=None):
+    '''
+    Returns the number of set bits in an array of packed bytes, summed along axis (all axes if None).
+    '''
+    if hasattr(np, 'bitwise_count'):
+        bits = np.bitwise_count(packed)
+    else:
+        bits = POPCOUNT_TABLE[packed]
+    return bits.sum(axis=axis, dtype=np.int64)
+
+
+def as_binary(mask):
+    '''
+    Returns the mask as booleans. Boolean masks are used as they are; anything else is binarized with an
+    Otsu threshold, as the pipeline's masks always were.
+    '''
+    mask = np.asarray(mask)
+    if mask.dtype == bool:
+        return mask
+    return mask > threshold_otsu(mask)
+
+
+def pack(mask, axis=None):
+    '''
+    Returns the mask packed into bits, either as one row (axis=None) or one row per index of axis.
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    if axis is None:
+        return np.packbits(mask.ravel())
+    rows = np.moveaxis(mask, axis, 0).reshape(mask.shape[axis], -1)
+    return np.packbits(rows, axis=1)
+
+
+def count_per_index(mask, axis:int):
+    '''
+    Returns the number of foreground voxels for every index of axis. The axis is moved last, which for the
+    slice axis of a volume needs no copy, and the mask is reduced over its rows.
+    '''
+    columns = np.moveaxis(mask, axis, -1)
+    return columns.reshape(-1, columns.shape[-1]).sum(axis=0, dtype=np.int64)
+
+
+class ConfusionCounts:
+    def __init__(self, tp, fp, fn, tn) -> None:
+        '''
+        True positive, false positive, false negative and true negative voxel counts. Each is an int or an
+        array (one count per slice, case or candidate).
+        '''
+        self.tp = np.asarray(tp, dtype=np.int64)
+        self.fp = np.asarray(fp, dtype=np.int64)
+        self.fn = np.asarray(fn, dtype=np.int64)
+        self.tn = np.asarray(tn, dtype=np.int64)
+
+    def __add__(self, other):
+        return ConfusionCounts(self.tp + other.tp, self.fp + other.fp, self.fn + other.fn, self.tn + other.tn)
+
+    def __len__(self) -> int:
+        return self.tp.size
+
+    def __getitem__(self, index):
+        return ConfusionCounts(self.tp[index], self.fp[index], self.fn[index], self.tn[index])
+
+    def total(self):
+        '''
+        Returns the counts summed over every slice, case or candidate.
+        '''
+        return ConfusionCounts(self.tp.sum(), self.fp.sum(), self.fn.sum(), self.tn.sum())
+
+    def metrics(self, voxel_volume:float=None) -> dict:
+        '''
+        Returns Dice, IoU, sensitivity, precision and the relative volume error ((predicted - true) / true)
+        computed from the counts, as floats or arrays. A metric whose denominator is 0 (e.g. the sensitivity
+        of an empty truth) is nan. With a voxel_volume (in mm^3) the predicted and true volumes in mL and the
+        absolute volume error are added too.
+        '''
+        tp, fp, fn = self.tp.astype(float), self.fp.astype(float), self.fn.astype(float)
+        predicted = tp + fp
+        true = tp + fn
+        with np.errstate(divide='ignore', invalid='ignore'):
+            metrics = {'dice': 2*tp / (2*tp + fp + fn),
+                       'iou': tp / (tp + fp + fn),
+                       'sensitivity': tp / true,
+                       'precision': tp / predicted,
+                       'volume_error': (predicted - true) / true}
+        if voxel_volume is not None:
+            metrics['predicted_volume'] = predicted * voxel_volume / 1000
+            metrics['true_volume'] = true * voxel_volume / 1000
+            metrics['volume_error_ml'] = (predicted - true) * voxel_volume / 1000
+        return {name: value[()] if np.ndim(value) == 0 else value for name, value in metrics.items()}
+
+    def as_dict(self) -> dict:
+        '''
+        Returns the counts as plain ints (or lists), e.g. for a JSON manifest.
+        '''
+        return {name: getattr(self, name).tolist() for name in ('tp', 'fp', 'fn', 'tn')}
+
+    @classmethod
+    def from_dict(cls, counts:dict):
+        return cls(counts['tp'], counts['fp'], counts['fn'], counts['tn'])
+
+
+def confusion_counts(prediction, truth, axis=None) -> ConfusionCounts:
+    '''
+    Returns the confusion counts of a binary prediction against a binary truth of the same shape.
+
+    Args:
+      prediction, truth: boolean arrays (see as_binary for other masks)
+      axis: None for counts over the whole array, or the axis to count per index of (e.g. -1 for one count
+            per slice of a volume)
+    '''
+    prediction = np.asarray(prediction, dtype=bool)
+    truth = np.asarray(truth, dtype=bool)
+    if prediction.shape != truth.shape:
+        raise ValueError('Prediction shape {} does not match truth shape {}.'.format(prediction.shape, truth.shape))
+    if axis is None:
+        size = prediction.size
+        packed_prediction = pack(prediction)
+        packed_truth = pack(truth)
+        tp = popcount(packed_prediction & packed_truth)
+        predicted = popcount(packed_prediction)
+        true = popcount(packed_truth)
+    else:
+        size = prediction.size // prediction.shape[axis]
+        tp = count_per_index(prediction & truth, axis)
+        predicted = count_per_index(prediction, axis)
+        true = count_per_index(truth, axis)
+    return ConfusionCounts(tp, predicted - tp, true - tp, size - predicted - true + tp)
+
+
+def candidate_counts(candidates, truth) -> ConfusionCounts:
+    '''
+    Returns the confusion counts of every candidate mask against one truth. The truth is packed once and
+    every candidate is scored in the same vectorized pass.
+
+    Args:
+      candidates: boolean array of shape (n,) + truth.shape
+      truth: boolean array
+    '''
+    candidates = np.asarray(candidates, dtype=bool)
+    truth = np.asarray(truth, dtype=bool)
+    if candidates.shape[1:] != truth.shape:
+        raise ValueError('Candidate shape {} does not match truth shape {}.'.format(candidates.shape[1:], truth.shape))
+    packed_candidates = pack(candidates, 0)
+    packed_truth = pack(truth)
+    tp = popcount(packed_candidates & packed_truth, 1)
+    predicted = popcount(packed_candidates, 1)
+    true = popcount(packed_truth)
+    return ConfusionCounts(tp, predicted - tp, true - tp, truth.size - predicted - true + tp)
+
+
+def dataset_summary(case_counts:list, voxel_volume:float=None) -> dict:
+    '''
+    Returns dataset-level metrics for a list of per-case ConfusionCounts: 'micro' metrics of the summed
+    counts, and 'macro' means (ignoring nan) and standard deviations of the per-case metrics.
+    '''
+    if not case_counts:
+        return {'cases': 0}
+    totals = [counts.total() for counts in case_counts]
+    stacked = ConfusionCounts([c.tp for c in totals], [c.fp for c in totals], [c.fn for c in totals], [c.tn for c in totals])
+    per_case = stacked.metrics()
+    summed = stacked.total().metrics(voxel_volume)
+    summary = {'cases': len(totals), 'micro': {name: float(value) for name, value in summed.items()}, 'macro': {}}
+    for name in METRICS:
+        values = per_case[name]
+        if np.all(np.isnan(values)):
+            summary['macro'][name] = {'mean': float('nan'), 'std': float('nan')}
+        else:
+            summary['macro'][name] = {'mean': float(np.nanmean(values)), 'std': float(np.nanstd(values))}
+    return summary
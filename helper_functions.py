@@ -9,29 +9,32 @@ import plotly.graph_objects as go
 
 import numpy as np
 
+import dtype_policy, evaluation, mesh_export, instrumentation
+
 
 def calculate_dice_similarity_coefficient(my_segmentation, truth):
     '''
     Dice Similarity Coefficient = \frac{2 * cardinality(A intersection B)}{cardinality(A) + cardinality(B)}
+    Kept for existing callers; see evaluation.py for the other metrics and for per-slice and dataset counts.
 
     Args:
       my_segmentation: numpy array of booleans
       truth: numpy array of booleans
     '''
-    intersection = np.logical_and(my_segmentation, truth)
-    union = np.logical_or(my_segmentation, truth)
-    numerator = 2 * np.sum(intersection)
-    denominator = np.sum(union) + np.sum(intersection)
-    print(np.sum(union))
-    print(np.sum(intersection))
-    dsc = (2 * np.sum(intersection))/(np.sum(union) + np.sum(intersection))
-    return dsc, numerator, denominator
-
-
-def view_3D(volume):
-    # NOTE: This is VERY resource-intensive! Use with caution.
-    # If you want a responsive plot, be sure to resample the volume first!
-    verts, faces = make_mesh(volume)
+    counts = evaluation.confusion_counts(my_segmentation, truth)
+    numerator = 2 * int(counts.tp)
+    denominator = numerator + int(counts.fp) + int(counts.fn)
+    return counts.metrics()['dice'], numerator, denominator
+
+
+def view_3D(volume, triangle_budget=None):
+    # Opens an interactive plot in a browser. The mesh is reduced to a triangle budget (see mesh_export.py);
+    # to save a mesh without a browser, use mesh_export.export instead.
+    mesh = mesh_export.lod_mesh(volume, triangle_budget=triangle_budget)
+    if mesh is None:
+        print('Nothing to view: the volume is empty.')
+        return
+    verts, faces = mesh
     plotly_3d(verts, faces, volume)
 
 
@@ -48,7 +51,7 @@ def make_mesh(image, threshold=0, step_size=1):
 
 
 def plotly_3d(verts, faces, volume):
-    x, y, z = zip(*verts)
+    x, y, z = verts[:, 0], verts[:, 1], verts[:, 2]
 
     # Make the colormap single color since the axes are positional not intensity.
     colormap = ['rgb(236, 236, 212)', 'rgb(236, 236, 212)']
@@ -64,22 +67,28 @@ def plotly_3d(verts, faces, volume):
     plot(fig)
 
 
-def create_slices(volume):
-    slices = []
-    for i in range(volume.shape[2]):
-        # separate slices
-        slice = volume[:, :, i]
-        slices.append(slice)
-    return slices
+def bounding_box(mask, padding) -> tuple:
+    '''
+    Returns the slices of the smallest box that holds every non-zero voxel of the mask, widened by padding
+    voxels (one number per axis) on either side and clipped to the mask. An empty mask gives the whole mask.
+    '''
+    box = []
+    for axis in range(mask.ndim):
+        others = tuple(other for other in range(mask.ndim) if other != axis)
+        nonzero = np.flatnonzero(np.any(mask, axis=others))
+        if len(nonzero) == 0:
+            return tuple(slice(0, size) for size in mask.shape)
+        box.append(slice(max(int(nonzero[0]) - padding[axis], 0), min(int(nonzero[-1]) + 1 + padding[axis], mask.shape[axis])))
+    return tuple(box)
 
 
-def create_bronchial_slices(volume):
-    slices = []
-    for i in range(volume.shape[0]):
-        # separate slices
-        slice = volume[i, :, :]
-        slices.append(slice)
-    return slices
+def paste(array, shape, box, fill=0):
+    '''
+    Returns a new array of shape, filled with fill, with array written into its box (see bounding_box).
+    '''
+    full = np.full(shape, fill, dtype=array.dtype)
+    full[box] = array
+    return full
 
 
 def separate_hounsfield_range(slice, thresh_min, thresh_max):
@@ -89,14 +98,17 @@ def separate_hounsfield_range(slice, thresh_min, thresh_max):
     return slc
 
 
+@instrumentation.timed('otsu')
 def create_binary_mask(volume):
     thresh = threshold_otsu(volume)
     binary = volume > thresh
     return binary
 
+@instrumentation.timed('otsu')
 def create_grayscale_mask(volume):
+    # 0/255 values in the policy's float dtype (Lesion inverts this as a float mask)
     thresh = threshold_otsu(volume)
-    slc = volume.copy()
+    slc = np.array(volume, dtype=dtype_policy.POLICY.filter_dtype)
     slc[slc >= thresh] = 0
     slc[slc <= thresh] = 255
     return slc
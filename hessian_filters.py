@@ -0,0 +1,232 @@
+'''
+Blockwise, memory-bounded Hessian filters (Sato and Frangi).
+
+skimage's sato and frangi compute, for every sigma, the Hessian components and their eigenvalues as whole
+volumes, so their working memory is about 200 bytes per voxel: many times the volume itself. Here the volume
+is split into blocks that are filtered one at a time (or a few at a time on a thread pool), each with a halo
+of neighbouring voxels, and only the core of every block is written to the output. The blocks are as large as
+the memory limit allows, so that as few halo voxels as possible are filtered twice.
+
+The output is identical to the monolithic call. The Hessian is computed by two successive Gaussian derivative
+filters, and the halo along every axis is the sum of their radii. Only kernel weights that are not zero in
+float64 count, since a zero weight adds nothing: for sigma 1 skimage truncates the kernel at 100 standard
+deviations, but only 27 voxels of it are non-zero. frangi normalises every sigma by a gamma computed from the
+whole volume (half the largest Hessian norm at the first sigma), so it makes a first pass over the blocks to
+find that maximum.
+
+The halo arithmetic and the gamma computation above follow scikit-image 0.26, the version pinned in
+requirements.txt; the Gaussian derivative Hessian they rely on needs scikit-image 0.20 or later.
+
+Like the dtype policy, the settings are process-wide: set them once with configure before the pipeline runs.
+Without a memory limit the filters run on the whole volume as before.
+'''
+
+import itertools, math, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import skimage
+from skimage import filters
+from skimage.feature import hessian_matrix, hessian_matrix_eigvals
+
+if tuple(int(part) for part in skimage.__version__.split('.')[:2]) < (0, 20):
+    raise ImportError('hessian_filters needs scikit-image 0.20 or later (see requirements.txt), found {}.'.format(skimage.__version__))
+
+# peak working memory of skimage's frangi on float64 input (sato and float32 need a little less)
+WORKING_BYTES_PER_VOXEL = 240
+# most blocks considered along one axis when planning
+MAX_BLOCKS_PER_AXIS = 64
+
+MEMORY_LIMIT = None
+THREADS = 1
+SCRATCH_DIRECTORY = None
+
+
+def configure(memory_limit:int=None, threads:int=1, scratch_directory:str=None):
+    '''
+    Sets the process-wide working memory limit of the filters in bytes (None filters whole volumes), the
+    number of threads that filter blocks at once (the limit is shared between them) and an optional directory
+    in which the outputs are memory-mapped instead of held in memory.
+    '''
+    global MEMORY_LIMIT, THREADS, SCRATCH_DIRECTORY
+    MEMORY_LIMIT = memory_limit
+    THREADS = max(threads, 1)
+    SCRATCH_DIRECTORY = scratch_directory
+
+
+def settings() -> dict:
+    return {'memory_limit': MEMORY_LIMIT, 'threads': THREADS, 'scratch_directory': SCRATCH_DIRECTORY}
+
+
+def float_dtype(dtype):
+    '''
+    Returns the float dtype skimage computes in for input of dtype (float32 stays float32).
+    '''
+    dtype = np.dtype(dtype)
+    if dtype in (np.float16, np.float32):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+
+def allocate(shape, dtype):
+    '''
+    Returns an uninitialised output array, memory-mapped to an anonymous file in SCRATCH_DIRECTORY if set.
+    '''
+    if SCRATCH_DIRECTORY is None:
+        return np.empty(shape, dtype=dtype)
+    # the file is deleted once closed, but stays mapped for as long as the array lives
+    with tempfile.TemporaryFile(dir=SCRATCH_DIRECTORY) as file:
+        return np.memmap(file, dtype=dtype, mode='w+', shape=tuple(shape))
+
+
+def kernel_radius(sigma:float, truncate:float) -> int:
+    '''
+    Returns the radius of the non-zero weights of scipy's Gaussian (derivative) kernel.
+    '''
+    radius = int(truncate * sigma + 0.5)
+    x = np.arange(-radius, radius + 1)
+    weights = np.exp(-0.5 / (sigma * sigma) * x.astype(np.float64)**2)
+    weights /= weights.sum()
+    return int(np.abs(x[weights != 0]).max())
+
+
+def halo(sigmas) -> int:
+    '''
+    Returns the number of neighbouring voxels along each axis that the Hessian at a voxel depends on, for
+    the largest of sigmas (see skimage.feature.corner._hessian_matrix_with_gaussian).
+    '''
+    widths = [0]
+    for sigma in sigmas:
+        # skimage filters twice with sigma / sqrt(2), truncated at 8 standard deviations (100 for sigma <= 1)
+        truncate = 8 if sigma > 1 else 100
+        widths.append(2 * kernel_radius(sigma / math.sqrt(2), truncate))
+    return max(widths)
+
+
+def extended_lengths(size:int, count:int, width:int) -> list:
+    '''
+    Returns the lengths of the blocks of an axis split into count blocks, with a halo of width on either side
+    (clipped to the axis).
+    '''
+    step = math.ceil(size / count)
+    return [min(start + step + width, size) - max(start - width, 0) for start in range(0, size, step)]
+
+
+def plan(shape, width:int, memory_limit, threads:int=1, bytes_per_voxel:int=WORKING_BYTES_PER_VOXEL) -> tuple:
+    '''
+    Returns the number of blocks along each axis such that threads blocks (with their halos) fit in
+    memory_limit bytes of working memory, filtering as few voxels in total as possible. Blocks are never
+    shorter than the halo, and if not even the smallest such blocks fit, those are used.
+    '''
+    if memory_limit is None:
+        return (1,) * len(shape)
+    budget = memory_limit / (max(threads, 1) * bytes_per_voxel)
+    # the distinct block counts of each axis (more blocks than that only repeat the same block length), with
+    # blocks at least as long as their halo: shorter blocks would filter mostly halo
+    options = []
+    for size in shape:
+        counts = sorted({math.ceil(size / math.ceil(size / count)) for count in range(1, min(size, MAX_BLOCKS_PER_AXIS) + 1)
+                         if count == 1 or math.ceil(size / count) >= width})
+        options.append([(count, max(extended_lengths(size, count, width)), sum(extended_lengths(size, count, width))) for count in counts])
+    best, best_cost = None, None
+    smallest, smallest_choice = None, None
+    for choice in itertools.product(*options):
+        voxels = math.prod(longest for _, longest, _ in choice)
+        cost = math.prod(total for _, _, total in choice)
+        if smallest is None or (voxels, cost) < smallest:
+            smallest = (voxels, cost)
+            smallest_choice = choice
+        if voxels <= budget and (best is None or cost < best_cost):
+            best, best_cost = choice, cost
+    if best is None:
+        print('Hessian filter: blocks of {} voxels exceed the memory limit, using the smallest blocks.'.format(smallest[0]))
+        best = smallest_choice
+    return tuple(count for count, _, _ in best)
+
+
+def blocks(shape, counts, width:int):
+    '''
+    Yields (core, extended, inner) slices of every block: core indexes the block in the volume, extended the
+    block with its halo, and inner the core within the extended block.
+    '''
+    axes = []
+    for size, count in zip(shape, counts):
+        step = math.ceil(size / count)
+        axes.append([(start, min(start + step, size)) for start in range(0, size, step)])
+    for block in itertools.product(*axes):
+        core, extended, inner = [], [], []
+        for (start, stop), size in zip(block, shape):
+            low, high = max(start - width, 0), min(stop + width, size)
+            core.append(slice(start, stop))
+            extended.append(slice(low, high))
+            inner.append(slice(start - low, stop - low))
+        yield tuple(core), tuple(extended), tuple(inner)
+
+
+def run_blocks(function, image, sigmas, out=None):
+    '''
+    Returns function(block) evaluated over the image block by block, within the configured memory limit
+    and on the configured number of threads, writing the core of every block into out (allocated if None).
+    function must compute every voxel from the voxels within halo(sigmas) of it.
+    '''
+    width = halo(sigmas)
+    counts = plan(image.shape, width, MEMORY_LIMIT, THREADS)
+    if out is None:
+        out = allocate(image.shape, float_dtype(image.dtype))
+
+    def filter_block(block):
+        core, extended, inner = block
+        out[core] = function(image[extended])[inner]
+
+    if THREADS > 1:
+        with ThreadPoolExecutor(max_workers=THREADS) as pool:
+            for _ in pool.map(filter_block, blocks(image.shape, counts, width)):
+                pass
+    else:
+        for block in blocks(image.shape, counts, width):
+            filter_block(block)
+    return out
+
+
+def sato(image, sigmas=range(1, 10, 2), black_ridges:bool=True, out=None):
+    '''
+    skimage.filters.sato, computed block by block within the memory limit (see configure). The result is
+    identical to skimage's.
+    '''
+    sigmas = list(sigmas)
+    if MEMORY_LIMIT is None and out is None:
+        return filters.sato(image, sigmas=sigmas, black_ridges=black_ridges)
+    return run_blocks(lambda block: filters.sato(block, sigmas=sigmas, black_ridges=black_ridges), image, sigmas, out)
+
+
+def largest_hessian_norm(image, sigma:float, black_ridges:bool=True):
+    '''
+    Returns the largest Hessian norm of the image at sigma, as frangi computes it, block by block.
+    '''
+    width = halo([sigma])
+    counts = plan(image.shape, width, MEMORY_LIMIT, 1)
+    largest = None
+    for core, extended, inner in blocks(image.shape, counts, width):
+        block = image[extended].astype(float_dtype(image.dtype), copy=False)
+        if not black_ridges:
+            block = -block
+        eigvals = hessian_matrix_eigvals(hessian_matrix(block, sigma, mode='reflect', cval=0, use_gaussian_derivatives=True))
+        eigvals = np.take_along_axis(eigvals, abs(eigvals).argsort(0), 0)
+        block_largest = np.sqrt((eigvals**2).sum(0))[inner].max()
+        largest = block_largest if largest is None else max(largest, block_largest)
+    return largest
+
+
+def frangi(image, sigmas=range(1, 10, 2), alpha:float=0.5, beta:float=0.5, gamma=None, black_ridges:bool=True, out=None):
+    '''
+    skimage.filters.frangi, computed block by block within the memory limit (see configure). The gamma that
+    frangi derives from the whole image is found in a first pass, so the result is identical to skimage's.
+    '''
+    sigmas = list(sigmas)
+    if MEMORY_LIMIT is None and out is None:
+        return filters.frangi(image, sigmas=sigmas, alpha=alpha, beta=beta, gamma=gamma, black_ridges=black_ridges)
+    if gamma is None:
+        gamma = largest_hessian_norm(image, sigmas[0], black_ridges) / 2
+        if gamma == 0:
+            gamma = 1
+    return run_blocks(lambda block: filters.frangi(block, sigmas=sigmas, alpha=alpha, beta=beta, gamma=gamma, black_ridges=black_ridges), image, sigmas, out)
@@ -0,0 +1,212 @@
+'''
+Per-stage instrumentation of the pipeline.
+
+Stages are marked with the stage() context manager or the timed() decorator. Outside of a case they cost
+next to nothing; inside instrumentation.case(...) every stage records its wall time, CPU time (of this process
+and of the worker processes it waited for), the growth of the peak resident set size, the peak of traced
+Python/numpy allocations (when tracemalloc is on) and the shapes and dtypes of its arrays. Stages nest, and a
+record is named by its path, e.g. 'lesion/frangi'. When the case ends, its records are written as JSON lines
+to <directory>/<case>.jsonl: a line for the whole case, then one line per stage in the order they started.
+Only the thread that started the case is instrumented (the threads prefetching scans or writing meshes are not).
+
+Like the dtype policy, the settings are process-wide: set them once with configure before the pipeline runs.
+'''
+
+import functools, json, os, resource, sys, tempfile, threading, time, tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+
+DIRECTORY = None
+TRACEMALLOC = False
+
+# the case being instrumented by this thread
+current = threading.local()
+
+
+def current_case():
+    return getattr(current, 'case', None)
+
+
+def configure(directory:str=None, trace_allocations:bool=False):
+    '''
+    Enables instrumentation, writing to directory (None disables it). trace_allocations turns on tracemalloc,
+    which measures the peak allocations of every stage exactly but slows numpy-heavy code down.
+    '''
+    global DIRECTORY, TRACEMALLOC
+    DIRECTORY = directory
+    TRACEMALLOC = trace_allocations
+
+
+def settings() -> dict:
+    return {'directory': DIRECTORY, 'trace_allocations': TRACEMALLOC}
+
+
+def max_rss_mb() -> float:
+    '''
+    Returns the peak resident set size of this process so far in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 1024**2 if sys.platform == 'darwin' else peak / 1024
+
+
+# lists longer than this (e.g. lists of slices) are described by their length and first item
+MAX_DESCRIBED_ITEMS = 8
+
+
+def describe(value):
+    '''
+    Returns the shape and dtype of an array (or of the arrays in a list or tuple), or None for anything else.
+    '''
+    if isinstance(value, np.ndarray):
+        return {'shape': list(value.shape), 'dtype': value.dtype.str}
+    if isinstance(value, (list, tuple)) and value:
+        if len(value) > MAX_DESCRIBED_ITEMS:
+            first = describe(value[0])
+            return None if first is None else {'count': len(value), 'first': first}
+        items = [describe(item) for item in value]
+        if any(item is not None for item in items):
+            return items
+    return None
+
+
+class Case:
+    def __init__(self, name:str) -> None:
+        '''
+        Records of the stages of one case.
+        '''
+        self.name = name
+        self.records = []
+        self.path = []
+        # highest traced allocation of every open stage so far (reset_peak is shared by nested stages)
+        self.peaks = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name:str, arrays:dict):
+        record = {'case': self.name, 'stage': '/'.join(self.path + [name]), 'depth': len(self.path)}
+        record['inputs'] = {key: described for key, described in ((key, describe(value)) for key, value in arrays.items()) if described is not None}
+        self.path.append(name)
+        tracing = TRACEMALLOC and tracemalloc.is_tracing()
+        if tracing:
+            traced_before, peak = tracemalloc.get_traced_memory()
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            self.peaks.append(traced_before)
+            tracemalloc.reset_peak()
+        rss_before = max_rss_mb()
+        times_before = os.times()
+        wall_before = time.perf_counter()
+        try:
+            yield record
+        finally:
+            wall = time.perf_counter() - wall_before
+            times_after = os.times()
+            self.path.pop()
+            record['offset_s'] = wall_before - self.start
+            record['wall_s'] = wall
+            record['cpu_s'] = (times_after.user - times_before.user) + (times_after.system - times_before.system)
+            record['children_cpu_s'] = ((times_after.children_user - times_before.children_user)
+                                        + (times_after.children_system - times_before.children_system))
+            record['max_rss_mb'] = max_rss_mb()
+            record['rss_growth_mb'] = record['max_rss_mb'] - rss_before
+            if tracing:
+                peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+                if self.peaks:
+                    self.peaks[-1] = max(self.peaks[-1], peak)
+                record['traced_peak_mb'] = (peak - traced_before) / 1024**2
+            self.records.append(record)
+
+    def write(self, path:str):
+        '''
+        Writes the records as JSON lines, in the order the stages started, to a temporary file that is then
+        renamed to path.
+        '''
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        handle, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        try:
+            with os.fdopen(handle, 'w') as file:
+                for record in sorted(self.records, key=lambda record: record['offset_s']):
+                    file.write(json.dumps(record, default=str) + '\n')
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+
+@contextmanager
+def case(name:str, records:list=None):
+    '''
+    Instruments everything that runs inside the block as one case, named after name (e.g. the image path),
+    and writes its records when the block ends. Does nothing if instrumentation is not configured, unless a
+    records list is given: the records are then also appended to it (e.g. by the benchmark).
+    '''
+    if (DIRECTORY is None and records is None) or current_case() is not None:
+        yield None
+        return
+    label = os.path.splitext(os.path.basename(name))[0]
+    current.case = Case(name)
+    started_tracing = TRACEMALLOC and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    try:
+        with current.case.stage('case', {}) as record:
+            yield record
+    finally:
+        if started_tracing:
+            tracemalloc.stop()
+        if DIRECTORY is not None:
+            current.case.write(os.path.join(DIRECTORY, label + '.jsonl'))
+        if records is not None:
+            records.extend(current.case.records)
+        current.case = None
+
+
+@contextmanager
+def stage(name:str, **arrays):
+    '''
+    Records the block as a stage of the current case. Keyword arguments that are arrays are described by
+    their shape and dtype; the yielded record (None outside of a case) can take more fields, e.g. outputs.
+    '''
+    case = current_case()
+    if case is None:
+        yield None
+        return
+    with case.stage(name, arrays) as record:
+        yield record
+
+
+def output(record, **arrays):
+    '''
+    Adds the shapes and dtypes of output arrays to a stage record (does nothing outside of a case).
+    '''
+    if record is None:
+        return
+    outputs = record.setdefault('outputs', {})
+    for key, value in arrays.items():
+        described = describe(value)
+        if described is not None:
+            outputs[key] = described
+
+
+def timed(name:str):
+    '''
+    Decorator that records every call of a function as a stage, with the shapes and dtypes of its array
+    arguments and of its result.
+    '''
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if current_case() is None:
+                return function(*args, **kwargs)
+            arrays = {'arg{}'.format(i): value for i, value in enumerate(args)}
+            arrays.update(kwargs)
+            with stage(name, **arrays) as record:
+                result = function(*args, **kwargs)
+                output(record, result=result)
+            return result
+        return wrapper
+    return decorator
@@ -1,77 +1,168 @@
+import os
+
 from skimage.transform import resize
-from skimage.filters import frangi
 from skimage import util, exposure
-from skimage.morphology import erosion, ball, disk, white_tophat
+from skimage.morphology import erosion, ball
 
 import matplotlib.pyplot as plt
 
 import numpy as np
 
-import helper_functions
+import helper_functions, morphology, hessian_filters, dtype_policy, evaluation, mesh_export, instrumentation
+
+FRANGI_SIGMAS = range(1, 3)
+# Hounsfield Units kept for the Frangi filter (both ends excluded)
+HOUNSFIELD_WINDOW = (-1000, -300)
+# slices dropped at the start and at the end of a 3D volume
+CROP_MARGINS = (2, 12)
+
+
+@instrumentation.timed('resize')
+def resize_volume(volume, shape):
+    '''
+    Resizes an intensity volume (with interpolation and anti-aliasing, keeping its HU range) unless it
+    already has the shape.
+    '''
+    if volume.shape == tuple(shape):
+        return volume
+    return resize(volume, shape, preserve_range=True)
+
+
+@instrumentation.timed('resize')
+def resize_mask(mask, shape):
+    '''
+    Resizes a mask with nearest-neighbour interpolation unless it already has the shape. A trailing
+    singleton axis (a 2D mask stacked as a volume) is dropped when resizing to 2D.
+    '''
+    if mask.ndim == len(shape) + 1 and mask.shape[-1] == 1:
+        mask = mask[..., 0]
+    if mask.shape == tuple(shape):
+        return mask
+    return resize(mask, shape, order=0, preserve_range=True, anti_aliasing=False).astype(mask.dtype)
+
+
+class LesionStage:
+    '''
+    Runs the lesion segmentation of one volume both with and without bronchial tree removal. The resized
+    lung mask and volume and the masked volume are computed once and shared by both segmentations, and
+    the Frangi filter of both runs goes through frangi. The tunable parameters and frame (see Lesion) apply
+    to both segmentations.
+    '''
+    def __init__(self, src_file, volume, lung_mask, bronchial_mask, mm_x, mm_y, mm_z, footprint_size, number, demo=False, two_d=False, truth=None,
+                 hounsfield_window=HOUNSFIELD_WINDOW, frangi_sigmas=FRANGI_SIGMAS, crop_margins=CROP_MARGINS, frame=None) -> None:
+        shape = bronchial_mask.shape
+        self.lung_mask = resize_mask(lung_mask, shape)
+        self.volume = resize_volume(volume, shape)
+        self.masked_volume = np.where(self.lung_mask, self.volume, 0)
+        self.frangi_sigmas = list(frangi_sigmas)
+        parameters = {'hounsfield_window': hounsfield_window, 'frangi_sigmas': frangi_sigmas, 'crop_margins': crop_margins, 'frame': frame}
+
+        with instrumentation.stage('lesion.processed'):
+            self.processed = Lesion(src_file, volume, lung_mask, bronchial_mask, mm_x, mm_y, mm_z, footprint_size, number, demo, two_d, truth, stage=self, **parameters)
+        with instrumentation.stage('lesion.unprocessed'):
+            self.unprocessed = Lesion(src_file, volume, lung_mask, bronchial_mask, mm_x, mm_y, mm_z, footprint_size, number, demo, two_d, truth, no_processing=True, stage=self, **parameters)
+
+    def frangi(self, image):
+        '''
+        Returns the Frangi response of the image. The inputs of the two segmentations always differ (one has
+        the bronchial tree removed), so responses are not kept for reuse.
+        '''
+        with instrumentation.stage('frangi', image=image):
+            return hessian_filters.frangi(image, sigmas=self.frangi_sigmas, black_ridges=False)
+
 
 class Lesion:
-    def __init__(self, src_file, volume, lung_mask, bronchial_mask, mm_x, mm_y, mm_z, footprint_size, number, demo=False, two_d=False, truth=None, no_processing=False) -> None:
+    def __init__(self, src_file, volume, lung_mask, bronchial_mask, mm_x, mm_y, mm_z, footprint_size, number, demo=False, two_d=False, truth=None, no_processing=False, stage=None,
+                 hounsfield_window=HOUNSFIELD_WINDOW, frangi_sigmas=FRANGI_SIGMAS, crop_margins=CROP_MARGINS, frame=None) -> None:
+        '''
+        The parameters tuned in this phase (see sweep.py) are footprint_size (of the lung mask erosion and the
+        white top-hat), hounsfield_window (the HU range, both ends excluded, that the Frangi filter sees),
+        frangi_sigmas and crop_margins (the slices dropped at the start and the end of a 3D volume).
+
+        frame: optional (shape, box) when the volume and masks are the box (a tuple of slices, see
+               Lung.bounding_box) of a full-size 3D volume of that shape. The lesion masks are then pasted
+               back into full size, crop_margins count from the first and last slices of the full volume,
+               and truth is full size.
+        '''
         print('Begin lesion segmentation.')
         self.src_file = src_file
         self.volume = volume
         self.lung_mask = lung_mask
         self.bronchial_mask = bronchial_mask
         self.footprint_size = footprint_size
+        self.hounsfield_window = hounsfield_window
+        self.frangi_sigmas = frangi_sigmas
+        self.crop_margins = crop_margins
+        self.frame = frame
         self.number = number
         self.two_d = two_d
         self.demo = demo
         self.mm_x = mm_x
         self.mm_y = mm_y
         self.mm_z = mm_z
+        self.stage = stage
+        self.dice_coeff = None
+        self.confusion = None
+        self.slice_confusion = None
+        self.evaluation = None
 
-        self.lung_mask = resize(self.lung_mask, self.bronchial_mask.shape)
-        self.volume = resize(self.volume, self.bronchial_mask.shape)
-
-        self.volume = self.lung_mask * self.volume
-        bronchial_slices = helper_functions.create_slices(self.volume)
+        if stage is not None:
+            self.lung_mask = stage.lung_mask
+            self.volume = stage.masked_volume
+        else:
+            self.lung_mask = resize_mask(self.lung_mask, self.bronchial_mask.shape)
+            self.volume = resize_volume(self.volume, self.bronchial_mask.shape)
+            self.volume = np.where(self.lung_mask, self.volume, 0)
 
         if no_processing:
-            self.bronchial_mask = self.volume * self.lung_mask
+            self.bronchial_mask = np.where(self.lung_mask, self.volume, 0)
             self.bronchial_mask = helper_functions.create_grayscale_mask(self.bronchial_mask)
-            self.bronchial_mask = self.create_combined_mask()
+            combined = self.create_combined_mask()
+            # outside the lung the mask is constant (the inverted threshold of 0), outside the box too
+            outside = combined[~self.lung_mask.astype(bool)]
+            self.bronchial_mask = self.paste(combined, fill=outside[0] if outside.size else False)
             self.total_lesion_voxels, self.total_lesion_volume = self.calculate_total_lesion_volume(self.bronchial_mask)
             return
         
-        elif len(self.lung_mask) > 2:
+        elif self.lung_mask.ndim > 2:
             if self.lung_mask.shape[2] > 1:
                 print(self.lung_mask.shape)
                 # remove parts of the masks and volumes
-                length = self.volume.shape[2]
+                start, stop = self.margin_slices()
                 # original image
-                self.volume = self.volume[:, :, 2:length-12]
+                self.volume = self.volume[:, :, start:stop]
                 # output of bronchial segmentation, bronchial tree is white
-                self.bronchial_mask = bronchial_mask[:, :, 2:length-12]
+                self.bronchial_mask = bronchial_mask[:, :, start:stop]
                 # lung segmentation mask, lung region is white
-                self.lung_mask = self.lung_mask[:, :, 2:length-12]
+                self.lung_mask = self.lung_mask[:, :, start:stop]
 
                 self.bronchial_mask = helper_functions.create_grayscale_mask(self.bronchial_mask)
                 self.bronchial_mask = self.create_combined_mask()
-                self.eroded_lung_mask = erosion(self.lung_mask, ball(self.footprint_size))
-                self.bronchial_mask = self.bronchial_mask * self.eroded_lung_mask
-                self.bronchial_mask = exposure.equalize_hist(self.bronchial_mask)
+                with instrumentation.stage('erosion', mask=self.lung_mask):
+                    self.eroded_lung_mask = morphology.binary_erosion(self.lung_mask, morphology.ball(self.footprint_size))
+                self.bronchial_mask = np.logical_and(self.bronchial_mask, self.eroded_lung_mask)
+                with instrumentation.stage('equalize_hist', image=self.bronchial_mask):
+                    self.bronchial_mask = exposure.equalize_hist(self.bronchial_mask)
                 self.bronchial_mask = helper_functions.create_binary_mask(self.bronchial_mask)
-                white_hat = white_tophat(self.bronchial_mask, ball(1))
+                white_hat = morphology.binary_white_tophat(self.bronchial_mask, morphology.ball(1))
                 self.bronchial_mask = self.bronchial_mask ^ white_hat
                 self.bronchial_mask = self.generate_mask_for_calculating_volume()
-                self.bronchial_mask = self.bronchial_mask * self.volume
-                self.bronchial_mask = erosion(self.bronchial_mask, ball(1))
-                self.bronchial_mask = self.generate_mask_for_calculating_volume()
+                self.bronchial_mask = np.where(self.bronchial_mask, self.volume, 0)
+                with instrumentation.stage('erosion', image=self.bronchial_mask):
+                    self.bronchial_mask = erosion(self.bronchial_mask, ball(1))
+                self.bronchial_mask = self.paste(self.generate_mask_for_calculating_volume(), margins=True)
 
         else:
             self.bronchial_mask = helper_functions.create_grayscale_mask(self.bronchial_mask)
             self.bronchial_mask = self.create_combined_mask()
-            self.eroded_lung_mask = erosion(self.lung_mask, disk(self.footprint_size))
-            self.bronchial_mask = self.bronchial_mask * self.eroded_lung_mask
-            white_hat = white_tophat(self.bronchial_mask, disk(self.footprint_size))
+            with instrumentation.stage('erosion', mask=self.lung_mask):
+                self.eroded_lung_mask = morphology.binary_erosion(self.lung_mask, morphology.ball(self.footprint_size))
+            self.bronchial_mask = np.logical_and(self.bronchial_mask, self.eroded_lung_mask)
+            white_hat = morphology.binary_white_tophat(self.bronchial_mask, morphology.ball(self.footprint_size))
             self.bronchial_mask = self.bronchial_mask ^ white_hat
             self.bronchial_mask = self.generate_mask_for_calculating_volume()
             self.bronchial_mask = util.invert(self.bronchial_mask)
-            self.bronchial_mask = self.bronchial_mask * self.volume
+            self.bronchial_mask = np.where(self.bronchial_mask, self.volume, 0)
             
 
 
@@ -83,41 +174,63 @@ class Lesion:
                 plt.title('Lesion Mask')
                 plt.show()
             else:
-                bronchial_slices = helper_functions.create_slices(self.bronchial_mask)
-                plt.imshow(util.invert(bronchial_slices[len(bronchial_slices)//2]), cmap='gray')
+                plt.imshow(util.invert(self.bronchial_mask[:, :, self.bronchial_mask.shape[2]//2]), cmap='gray')
                 plt.title('Lesion Mask')
                 plt.show()
-        name = self.generate_filename()
 
         if truth is not None:
-            print(truth)
-            truth = resize(truth, self.bronchial_mask.shape)
-            binary_lesion = helper_functions.create_binary_mask(self.bronchial_mask)
-            binary_truth = helper_functions.create_binary_mask(truth)
-            dice_coeff, numerator, denominator = helper_functions.calculate_dice_similarity_coefficient(binary_lesion, binary_truth)
-            print("DSC with Bronchial Removal: ", dice_coeff)
-            print(dice_coeff, numerator, denominator)
+            truth = resize_mask(truth, self.bronchial_mask.shape)
+            binary_lesion = evaluation.as_binary(self.bronchial_mask)
+            binary_truth = evaluation.as_binary(truth)
+            if binary_lesion.ndim > 2:
+                # counted per slice once; the case counts are their sum
+                self.slice_confusion = evaluation.confusion_counts(binary_lesion, binary_truth, axis=-1)
+                self.confusion = self.slice_confusion.total()
+            else:
+                self.confusion = evaluation.confusion_counts(binary_lesion, binary_truth)
+            self.evaluation = self.confusion.metrics(self.mm_x * self.mm_y * self.mm_z)
+            self.dice_coeff = self.evaluation['dice']
+            print("DSC with Bronchial Removal: ", self.dice_coeff)
             if not self.two_d:
-                helper_functions.view_3D(binary_lesion)
+                # written in the background at a bounded level of detail (see mesh_export.py)
+                name = os.path.splitext(os.path.basename(self.src_file))[0] + '_lesion'
+                mesh_export.export(binary_lesion, name, (self.mm_x, self.mm_y, self.mm_z))
         
+    def margin_slices(self) -> tuple:
+        '''
+        Returns the (start, stop) range of the slices of the volume that remain once crop_margins slices are
+        dropped at the start and the end of the full-size volume (see frame).
+        '''
+        if self.frame is None:
+            return self.crop_margins[0], self.volume.shape[2] - self.crop_margins[1]
+        shape, box = self.frame
+        start = max(self.crop_margins[0], box[2].start)
+        stop = max(min(shape[2] - self.crop_margins[1], box[2].stop), start)
+        return start - box[2].start, stop - box[2].start
+
+    def paste(self, mask, margins:bool=False, fill=False):
+        '''
+        Returns a lesion mask of the box pasted back into the full-size volume (see frame), filled with fill
+        outside the box, without the margin slices if margins (the mask then covers only the slices that
+        remain, see margin_slices).
+        '''
+        if self.frame is None:
+            return mask
+        shape, box = self.frame
+        if not margins:
+            return helper_functions.paste(mask, shape, box, fill)
+        first, last = self.crop_margins
+        start = box[2].start + self.margin_slices()[0] - first
+        return helper_functions.paste(mask, shape[:2] + (shape[2] - first - last,), box[:2] + (slice(start, start + mask.shape[2]),), fill)
+
     def generate_mask_for_calculating_volume(self):
         binary_bronchial_mask = helper_functions.create_binary_mask(self.bronchial_mask)
         mask = np.bitwise_and(self.eroded_lung_mask, binary_bronchial_mask)
         return mask
 
-    def generate_filename(self, dsc=-1):
-        file = 'has_dsc'
-        if dsc > 0:
-            name = 'output/two_dimensional/' + file + '_' + str(self.number) + '_DSC_' + str(dsc) + '.png'
-        else:
-            file = 'no_truth'
-            name = 'output/two_dimensional/' + file + '_' + str(self.number) + '.png'
-        return name
-
     def view_volume(self, volume):
-        slices = helper_functions.create_slices(volume)
-        for i in range(len(slices)):
-            plt.imshow(slices[i], cmap='gray')
+        for i in range(volume.shape[2]):
+            plt.imshow(volume[:, :, i], cmap='gray')
             plt.show()
 
     def calculate_total_lesion_volume(self, lesions):
@@ -155,16 +268,19 @@ class Lesion:
         bronchial_mask = util.invert(original)
         mask = lung_mask * bronchial_mask
         # keep masked area in volume
-        frangi_mask = mask * volume
+        frangi_mask = dtype_policy.POLICY.filter_input(mask * volume)
         frangi_mask = helper_functions.separate_hounsfield_range(
-            frangi_mask, -1000, -300)
-        frangi_mask = frangi(
-            frangi_mask, sigmas=range(1, 3), black_ridges=False)
+            frangi_mask, *self.hounsfield_window)
+        if self.stage is not None:
+            frangi_mask = self.stage.frangi(frangi_mask)
+        else:
+            with instrumentation.stage('frangi', image=frangi_mask):
+                frangi_mask = hessian_filters.frangi(frangi_mask, sigmas=self.frangi_sigmas, black_ridges=False)
         frangi_mask = util.invert(frangi_mask)
         frangi_mask = helper_functions.create_binary_mask(frangi_mask)
         # remove Frangi mask result from mask
-        mask = lung_mask * frangi_mask
-        final = volume * mask
+        mask = np.logical_and(lung_mask, frangi_mask)
+        final = np.where(mask, volume, 0)
         final = helper_functions.create_binary_mask(final)
         final = util.invert(final)
-        return final
\ No newline at end of file
+        return final
@@ -10,20 +10,44 @@ the process is automated, which is possible due to the narrow use case.
 
 import numpy as np 
 import pandas as pd # numpy and pandas overlap, here we use numpy for most operations and pandas for file I/O
-import os
+import os, multiprocessing
 import scipy.ndimage as ndimage
 import matplotlib.pyplot as plt
 
-from skimage import measure, segmentation
+from skimage import segmentation
 from skimage.filters import try_all_threshold
 from mpl_toolkits.mplot3d.art3d import Poly3DCollection
 
-import helper_functions
+import helper_functions, shared_arrays, morphology, dtype_policy, instrumentation
 
 LUNG_TEST = False
 
+# Footprints of the marker dilations, the black-hat and the lung filter closing (see morphology.py for the
+# scipy calls these are equivalent to). The black-hat footprint is a 7x7 disk iterated 8 times.
+EXTERNAL_INNER_FOOTPRINT = morphology.ball(10, 'taxicab')
+EXTERNAL_OUTER_FOOTPRINT = morphology.ball(55, 'taxicab')
+BLACKHAT_FOOTPRINT = [('chessboard', 8), ('taxicab', 16)]
+LUNGFILTER_FOOTPRINT = morphology.ball(6, 'chessboard')
+# padding of the lung bounding box that the later stages are cropped to, in mm: more than the reach of the
+# cavity enhancement filter (twice the largest airway radius, around the lung dilated by that radius)
+BOX_PADDING_MM = 30
+# HU assigned outside the lungs in the segmented volumes
+OUTSIDE_HU = -2000
+
+
+def segmentation_dtype(dtype):
+    '''
+    Returns the dtype of the segmented lungs of a volume of dtype: its own, or for unsigned integer data
+    (which cannot hold OUTSIDE_HU) the smallest signed dtype that holds both.
+    '''
+    dtype = np.dtype(dtype)
+    if dtype.kind == 'u':
+        return np.promote_types(dtype, np.int16)
+    return dtype
+
+
 class Lung:
-    def __init__(self, volume, px_height, px_width, voxel_x, voxel_y, voxel_z, demo=False) -> None:
+    def __init__(self, volume, px_height, px_width, voxel_x, voxel_y, voxel_z, demo=False, cache=None, volume_digest=None, workers=1) -> None:
         # Note that for this to work, the Hounsfield Units must be preserved in the passed in volume, do NOT convert to another format before running
         self.volume = volume
         self.px_height = px_height
@@ -32,35 +56,61 @@ class Lung:
         self.voxel_y = voxel_y
         self.voxel_z = voxel_z
         self.demo = demo
-        if voxel_z > 0:
-            self.slices = helper_functions.create_slices(self.volume)
-        else:
-            self.slices = [self.volume]
+        self.workers = workers
+        # a 3D volume or a stack of 2D images (segmented slice by slice either way) with its slices along the
+        # last axis; a 2D image is a stack of one slice
+        self.slices = self.volume if self.volume.ndim > 2 else self.volume[:, :, np.newaxis]
 
         print("Begin watershed segmentation of the entire lung.")
-        self.segmentations, self.masks = self.process()
+        if cache is not None:
+            self.segmentations, self.masks = self.process_cached(cache, volume_digest)
+        else:
+            self.segmentations, self.masks = self.process()
         self.lung_volume = self.calculate_lung_volume()
 
+    def process_cached(self, cache, volume_digest):
+        '''
+        Runs process() through the stage cache.
+        '''
+        key = cache.key('lung', volume_digest, voxel=(self.voxel_x, self.voxel_y, self.voxel_z))
+
+        def compute():
+            segmentations, masks = self.process()
+            return {'segmentations': segmentations, 'masks': masks}
+
+        stage = cache.get_or_compute(key, compute)
+        return stage['segmentations'], stage['masks']
+
     def calculate_lung_volume(self):
         # for each slice, count non-zero pixels
         # add up volume
         total_mask = 0
         total_mask_vol = 0
-        for i in range(len(self.masks)):
-            mask_px = np.count_nonzero(self.masks[i])
+        for i in range(self.masks.shape[2]):
+            mask_px = np.count_nonzero(self.masks[:, :, i])
             total_mask += mask_px
             mask_dim = mask_px * (self.voxel_x * self.voxel_y)
             total_mask_vol += (mask_dim * self.voxel_z)
         return total_mask_vol/1000
         
 
-    def seperate_lungs(self, slice):
+    def bounding_box(self, padding_mm:float=BOX_PADDING_MM) -> tuple:
+        '''
+        Returns the slices of the box around the lung masks, padded by padding_mm on every side (see
+        helper_functions.bounding_box). The bronchial tree and lesion stages run on this box only.
+        '''
+        voxel = (self.voxel_x, self.voxel_y, self.voxel_z)
+        padding = [int(np.ceil(padding_mm / size)) if size > 0 else 0 for size in voxel]
+        return helper_functions.bounding_box(self.masks, padding)
+
+    @staticmethod
+    def seperate_lungs(slice, marker_internal=None):
         #Creation of the markers as shown above:
-        marker_internal, marker_external, marker_watershed = self.generate_watershed_markers(slice)
+        marker_internal, marker_external, marker_watershed = Lung.generate_watershed_markers(slice, marker_internal)
         
         #Creation of the Sobel-Gradient
-        sobel_filtered_dx = ndimage.sobel(slice, 1)
-        sobel_filtered_dy = ndimage.sobel(slice, 0)
+        sobel_filtered_dx = ndimage.sobel(slice, 1, output=dtype_policy.POLICY.filter_dtype)
+        sobel_filtered_dy = ndimage.sobel(slice, 0, output=dtype_policy.POLICY.filter_dtype)
         sobel_gradient = np.hypot(sobel_filtered_dx, sobel_filtered_dy)
         sobel_gradient *= 255.0 / np.max(sobel_gradient)
         
@@ -72,68 +122,98 @@ class Lung:
         outline = outline.astype(bool)
         
         #Performing Black-Tophat Morphology for reinclusion
-        #Creation of the disk-kernel and increasing its size a bit
-        blackhat_struct = [[0, 0, 1, 1, 1, 0, 0],
-                        [0, 1, 1, 1, 1, 1, 0],
-                        [1, 1, 1, 1, 1, 1, 1],
-                        [1, 1, 1, 1, 1, 1, 1],
-                        [1, 1, 1, 1, 1, 1, 1],
-                        [0, 1, 1, 1, 1, 1, 0],
-                        [0, 0, 1, 1, 1, 0, 0]]
-        blackhat_struct = ndimage.iterate_structure(blackhat_struct, 8)
-        #Perform the Black-Hat
-        outline += ndimage.black_tophat(outline, structure=blackhat_struct)
+        #The kernel is a 7x7 disk increased in size a bit (iterated 8 times), which decomposes into a square and a diamond
+        outline += morphology.binary_black_tophat(outline, BLACKHAT_FOOTPRINT)
         
         #Use the internal marker and the Outline that was just created to generate the lungfilter
         lungfilter = np.bitwise_or(marker_internal, outline)
         #Close holes in the lungfilter
         #fill_holes is not used here, since in some slices the heart would be reincluded by accident
-        lungfilter = ndimage.morphology.binary_closing(lungfilter, structure=np.ones((5,5)), iterations=3)
+        lungfilter = morphology.binary_closing(lungfilter, LUNGFILTER_FOOTPRINT, border_value=0)
         
-        #Apply the lungfilter (note the filtered areas being assigned -2000 HU)
-        segmented = np.where(lungfilter == 1, slice, -2000*np.ones((self.px_height, self.px_width)))
+        #Apply the lungfilter (note the filtered areas being assigned -2000 HU, in the dtype of the slice, signed)
+        segmented = np.where(lungfilter, slice, np.array(OUTSIDE_HU, dtype=segmentation_dtype(slice.dtype)))
         
         return segmented, lungfilter, outline, watershed, sobel_gradient, marker_internal, marker_external, marker_watershed
 
-    def generate_watershed_markers(self, slice):
+    @staticmethod
+    def generate_internal_markers(slices):
+        '''
+        Returns the internal watershed markers of a stack of slices (slices along the last axis): the
+        regions below -400 HU that do not touch the border of their slice, keeping only the two largest
+        regions per slice (and any region tied in size with the second largest).
+
+        All slices are labelled in one pass (8-connectivity within a slice, none between slices) and the
+        regions are kept or dropped with a lookup table built from the label sizes.
+        '''
+        structure = np.zeros((3, 3, 3), dtype=bool)
+        structure[:, :, 1] = True
+        labels, count = ndimage.label(slices < -400, structure=structure)
+        sizes = np.bincount(labels.ravel(), minlength=count + 1)
+        # clear_border: drop the regions that touch the border of their slice
+        border = np.concatenate((labels[0, :, :].ravel(), labels[-1, :, :].ravel(), labels[:, 0, :].ravel(), labels[:, -1, :].ravel()))
+        sizes[border] = 0
+        sizes[0] = 0
+        # slice index of every label
+        label_slice = np.zeros(count + 1, dtype=np.intp)
+        label_slice[labels.ravel()] = np.broadcast_to(np.arange(slices.shape[2]), slices.shape).ravel()
+
+        regions = np.flatnonzero(sizes)
+        order = np.lexsort((-sizes[regions], label_slice[regions]))
+        regions = regions[order]
+        region_slices = label_slice[regions]
+        regions_per_slice = np.bincount(region_slices, minlength=slices.shape[2])
+        # rank of every region within its slice, largest first
+        first_of_slice = np.concatenate(([0], np.cumsum(regions_per_slice)[:-1]))
+        rank = np.arange(len(regions)) - first_of_slice[region_slices]
+        second_largest = np.zeros(slices.shape[2], dtype=sizes.dtype)
+        second_largest[region_slices[rank == 1]] = sizes[regions[rank == 1]]
+
+        keep = np.zeros(count + 1, dtype=bool)
+        keep[regions] = (regions_per_slice[region_slices] <= 2) | (sizes[regions] >= second_largest[region_slices])
+        return keep[labels]
+
+    @staticmethod
+    def generate_watershed_markers(slice, marker_internal=None):
         # This code is taken from the Kaggle notebook with some minor changes
-        #Creation of the internal Marker
-        marker_internal = slice < -400
-        marker_internal = segmentation.clear_border(marker_internal)
-        marker_internal_labels = measure.label(marker_internal)
-        areas = [r.area for r in measure.regionprops(marker_internal_labels)]
-        areas.sort()
-        if len(areas) > 2:
-            for region in measure.regionprops(marker_internal_labels):
-                if region.area < areas[-2]:
-                    for coordinates in region.coords:                
-                        marker_internal_labels[coordinates[0], coordinates[1]] = 0
-        marker_internal = marker_internal_labels > 0
+        #Creation of the internal Marker (unless it was already created for a whole stack of slices)
+        if marker_internal is None:
+            marker_internal = Lung.generate_internal_markers(slice[:, :, np.newaxis])[:, :, 0]
         #Creation of the external Marker
-        external_a = ndimage.binary_dilation(marker_internal, iterations=10)
-        external_b = ndimage.binary_dilation(marker_internal, iterations=55)
+        external_a = morphology.binary_dilation(marker_internal, EXTERNAL_INNER_FOOTPRINT)
+        external_b = morphology.binary_dilation(marker_internal, EXTERNAL_OUTER_FOOTPRINT)
         marker_external = external_b ^ external_a
         #Creation of the Watershed Marker matrix
-        marker_watershed = np.zeros((self.px_width, self.px_height), dtype=np.int)
+        marker_watershed = np.zeros(slice.shape, dtype=int)
         marker_watershed += marker_internal * 255
         marker_watershed += marker_external * 128
         
         return marker_internal, marker_external, marker_watershed
 
+    @instrumentation.timed('lung.process')
     def process(self, healthy=False):
-        segmentations = []
-        masks = []
-        slice_list = self.slices
+        '''
+        Returns the segmented lungs (HU, -2000 outside) and the lung masks, each a volume shaped like the
+        slice stack that every slice is written into in place.
+        '''
+        slices = self.slices
         if healthy:
-            slice_list = self.healthy_slices
-        for i in range(len(slice_list)):
-            segmented, lungfilter, outline, watershed, sobel_gradient, marker_internal, marker_external, marker_watershed = self.seperate_lungs(slice_list[i])
-            segmentations.append(segmented)
-            masks.append(lungfilter)
+            slices = self.healthy_slices
+        if self.workers > 1 and slices.shape[2] > 1:
+            segmentations, masks = self.process_parallel(slices)
+        else:
+            segmentations = np.empty(slices.shape, dtype=segmentation_dtype(slices.dtype))
+            masks = np.empty(slices.shape, dtype=bool)
+            internal_markers = self.generate_internal_markers(slices)
+            for i in range(slices.shape[2]):
+                segmented, lungfilter, outline, watershed, sobel_gradient, marker_internal, marker_external, marker_watershed = self.seperate_lungs(slices[:, :, i], internal_markers[:, :, i])
+                segmentations[:, :, i] = segmented
+                masks[:, :, i] = lungfilter
 
         if self.demo:
-            segmented, lungfilter, outline, watershed, sobel_gradient, marker_internal, marker_external, marker_watershed = self.seperate_lungs(self.slices[len(slice_list)//2])
-            plt.imshow(self.slices[len(self.slices)//2], cmap='gray')
+            middle = self.slices[:, :, slices.shape[2]//2]
+            segmented, lungfilter, outline, watershed, sobel_gradient, marker_internal, marker_external, marker_watershed = self.seperate_lungs(middle)
+            plt.imshow(middle, cmap='gray')
             plt.title('Original Image')
             plt.show()
             plt.imshow(lungfilter, cmap="gray")
@@ -142,4 +222,42 @@ class Lung:
             plt.imshow(segmented, cmap="gray")
             plt.title('Segmented Lung')
             plt.show()
-        return segmentations, masks
\ No newline at end of file
+        return segmentations, masks
+
+    def process_parallel(self, stack, batches_per_worker=4):
+        '''
+        Runs seperate_lungs on batches of slices on a process pool. The slices and the outputs are held in
+        shared memory, so each worker reads its slices and writes its segmentations and masks in place and
+        only slice indices are pickled. Returns the same volumes as the serial loop in process().
+        '''
+        shape = stack.shape
+        with shared_arrays.SharedArray.copy_of(stack) as slices, \
+                shared_arrays.SharedArray(shape, segmentation_dtype(stack.dtype)) as segmentations, \
+                shared_arrays.SharedArray(shape, bool) as masks:
+            jobs = [(slices.spec, segmentations.spec, masks.spec, start, stop)
+                    for start, stop in shared_arrays.slabs(shape[2], self.workers * batches_per_worker)]
+            with multiprocessing.Pool(processes=self.workers) as pool:
+                pool.starmap(seperate_lungs_batch, jobs, chunksize=1)
+            segmentation_volume = segmentations.array.copy()
+            mask_volume = masks.array.copy()
+        return segmentation_volume, mask_volume
+
+
+def seperate_lungs_batch(slices_spec, segmentations_spec, masks_spec, start:int, stop:int):
+    '''
+    Worker for Lung.process_parallel: segments slices [start, stop) of the shared slice stack.
+    '''
+    slices = shared_arrays.SharedArray.attach(slices_spec)
+    segmentations = shared_arrays.SharedArray.attach(segmentations_spec)
+    masks = shared_arrays.SharedArray.attach(masks_spec)
+    try:
+        internal_markers = Lung.generate_internal_markers(slices.array[:, :, start:stop])
+        for i in range(start, stop):
+            segmented, lungfilter = Lung.seperate_lungs(slices.array[:, :, i], internal_markers[:, :, i - start])[:2]
+            segmentations.array[:, :, i] = segmented
+            masks.array[:, :, i] = lungfilter
+    finally:
+        slices.close()
+        segmentations.close()
+        masks.close()
+    return stop - start
@@ -1,10 +1,8 @@
 import argparse, time
 import os
-from operator import gt
 import numpy as np
-from matplotlib.image import imsave
 
-import reader, demo
+import batch, demo, stage_cache, dtype_policy, evaluation, hessian_filters, mesh_export, mask_export, instrumentation
 
 HAS_GROUND_TRUTH = False
 
@@ -44,9 +42,56 @@ def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("-t", "--type", type=str,
                        help="Selection from k for Kassin et al, s for 3D segmented volumes, t for 2D segmentations, d for demo, or x for exit.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                       help="Number of worker processes for the parallel stages (default 1).")
+    parser.add_argument("-c", "--cache", type=str, default=None,
+                       help="Directory in which to cache the lung and bronchial tree stages between runs.")
+    parser.add_argument("--cache-size", type=float, default=20,
+                       help="Maximum size of the stage cache in GB (default 20).")
+    parser.add_argument("--multiresolution", type=int, default=1,
+                       help="Experimental: run the cavity enhancement filter coarse-to-fine, downsampling by this factor, with no guaranteed error bound (default 1, full resolution).")
+    parser.add_argument("--no-crop", action="store_true",
+                       help="Run the bronchial tree and lesion stages of 3D volumes on the whole scan instead of the bounding box of the lungs.")
+    parser.add_argument("--filter-memory", type=float, default=None,
+                       help="Working memory limit of the Sato and Frangi filters in GB; larger volumes are filtered in blocks (default: no limit).")
+    parser.add_argument("--filter-threads", type=int, default=1,
+                       help="Number of threads filtering blocks at once, sharing the --filter-memory limit (default 1).")
+    parser.add_argument("--filter-scratch", type=str, default=None,
+                       help="Directory in which to memory-map the Sato and Frangi outputs instead of keeping them in memory.")
+    parser.add_argument("--mmap", action="store_true",
+                       help="Memory-map the NIfTI files and keep their on-disk dtype, without the dtype policy's conversion on load. Only scaled files are converted, to the compute dtype (the policy's filter dtype).")
+    parser.add_argument("--dtype-policy", type=str, default='compact', choices=sorted(dtype_policy.POLICIES),
+                       help="compact (default): int16 HU, float32 filters, bool masks. legacy: float64 throughout.")
+    parser.add_argument("-j", "--jobs", type=int, default=None,
+                       help="Number of cases to process at once (default: as many as fit in the available memory).")
+    parser.add_argument("-m", "--manifest", type=str, default=None,
+                       help="Results manifest to write to and resume from (default output/manifest_<type>.json).")
+    parser.add_argument("--prefetch", type=int, default=2,
+                       help="Number of scans to load ahead of the one being processed in Kassin et al mode (default 2).")
+    parser.add_argument("--mesh-format", type=str, default='ply', choices=mesh_export.FORMATS,
+                       help="Format of the lesion surface meshes written to output/meshes (default ply, none to disable).")
+    parser.add_argument("--mesh-triangles", type=int, default=mesh_export.TRIANGLE_BUDGET,
+                       help="Maximum number of triangles per mesh (default {}).".format(mesh_export.TRIANGLE_BUDGET))
+    parser.add_argument("--mask-format", type=str, default='uint8', choices=mask_export.FORMATS,
+                       help="Storage of the lung, bronchial tree and lesion masks written to output/masks (default uint8, packed for bit-packed, none to disable).")
+    parser.add_argument("--no-mask-compression", action="store_true",
+                       help="Write the masks as .nii instead of gzip compressed .nii.gz.")
+    parser.add_argument("--profile", type=str, default=None,
+                       help="Directory in which to write per-stage timings and memory use, one JSON lines file per case.")
+    parser.add_argument("--trace-allocations", action="store_true",
+                       help="With --profile, also trace the peak numpy/Python allocations of every stage (slower).")
     options = parser.parse_args()
 
     footprint_size = 6
+    dtype_policy.set_policy(options.dtype_policy)
+    mesh_export.configure(options.mesh_format, options.mesh_triangles)
+    mask_export.configure(options.mask_format, not options.no_mask_compression)
+    instrumentation.configure(options.profile, options.trace_allocations)
+    filter_memory = None if options.filter_memory is None else int(options.filter_memory * 1024**3)
+    hessian_filters.configure(filter_memory, options.filter_threads, options.filter_scratch)
+    cache = None
+    if options.cache is not None:
+        cache = stage_cache.StageCache(options.cache, int(options.cache_size * 1024**3))
 
     if options.type == 'k':
         dataset_name = 'Kassin et al'
@@ -56,15 +101,13 @@ def main():
                 "Directory invalid. Enter a valid directory or press 'h' for help.: ")
             if directory == 'h':
                 print("The data from Kassin et al must be requested from the authors. This software expects that all files have .nii file extension.")
+        HAS_GROUND_TRUTH = False
         paths = walk_files(directory)
-        print(paths)
-        exit()
     elif options.type == 's':
         dataset_name = 'three dimensional'
         footprint_size = 1
         HAS_GROUND_TRUTH = True
         paths = walk_files('resources/three_dimensional')
-        paths = ['resources/three_dimensional/three_dimensional_images/5.nii', 'resources/three_dimensional/three_dimensional_masks/5.nii']
     elif options.type == 't':
         dataset_name = 'two dimensional'
         HAS_GROUND_TRUTH = True
@@ -87,31 +130,34 @@ def main():
         print('{} images found.'.format(len(paths)))
         print('Begin processing {} dataset...'.format(dataset_name))
         # set up file reader and analysis on volumes
-        lung_volumes = []
-        lesion_volumes = []
-        no_processing_volumes = []
         if HAS_GROUND_TRUTH:
             paths, ground_truth = separate_ground_truth(paths)
             paths.sort()
             ground_truth.sort()
-            two = False
-            if options.type == 't':
-                two = True
-            for i in range(len(paths)):
-
-                read = reader.Reader(
-                    paths[i], i, footprint_size, ground_truth[i], two_d=two)
-                gt_name = 'output/two_dimensional/gt_' + str(i) + '_.png'
-                imsave(gt_name, ground_truth[i], cmap='gray')
-                lung_volumes.append(read.lung_volume)
-                lesion_volumes.append(read.lesion_volume)
-                no_processing_volumes.append(read.lesion_volume)
         else:
-            for i in range(len(paths)):
-                read = reader.Reader(paths[i], i, footprint_size)
-                lung_volumes.append(read.lung_volume)
-                lesion_volumes.append(read.lesion_volume)
-                no_processing_volumes.append(read.lesion_volume)
+            paths.sort()
+            ground_truth = [None] * len(paths)
+        manifest_path = options.manifest
+        if manifest_path is None:
+            manifest_path = os.path.join('output', 'manifest_' + options.type + '.json')
+        manifest = batch.Manifest(manifest_path)
+        if options.type == 'k':
+            # unlabelled dataset: stream the cases, loading the next scans while the current one is processed
+            for image, result in batch.stream(paths, manifest, footprint_size, depth=options.prefetch,
+                                              mmap=options.mmap, workers=options.workers, cache=cache,
+                                              multiresolution=options.multiresolution, crop=not options.no_crop):
+                if result['status'] == 'done':
+                    print('{}: lung volume {}, lesion volume {}'.format(image, result['lung_volume'], result['lesion_volume']))
+        else:
+            batch.run(paths, ground_truth, manifest, footprint_size, two_d=options.type == 't', jobs=options.jobs,
+                      workers=options.workers, cache=cache, mmap=options.mmap, multiresolution=options.multiresolution,
+                      crop=not options.no_crop)
+        for image in sorted(manifest.cases):
+            if manifest.cases[image]['status'] != 'done':
+                print('Case {} failed: {}'.format(image, manifest.cases[image]['error']))
+        lung_volumes = manifest.results('lung_volume')
+        lesion_volumes = manifest.results('lesion_volume')
+        no_processing_volumes = manifest.results('no_processing_lesion_volume')
         std_dev = np.std(lung_volumes)
         lung_avg = np.average(lung_volumes)
         median = np.median(lung_volumes)
@@ -129,9 +175,18 @@ def main():
         for i in range(len(no_processing_volumes)):
             print(' --', no_processing_volumes[i])
 
+        summary = evaluation.dataset_summary(manifest.confusion())
+        if summary['cases'] > 0:
+            print('Lesion Segmentation Evaluation ({} cases with ground truth):'.format(summary['cases']))
+            for name in evaluation.METRICS:
+                print(' {}: {:.4f} over all voxels, {:.4f} +/- {:.4f} per case'.format(
+                    name, summary['micro'][name], summary['macro'][name]['mean'], summary['macro'][name]['std']))
+
 
     else:
         demo.Demo(demo_type)
+        mesh_export.flush()
+        mask_export.flush()
 
 
    
@@ -140,15 +195,11 @@ if __name__ == "__main__":
     main()
     total_time = time.time() - start_time
     count = 0
-    units = ' seconds'
+    units = ['seconds', 'minutes', 'hours']
     while total_time > 60 and count < 2:
         total_time = total_time/60
         count += 1
-    if count == 1:
-        units = ' minutes'
-    else:
-        units = ' hours'
 
-    print('Total Execution Time: ', str(total_time), units)
+    print('Total Execution Time: ', str(total_time), units[count])
 
     
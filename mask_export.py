@@ -0,0 +1,125 @@
+'''
+Export of the segmentation masks of a case as NIfTI files.
+
+The lung mask, the bronchial tree (the cavity enhancement filter volume thresholded as the lesion stage
+thresholds it) and the lesion mask of a case are written to OUTPUT_DIRECTORY/<case>_<mask>.nii.gz with the
+affine of the source scan, so that they overlay it in any NIfTI viewer. Masks are stored as uint8 (8 times
+smaller than float64) or, with the 'packed' format, bit-packed: 8 voxels along the first axis per byte, a 64th
+of float64. Packed files are marked in their header (intent_name) and read back with read_mask; other tools
+see a volume of bytes. Files are gzip compressed unless compression is disabled.
+
+Encoding, compression and writing run on a background thread with a bounded queue (see background_writer.py).
+Unlike meshes, masks are results and are never skipped: when MAX_PENDING cases are already waiting the
+pipeline waits for the disk. Call flush() before a process exits to wait for the masks that are still queued.
+'''
+
+import os
+
+import nibabel as nib
+import numpy as np
+
+import background_writer
+
+FORMATS = ('uint8', 'packed', 'none')
+OUTPUT_DIRECTORY = 'output/masks'
+FORMAT = 'uint8'
+COMPRESS = True
+MAX_PENDING = 2
+PACKED_INTENT = b'LENS packbits'
+
+
+def configure(format:str=None, compress:bool=None, directory:str=None):
+    '''
+    Sets the process-wide mask format ('uint8', 'packed' or 'none' to disable export), whether files are
+    gzip compressed and the output directory. Worker processes forked afterwards inherit them.
+    '''
+    global FORMAT, COMPRESS, OUTPUT_DIRECTORY
+    if format is not None:
+        if format not in FORMATS:
+            raise ValueError('Unknown mask format {}, expected one of {}.'.format(format, FORMATS))
+        FORMAT = format
+    if compress is not None:
+        COMPRESS = compress
+    if directory is not None:
+        OUTPUT_DIRECTORY = directory
+
+
+def settings() -> dict:
+    return {'format': FORMAT, 'compress': COMPRESS, 'directory': OUTPUT_DIRECTORY}
+
+
+def encode(mask, affine, format:str='uint8'):
+    '''
+    Returns the mask (nonzero is foreground) as a Nifti1Image with the given affine, in uint8 or bit-packed
+    along the first axis.
+    '''
+    mask = np.asarray(mask) != 0
+    if format == 'packed':
+        image = nib.Nifti1Image(np.packbits(mask, axis=0), affine)
+        image.header['intent_name'] = PACKED_INTENT
+        # the packed axis is rounded up to a multiple of 8, so its length is kept too
+        image.header['intent_p1'] = mask.shape[0]
+    else:
+        image = nib.Nifti1Image(mask.astype(np.uint8), affine)
+    image.set_data_dtype(np.uint8)
+    return image
+
+
+def read_mask(path:str):
+    '''
+    Reads a mask written by this module and returns (mask, affine), the mask as booleans.
+    '''
+    image = nib.load(path)
+    data = np.asanyarray(image.dataobj)
+    if image.header['intent_name'].tobytes().rstrip(b'\0') == PACKED_INTENT:
+        data = np.unpackbits(data, axis=0, count=int(image.header['intent_p1']))
+    return data != 0, image.affine
+
+
+def write_masks(paths:dict, masks:dict, affine, format:str='uint8') -> int:
+    '''
+    Writes each mask to its path. Returns the number of bytes written.
+    '''
+    written = 0
+    for name, mask in masks.items():
+        path = paths[name]
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        nib.save(encode(mask, affine, format), path)
+        written += os.path.getsize(path)
+    return written
+
+
+def write_queued_masks(paths:dict, masks:dict, affine, format:str):
+    '''
+    write_masks, run by the background writer.
+    '''
+    written = write_masks(paths, masks, affine, format)
+    print('Wrote masks {} ({:.1f} MB)'.format(', '.join(paths.values()), written / 1024**2))
+
+
+def export(masks:dict, name:str, affine) -> bool:
+    '''
+    Queues masks (a dict from mask name, e.g. 'lesion', to array) for writing to
+    OUTPUT_DIRECTORY/<name>_<mask name>.nii[.gz] in the configured format. Does nothing if the format is
+    'none'.
+    '''
+    if FORMAT == 'none':
+        return False
+    extension = '.nii.gz' if COMPRESS else '.nii'
+    paths = {mask: os.path.join(OUTPUT_DIRECTORY, name + '_' + mask + extension) for mask in masks}
+    files = ', '.join(paths.values())
+    writer = background_writer.writer('masks', MAX_PENDING)
+    # masks are results, so rather than skipping them the pipeline waits for room in the queue
+    if not writer.offer('masks ' + files, write_queued_masks, paths, masks, affine, FORMAT):
+        print('Mask writer busy, waiting to queue {}'.format(files))
+        writer.put('masks ' + files, write_queued_masks, paths, masks, affine, FORMAT)
+    return True
+
+
+def flush():
+    '''
+    Waits for this process's queued masks, if it has any.
+    '''
+    background_writer.flush('masks')
@@ -0,0 +1,211 @@
+'''
+Headless export of segmentation surfaces as meshes.
+
+A surface at full resolution can have tens of millions of triangles, so meshes are built to a triangle budget:
+the mask is first downsampled (a coarse voxel is foreground if any of its voxels is) by a factor estimated
+from the area of its surface, and if marching cubes still produces too many triangles the mesh is decimated
+by vertex clustering. Meshes are written as binary PLY, OBJ or a self-contained plotly HTML page.
+
+Meshing and writing run on a background thread with a bounded queue (see background_writer.py), so the
+pipeline never waits for them: if the queue is full the mesh is skipped rather than held in memory. Call
+flush() before a process exits to wait for the meshes that are still queued.
+'''
+
+import math, os
+
+import numpy as np
+from skimage import measure
+
+import background_writer
+
+FORMATS = ('ply', 'obj', 'html', 'none')
+OUTPUT_DIRECTORY = 'output/meshes'
+FORMAT = 'ply'
+TRIANGLE_BUDGET = 200000
+MAX_PENDING = 2
+
+
+def configure(format:str=None, triangle_budget:int=None, directory:str=None):
+    '''
+    Sets the process-wide mesh format ('ply', 'obj', 'html' or 'none' to disable export), triangle budget
+    and output directory. Worker processes forked afterwards inherit them.
+    '''
+    global FORMAT, TRIANGLE_BUDGET, OUTPUT_DIRECTORY
+    if format is not None:
+        if format not in FORMATS:
+            raise ValueError('Unknown mesh format {}, expected one of {}.'.format(format, FORMATS))
+        FORMAT = format
+    if triangle_budget is not None:
+        TRIANGLE_BUDGET = triangle_budget
+    if directory is not None:
+        OUTPUT_DIRECTORY = directory
+
+
+def settings() -> dict:
+    return {'format': FORMAT, 'triangle_budget': TRIANGLE_BUDGET, 'directory': OUTPUT_DIRECTORY}
+
+
+def surface_faces(mask) -> int:
+    '''
+    Returns the number of voxel faces between foreground and background, which is proportional to the number
+    of triangles marching cubes produces.
+    '''
+    faces = 0
+    for axis in range(mask.ndim):
+        faces += np.count_nonzero(np.diff(mask, axis=axis))
+        # faces on the border of the volume
+        faces += np.count_nonzero(mask.take(0, axis=axis)) + np.count_nonzero(mask.take(-1, axis=axis))
+    return faces
+
+
+def downsample(mask, factor:int):
+    '''
+    Returns the mask downsampled by an integer factor along every axis, a coarse voxel being foreground if any
+    of its voxels is (so thin structures do not disappear).
+    '''
+    if factor <= 1:
+        return mask
+    pad = [(0, -n % factor) for n in mask.shape]
+    mask = np.pad(mask, pad)
+    shape = []
+    for n in mask.shape:
+        shape.extend((n // factor, factor))
+    return mask.reshape(shape).any(axis=tuple(range(1, 2*mask.ndim, 2)))
+
+
+def decimate(verts, faces, triangle_budget:int):
+    '''
+    Decimates a mesh by vertex clustering until it has at most triangle_budget faces: vertices that fall into
+    the same cell of a grid are merged into their mean, and faces that collapse or repeat are dropped. The grid
+    is coarsened until the mesh fits.
+    '''
+    extent = np.ptp(verts, axis=0).max() if len(verts) else 0
+    # a grid with about as many surface cells as the budget allows
+    cell = extent / math.sqrt(max(triangle_budget, 1)) if extent > 0 else 1
+    while len(faces) > triangle_budget:
+        keys = np.floor(verts / cell).astype(np.int64)
+        _, inverse, counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+        inverse = inverse.ravel()
+        merged = np.stack([np.bincount(inverse, weights=verts[:, axis]) for axis in range(3)], axis=1) / counts[:, np.newaxis]
+        merged_faces = inverse[faces]
+        keep = (merged_faces[:, 0] != merged_faces[:, 1]) & (merged_faces[:, 1] != merged_faces[:, 2]) & (merged_faces[:, 0] != merged_faces[:, 2])
+        merged_faces = merged_faces[keep]
+        _, unique = np.unique(np.sort(merged_faces, axis=1), axis=0, return_index=True)
+        merged_faces = merged_faces[np.sort(unique)]
+        if len(merged_faces) <= triangle_budget:
+            return merged.astype(verts.dtype), merged_faces
+        cell *= 1.5
+    return verts, faces
+
+
+def lod_mesh(mask, spacing=(1, 1, 1), triangle_budget:int=None):
+    '''
+    Returns (verts, faces) of the surface of a 3D mask with at most triangle_budget faces, with the vertices
+    in the units of spacing (e.g. mm), or None if the mask has no surface.
+
+    Args:
+      mask: 3D array, nonzero is foreground
+      spacing: voxel size along each axis
+      triangle_budget:int - maximum number of triangles (defaults to TRIANGLE_BUDGET)
+    '''
+    if triangle_budget is None:
+        triangle_budget = TRIANGLE_BUDGET
+    mask = np.asarray(mask, dtype=bool)
+    if not mask.any():
+        return None
+    # marching cubes makes about two triangles per voxel face, and a downsampling factor f divides the faces by f^2
+    factor = max(1, math.ceil(math.sqrt(2 * surface_faces(mask) / max(triangle_budget, 1))))
+    coarse = downsample(mask, factor)
+    # pad so that surfaces touching the border of the volume are closed
+    coarse = np.pad(coarse, 1).astype(np.uint8)
+    verts, faces, _, _ = measure.marching_cubes(coarse, 0.5, spacing=tuple(factor * s for s in spacing), allow_degenerate=False)
+    verts -= np.asarray(spacing, dtype=verts.dtype) * factor
+    verts = verts.astype(np.float32)
+    if len(faces) > triangle_budget:
+        verts, faces = decimate(verts, faces, triangle_budget)
+    return verts, faces
+
+
+def write_ply(path:str, verts, faces):
+    '''
+    Writes a binary (little endian) PLY file.
+    '''
+    header = ('ply\nformat binary_little_endian 1.0\nelement vertex {}\nproperty float x\nproperty float y\n'
+              'property float z\nelement face {}\nproperty list uchar int vertex_indices\nend_header\n').format(len(verts), len(faces))
+    face_records = np.empty(len(faces), dtype=[('count', 'u1'), ('indices', '<i4', (3,))])
+    face_records['count'] = 3
+    face_records['indices'] = faces
+    with open(path, 'wb') as file:
+        file.write(header.encode('ascii'))
+        file.write(np.ascontiguousarray(verts, dtype='<f4').tobytes())
+        file.write(face_records.tobytes())
+
+
+def write_obj(path:str, verts, faces):
+    '''
+    Writes a Wavefront OBJ file (faces are 1-based).
+    '''
+    with open(path, 'w') as file:
+        np.savetxt(file, verts, fmt='v %.4f %.4f %.4f')
+        np.savetxt(file, faces + 1, fmt='f %d %d %d')
+
+
+def write_html(path:str, verts, faces):
+    '''
+    Writes a self-contained interactive plotly page (plotly.js is embedded, so it opens offline).
+    '''
+    import plotly.graph_objects as go
+    mesh = go.Mesh3d(x=verts[:, 0], y=verts[:, 1], z=verts[:, 2], i=faces[:, 0], j=faces[:, 1], k=faces[:, 2],
+                     color='rgb(236, 236, 212)', flatshading=True)
+    figure = go.Figure(mesh)
+    figure.update_layout(scene={'aspectmode': 'data'}, paper_bgcolor='rgb(64, 64, 64)')
+    figure.write_html(path, include_plotlyjs=True, auto_open=False)
+
+
+WRITERS = {'ply': write_ply, 'obj': write_obj, 'html': write_html}
+
+
+def write_mesh(path:str, mask, spacing=(1, 1, 1), format:str='ply', triangle_budget:int=None):
+    '''
+    Builds the level-of-detail mesh of the mask and writes it to path. Returns the number of triangles written.
+    '''
+    mesh = lod_mesh(mask, spacing, triangle_budget)
+    if mesh is None:
+        print('Skipping mesh {}: the mask is empty.'.format(path))
+        return 0
+    verts, faces = mesh
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    WRITERS[format](path, verts, faces)
+    return len(faces)
+
+
+def write_queued_mesh(path:str, mask, spacing, format:str, triangle_budget:int):
+    '''
+    write_mesh, run by the background writer.
+    '''
+    triangles = write_mesh(path, mask, spacing, format, triangle_budget)
+    if triangles:
+        print('Wrote mesh {} ({} triangles)'.format(path, triangles))
+
+
+def export(mask, name:str, spacing=(1, 1, 1)) -> bool:
+    '''
+    Queues the surface of the mask for writing to OUTPUT_DIRECTORY/name.<format> in the configured format,
+    without waiting. Does nothing if the format is 'none'.
+    '''
+    if FORMAT == 'none':
+        return False
+    path = os.path.join(OUTPUT_DIRECTORY, name + '.' + FORMAT)
+    if not background_writer.writer('meshes', MAX_PENDING).offer('mesh ' + path, write_queued_mesh, path, mask, spacing, FORMAT, TRIANGLE_BUDGET):
+        print('Mesh writer busy, skipping {}'.format(path))
+        return False
+    return True
+
+
+def flush():
+    '''
+    Waits for this process's queued meshes, if it has any.
+    '''
+    background_writer.flush('meshes')
@@ -0,0 +1,153 @@
+'''
+Binary morphology whose cost does not grow with the size of the structuring element.
+
+A footprint is a list of (metric, radius) pairs, each one a ball of the given radius under the 'euclidean',
+'chessboard' or 'taxicab' metric; a list with more than one pair is the Minkowski sum of its balls (a
+decomposed structuring element). Dilating by a ball is a threshold on a distance transform, which is O(N)
+whatever the radius, and dilating by a Minkowski sum is dilating by each ball in turn.
+
+Every function takes method='reference', which runs the same operation through scipy.ndimage with the
+footprint built as an explicit array. The pipeline used to call scipy/skimage directly; these are the
+equivalences (all exact, for boolean images):
+
+    ndimage.binary_dilation(m, iterations=n)
+        == binary_dilation(m, [('taxicab', n)])
+    ndimage.binary_closing(m, structure=np.ones((5, 5)), iterations=3)
+        == binary_closing(m, [('chessboard', 6)], border_value=0)
+    ndimage.black_tophat(m, structure=ndimage.iterate_structure(<7x7 disk>, 8))
+        == binary_black_tophat(m, [('chessboard', 8), ('taxicab', 16)])
+    skimage.morphology.erosion(m, ball(r)) (or disk(r) in 2D)
+        == binary_erosion(m, [('euclidean', r)])
+    skimage.morphology.white_tophat(m, ball(r)) (or disk(r) in 2D)
+        == binary_white_tophat(m, [('euclidean', r)])
+
+border_value is the value assumed outside the image by erosions, as in scipy.ndimage. scipy's binary
+erosion uses 0; skimage and ndimage's grey morphology use 'reflect', which for these footprints is the same
+as 1 (outside the image never erodes).
+'''
+
+import math
+
+import numpy as np
+import scipy.ndimage as ndimage
+
+METRICS = ('euclidean', 'chessboard', 'taxicab')
+
+
+def ball(radius, metric:str='euclidean') -> list:
+    '''
+    Returns the footprint of a single ball.
+    '''
+    return [(metric, radius)]
+
+
+def footprint_array(footprint, ndim:int):
+    '''
+    Returns the footprint as an explicit boolean structuring element (used by method='reference').
+    '''
+    result = np.ones((1,)*ndim, dtype=bool)
+    for metric, radius in footprint:
+        r = int(math.floor(radius))
+        offsets = np.ogrid[(slice(-r, r + 1),)*ndim]
+        if metric == 'euclidean':
+            element = sum(o**2 for o in offsets) <= radius**2
+        elif metric == 'chessboard':
+            element = np.ones((2*r + 1,)*ndim, dtype=bool)
+        elif metric == 'taxicab':
+            element = sum(np.abs(o) for o in offsets) <= radius
+        else:
+            raise ValueError('Unknown metric {}, expected one of {}.'.format(metric, METRICS))
+        # Minkowski sum of the structuring elements
+        result = ndimage.binary_dilation(np.pad(result, r), structure=element)
+    return result
+
+
+def distance_to(mask, metric:str):
+    '''
+    Returns the distance from every voxel to the nearest foreground voxel of mask (inf if there is none).
+    '''
+    if not mask.any():
+        return np.full(mask.shape, np.inf)
+    if metric == 'euclidean':
+        return ndimage.distance_transform_edt(~mask)
+    if metric in ('chessboard', 'taxicab'):
+        return ndimage.distance_transform_cdt(~mask, metric=metric)
+    raise ValueError('Unknown metric {}, expected one of {}.'.format(metric, METRICS))
+
+
+def clear_border(mask, footprint):
+    '''
+    Clears the voxels that an erosion with border_value=0 removes because the footprint reaches outside the
+    image: those closer to the edge than the total radius of the footprint along some axis.
+    '''
+    width = int(math.floor(sum(radius for _, radius in footprint)))
+    if width > 0:
+        for axis in range(mask.ndim):
+            index = [slice(None)] * mask.ndim
+            index[axis] = slice(0, width)
+            mask[tuple(index)] = False
+            index[axis] = slice(-width, None)
+            mask[tuple(index)] = False
+    return mask
+
+
+def binary_dilation(mask, footprint, method:str='fast'):
+    '''
+    Returns the dilation of a binary image by the footprint.
+
+    Args:
+      mask: 2D or 3D array, nonzero is foreground
+      footprint: list of (metric, radius) pairs (see ball)
+      method:str - 'fast' (distance transforms) or 'reference' (scipy.ndimage with an explicit footprint)
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    if method == 'reference':
+        return ndimage.binary_dilation(mask, structure=footprint_array(footprint, mask.ndim))
+    for metric, radius in footprint:
+        mask = distance_to(mask, metric) <= radius
+    return mask
+
+
+def binary_erosion(mask, footprint, border_value:int=1, method:str='fast'):
+    '''
+    Returns the erosion of a binary image by the footprint, assuming border_value outside the image.
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    if method == 'reference':
+        return ndimage.binary_erosion(mask, structure=footprint_array(footprint, mask.ndim), border_value=border_value)
+    eroded = ~binary_dilation(~mask, footprint)
+    if not border_value:
+        eroded = clear_border(eroded, footprint)
+    return eroded
+
+
+def binary_closing(mask, footprint, border_value:int=1, method:str='fast'):
+    '''
+    Returns the closing (dilation then erosion) of a binary image by the footprint.
+    '''
+    dilated = binary_dilation(mask, footprint, method=method)
+    return binary_erosion(dilated, footprint, border_value=border_value, method=method)
+
+
+def binary_opening(mask, footprint, border_value:int=1, method:str='fast'):
+    '''
+    Returns the opening (erosion then dilation) of a binary image by the footprint.
+    '''
+    eroded = binary_erosion(mask, footprint, border_value=border_value, method=method)
+    return binary_dilation(eroded, footprint, method=method)
+
+
+def binary_white_tophat(mask, footprint, method:str='fast'):
+    '''
+    Returns the foreground voxels of a binary image that its opening removes.
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    return mask & ~binary_opening(mask, footprint, method=method)
+
+
+def binary_black_tophat(mask, footprint, method:str='fast'):
+    '''
+    Returns the background voxels of a binary image that its closing fills.
+    '''
+    mask = np.asarray(mask, dtype=bool)
+    return binary_closing(mask, footprint, method=method) & ~mask
@@ -0,0 +1,202 @@
+'''
+Synthetic chest CT phantoms, for benchmarking and checking the pipeline without the (gated) datasets.
+
+A phantom is an int16 volume in Hounsfield Units with the axes (x, y, z) of the NIfTI files the pipeline reads:
+air outside a body of soft tissue with a layer of fat, a spine and ribs, a mediastinum, two dome-shaped lungs
+of aerated tissue, a branching airway tree (air lumens inside soft tissue walls, from the trachea down into
+both lungs), a few vessels, and lesion-like blobs of ground glass opacity and consolidation inside the lungs,
+plus Gaussian noise. The lesion blobs are returned as the ground truth.
+
+Everything is drawn with broadcast (open-grid) coordinates, and tubes are only evaluated within their bounding
+box, so a full-size 512x512x400 phantom takes seconds.
+'''
+
+import math
+
+import numpy as np
+
+AIR = -1000
+LUNG = -850
+FAT = -100
+SOFT_TISSUE = 40
+BONE = 700
+AIRWAY_WALL = -50
+GROUND_GLASS = -550
+CONSOLIDATION = 0
+NOISE_HU = 20
+
+SIZES = {
+    'small': (64, 64, 64),
+    'medium': (128, 128, 96),
+    'large': (256, 256, 200),
+    'full': (512, 512, 400),
+}
+
+
+class Phantom:
+    def __init__(self, shape=(128, 128, 96), spacing=None, seed:int=0, lesions:int=6, airway_generations:int=6) -> None:
+        '''
+        Args:
+          shape - (x, y, z) size in voxels
+          spacing - voxel size in mm (defaults to a 350 mm field of view in-plane and 300 mm along z)
+          seed:int - seed of the random tree, lesions and noise
+          lesions:int - number of lesion blobs
+          airway_generations:int - number of airway generations after the trachea
+        '''
+        self.shape = tuple(shape)
+        if spacing is None:
+            spacing = (350 / shape[0], 350 / shape[1], 300 / shape[2])
+        self.spacing = tuple(float(s) for s in spacing)
+        self.rng = np.random.default_rng(seed)
+        self.volume = np.full(self.shape, AIR, dtype=np.int16)
+        # coordinates normalised to [-1, 1] in-plane and [0, 1] along z (0 at the feet)
+        x, y, z = np.ogrid[-1:1:complex(0, shape[0]), -1:1:complex(0, shape[1]), 0:1:complex(0, shape[2])]
+        self.x = x.astype(np.float32)
+        self.y = y.astype(np.float32)
+        self.z = z.astype(np.float32)
+
+        self.body = self.draw_body()
+        self.lungs = self.draw_lungs()
+        self.draw_airways(airway_generations)
+        self.draw_vessels()
+        self.truth = self.draw_lesions(lesions)
+        self.add_noise()
+
+    def draw_body(self):
+        x, y = self.x, self.y
+        body = (x / 0.9)**2 + (y / 0.68)**2 < 1
+        inner = (x / 0.84)**2 + (y / 0.62)**2 < 1
+        self.volume[np.broadcast_to(body & ~inner, self.shape)] = FAT
+        self.volume[np.broadcast_to(inner, self.shape)] = SOFT_TISSUE
+        # ribs: a ring just inside the fat, interrupted along z
+        ring = inner & ((x / 0.78)**2 + (y / 0.56)**2 > 1)
+        ribs = ring & (np.sin(self.z * 60) > 0.3)
+        self.volume[ribs] = BONE
+        spine = (x / 0.1)**2 + ((y - 0.48) / 0.1)**2 < 1
+        self.volume[np.broadcast_to(spine, self.shape)] = BONE
+        return np.broadcast_to(body, self.shape)
+
+    def draw_lungs(self):
+        x, y, z = self.x, self.y, self.z
+        # dome-shaped lungs: the cross-section shrinks towards the apex and is cut off at the diaphragm
+        profile = np.sqrt(np.clip(1 - ((z - 0.45) / 0.5)**2, 0, 1))
+        lungs = np.zeros(self.shape, dtype=bool)
+        for centre in (-0.4, 0.4):
+            lungs |= ((x - centre) / (0.3 * profile + 1e-6))**2 + ((y + 0.02) / (0.45 * profile + 1e-6))**2 < 1
+        self.volume[lungs] = LUNG
+        return lungs
+
+    def to_mm(self, point):
+        '''
+        Returns a normalised (x, y, z) point in mm.
+        '''
+        return np.array([(point[0] + 1) / 2 * (self.shape[0] - 1) * self.spacing[0],
+                         (point[1] + 1) / 2 * (self.shape[1] - 1) * self.spacing[1],
+                         point[2] * (self.shape[2] - 1) * self.spacing[2]])
+
+    def draw_tube(self, start, end, radius:float, value:int, inside=None):
+        '''
+        Sets the voxels within radius (mm) of the segment start-end (in mm) to value, optionally only where
+        inside is True.
+        '''
+        low = np.floor((np.minimum(start, end) - radius) / self.spacing).astype(int)
+        high = np.ceil((np.maximum(start, end) + radius) / self.spacing).astype(int) + 1
+        low = np.maximum(low, 0)
+        high = np.minimum(high, self.shape)
+        if np.any(high <= low):
+            return
+        box = tuple(slice(l, h) for l, h in zip(low, high))
+        coordinates = np.ogrid[box]
+        points = [c * s for c, s in zip(coordinates, self.spacing)]
+        direction = end - start
+        length = max(float(direction @ direction), 1e-12)
+        t = sum((p - s) * d for p, s, d in zip(points, start, direction)) / length
+        t = np.clip(t, 0, 1)
+        distance = sum((p - (s + t * d))**2 for p, s, d in zip(points, start, direction))
+        tube = distance <= radius**2
+        if inside is not None:
+            tube &= inside[box]
+        self.volume[box][tube] = value
+
+    def airway_segments(self, generations:int):
+        '''
+        Returns the (start, end, radius) segments of the airway tree in mm, from the trachea down, each branch
+        splitting in two with shorter and narrower children.
+        '''
+        segments = []
+        scale = self.spacing[0] * self.shape[0] / 512
+        start = self.to_mm((0, -0.05, 0.95))
+        carina = self.to_mm((0, -0.05, 0.7))
+        radius = 9 * scale
+        segments.append((start, carina, radius))
+        branches = [(carina, np.array([0.0, 0.0, -1.0]), radius)]
+        length = float(np.linalg.norm(start - carina)) * 0.9
+        for generation in range(generations):
+            children = []
+            length *= 0.72
+            for origin, direction, parent_radius in branches:
+                for side in (-1, 1):
+                    angle = math.radians(35 + self.rng.uniform(-8, 8)) * side
+                    # rotate in the x-z plane and add a little y jitter
+                    rotated = np.array([direction[0] * math.cos(angle) - direction[2] * math.sin(angle),
+                                        direction[1] + self.rng.uniform(-0.2, 0.2),
+                                        direction[0] * math.sin(angle) + direction[2] * math.cos(angle)])
+                    rotated /= np.linalg.norm(rotated)
+                    end = origin + rotated * length
+                    child_radius = parent_radius * 0.78
+                    segments.append((origin, end, child_radius))
+                    children.append((end, rotated, child_radius))
+            branches = children
+        return segments
+
+    def draw_airways(self, generations:int):
+        segments = self.airway_segments(generations)
+        wall = max(self.spacing[0], 1.0)
+        for start, end, radius in segments:
+            self.draw_tube(start, end, radius + wall, AIRWAY_WALL, inside=self.body)
+        for start, end, radius in segments:
+            self.draw_tube(start, end, radius, AIR, inside=self.body)
+
+    def draw_vessels(self, count:int=8):
+        for _ in range(count):
+            centre = (self.rng.choice((-0.4, 0.4)), self.rng.uniform(-0.2, 0.2), self.rng.uniform(0.3, 0.6))
+            start = self.to_mm(centre)
+            end = start + self.rng.normal(size=3) * 25
+            self.draw_tube(start, end, self.rng.uniform(1.5, 3), SOFT_TISSUE, inside=self.lungs)
+
+    def draw_lesions(self, count:int):
+        '''
+        Draws ellipsoidal blobs of ground glass opacity and consolidation inside the lungs and returns them as
+        a boolean mask.
+        '''
+        truth = np.zeros(self.shape, dtype=bool)
+        lung_voxels = np.flatnonzero(self.lungs)
+        if len(lung_voxels) == 0:
+            return truth
+        for i in range(count):
+            centre = np.array(np.unravel_index(self.rng.choice(lung_voxels), self.shape)) * self.spacing
+            radii = self.rng.uniform(12, 35, size=3)
+            low = np.maximum(np.floor((centre - radii) / self.spacing).astype(int), 0)
+            high = np.minimum(np.ceil((centre + radii) / self.spacing).astype(int) + 1, self.shape)
+            box = tuple(slice(l, h) for l, h in zip(low, high))
+            coordinates = np.ogrid[box]
+            blob = sum(((c * s - m) / r)**2 for c, s, m, r in zip(coordinates, self.spacing, centre, radii)) < 1
+            blob &= self.lungs[box]
+            self.volume[box][blob] = GROUND_GLASS if i % 2 == 0 else CONSOLIDATION
+            truth[box] |= blob
+        return truth
+
+    def add_noise(self):
+        noise = self.rng.standard_normal(self.shape, dtype=np.float32)
+        noise *= NOISE_HU
+        noisy = self.volume + noise
+        np.rint(noisy, out=noisy)
+        self.volume = np.clip(noisy, -1024, 3071).astype(np.int16)
+
+
+def chest_phantom(shape=(128, 128, 96), seed:int=0, **kwargs):
+    '''
+    Returns (volume, truth, spacing): an int16 HU volume, the boolean mask of its lesions and its voxel size.
+    '''
+    phantom = Phantom(shape, seed=seed, **kwargs)
+    return phantom.volume, phantom.truth, phantom.spacing
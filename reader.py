@@ -5,56 +5,117 @@ import numpy as np
 import matplotlib.pyplot as plt
 
 import volume
-import helper_functions
+import helper_functions, dtype_policy, instrumentation
 
 
 class Reader:
-    def __init__(self, src_file, number, footprint_size, truth, two_d=False, demo=False, bronchial_segmentation='') -> None:
+    def __init__(self, src_file, number, footprint_size, truth, two_d=False, demo=False, bronchial_segmentation='', workers=1, cache=None, mmap=False, compute_dtype=None, loaded=None, multiresolution=1, crop=True) -> None:
+        '''
+        loaded: optional (volume, (voxel_x, voxel_y, voxel_z), affine) for src_file, as returned by load_file,
+        for a scan that has already been read (e.g. prefetched by batch.stream)
+        multiresolution: downsampling factor of the coarse-to-fine CEF of 3D volumes (1 for full resolution)
+        crop: run the later stages of 3D volumes on the bounding box of the lungs (see Volume)
+        '''
         self.src_file = src_file
         self.file_dest = []
+        self.mmap = mmap
+        self.compute_dtype = compute_dtype if compute_dtype is not None else dtype_policy.POLICY.filter_dtype
         self.voxel_x, self.voxel_y, self.voxel_z = -1, -1, -1
-        self.volume = self.read_file(src_file)
+        # the scan's affine, for writing the masks in its space (see mask_export.py)
+        self.affine = None
+        if loaded is None:
+            self.volume = self.read_file(src_file)
+        else:
+            self.volume, (self.voxel_x, self.voxel_y, self.voxel_z), self.affine = loaded
         self.number = number
         self.footprint_size = footprint_size
         self.two_d = two_d
         self.demo = demo
         self.bronchial_segmentation = bronchial_segmentation
+        self.workers = workers
+        self.cache = cache
+        self.multiresolution = multiresolution
+        self.crop = crop
         self.truth = truth
         if two_d:
             self.truth = self.read_file(truth)
-            self.volumes = helper_functions.create_slices(self.volume)
-            self.truth = helper_functions.create_slices(self.truth)
-            for i in range(len(self.volumes)):
-                if np.count_nonzero(self.volumes[i]) > 0:
-                    print('Processing Slice Number: ', i)
-                    vol = volume.Volume(self.src_file, self.volumes[i], self.voxel_x, self.voxel_y, 0, i, self.footprint_size, True, self.truth[i], self.demo, self.bronchial_segmentation)
-                    self.lesion_volume = 0
-                    self.lesion_volume = 0
-                    self.no_processing_lesion_volume = 0
+            # the non-empty slices are processed together as one stack of 2D images
+            self.slice_numbers = np.flatnonzero(np.any(self.volume != 0, axis=(0, 1)))
+            self.lung_volume = 0
+            self.lesion_volume = 0
+            self.no_processing_lesion_volume = 0
+            self.confusion = None
+            if len(self.slice_numbers) > 0:
+                self.stack = volume.SliceStack(self.src_file, np.asarray(self.volume[:, :, self.slice_numbers]), self.voxel_x, self.voxel_y, self.slice_numbers, self.footprint_size, np.asarray(self.truth[:, :, self.slice_numbers]), self.demo, self.bronchial_segmentation, self.workers, self.cache)
+                self.confusion = self.stack.confusion
         else:
             if truth is not None:
                 self.truth = self.read_file(truth)
-                self.vol = volume.Volume(self.src_file, self.volume, self.voxel_x, self.voxel_y, self.voxel_z, self.number, self.footprint_size, self.two_d, self.truth, self.demo, self.bronchial_segmentation)
+                self.vol = volume.Volume(self.src_file, self.volume, self.voxel_x, self.voxel_y, self.voxel_z, self.number, self.footprint_size, self.two_d, self.truth, self.demo, self.bronchial_segmentation, self.workers, self.cache, self.multiresolution, self.crop, self.affine)
             else:
-                self.vol = volume.Volume(self.src_file, self.volume, self.voxel_x, self.voxel_y, self.voxel_z, self.number, self.footprint_size, self.two_d, self.truth, self.demo, self.bronchial_segmentation)
+                self.vol = volume.Volume(self.src_file, self.volume, self.voxel_x, self.voxel_y, self.voxel_z, self.number, self.footprint_size, self.two_d, self.truth, self.demo, self.bronchial_segmentation, self.workers, self.cache, self.multiresolution, self.crop, self.affine)
             self.lung_volume = self.vol.lung_volume
             self.lesion_volume = self.vol.lesion_volume
             self.no_processing_lesion_volume = self.vol.no_processing_lesions
+            self.confusion = self.vol.confusion
 # self, src_file:str, volume:np.numarray, voxel_x, voxel_y, voxel_z, number, footprint_size, two_d=False, truth=None, demo=False, bronchial_segmentation=''
     def read_file(self, src):
         if os.path.isfile(src):
             ext = os.path.splitext(src)[1]
             if ext == '.nii':
-                file = nib.load(src)
-                vol = np.array(file.get_fdata())
-                self.voxel_x, self.voxel_y, self.voxel_z = self.find_niftii_dimensions(file)
+                vol, (self.voxel_x, self.voxel_y, self.voxel_z), affine = load_file(src, self.mmap, self.compute_dtype)
+                if self.affine is None:
+                    self.affine = affine
         else:
             print("Can only read valid files/directories. Exiting ...")
             exit()
         return vol
 
-    def find_niftii_dimensions(self, file):
-        # units are mm
-        px_dim = file.header["pixdim"]
-        x, y, z = px_dim[1], px_dim[2], px_dim[3]
-        return x, y, z
+
+@instrumentation.timed('reader.load')
+def load_file(src, mmap=False, compute_dtype=None):
+    '''
+    Reads a NIfTI file and returns (volume, (voxel_x, voxel_y, voxel_z), affine), with the voxel size in mm.
+
+    Args:
+      src - path of the .nii file
+      mmap - memory-map the file and keep its on-disk dtype (see read_unscaled) instead of reading it into
+             memory in the dtypes of the dtype policy
+      compute_dtype - dtype of scaled data in mmap mode (defaults to the policy's filter dtype)
+    '''
+    if mmap:
+        file = nib.load(src, mmap=True)
+        vol = read_unscaled(file, compute_dtype)
+    else:
+        # nibabel would otherwise memory-map uncompressed files, and a prefetched scan would not be read yet
+        file = nib.load(src, mmap=False)
+        vol = dtype_policy.POLICY.voxels(file.dataobj)
+    return vol, find_niftii_dimensions(file), file.affine
+
+
+def read_unscaled(file, compute_dtype=None):
+    '''
+    Returns the voxel data in its on-disk dtype (e.g. int16 HU, uint8 masks), memory-mapped rather than
+    read into memory. Only if the header has a non-trivial scl_slope/scl_inter is the data scaled, in
+    compute_dtype.
+    '''
+    if compute_dtype is None:
+        compute_dtype = dtype_policy.POLICY.filter_dtype
+    proxy = file.dataobj
+    if not nib.is_proxy(proxy):
+        return np.asanyarray(proxy)
+    raw = proxy.get_unscaled()
+    slope, inter = proxy.slope, proxy.inter
+    if slope == 1 and inter == 0:
+        return raw
+    vol = np.array(raw, dtype=compute_dtype)
+    vol *= slope
+    vol += inter
+    return vol
+
+
+def find_niftii_dimensions(file):
+    # units are mm
+    px_dim = file.header["pixdim"]
+    x, y, z = px_dim[1], px_dim[2], px_dim[3]
+    return x, y, z
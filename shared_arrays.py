@@ -0,0 +1,76 @@
+'''
+Numpy arrays backed by multiprocessing.shared_memory, so that worker processes can read their input and
+write their output in place instead of having whole volumes pickled to and from them.
+
+The parent creates a SharedArray and passes its (picklable) spec to the workers, which attach to the same
+block of memory by name.
+'''
+
+from multiprocessing import shared_memory
+
+import numpy as np
+
+
+def slabs(length:int, count:int) -> list:
+    '''
+    Returns up to count contiguous (start, stop) ranges that cover range(length).
+    '''
+    bounds = np.linspace(0, length, min(count, length) + 1).round().astype(int)
+    return [(int(start), int(stop)) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+
+class SharedArray:
+    def __init__(self, shape, dtype, name=None) -> None:
+        '''
+        Creates a new shared block for an array of the given shape and dtype, or attaches to an existing
+        block if a name is given.
+        '''
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.owner = name is None
+        if self.owner:
+            size = max(int(np.prod(self.shape)) * self.dtype.itemsize, 1)
+            self.memory = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    @classmethod
+    def copy_of(cls, array):
+        '''
+        Returns a new SharedArray holding a copy of the array.
+        '''
+        array = np.asarray(array)
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, spec):
+        '''
+        Attaches to the SharedArray described by spec (see SharedArray.spec).
+        '''
+        name, shape, dtype = spec
+        return cls(shape, dtype, name=name)
+
+    @property
+    def spec(self) -> tuple:
+        '''
+        Returns (name, shape, dtype), which is all a worker needs to attach to this array.
+        '''
+        return self.memory.name, self.shape, self.dtype.str
+
+    def close(self):
+        '''
+        Detaches from the shared block and, if this process created it, frees it.
+        '''
+        self.array = None
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
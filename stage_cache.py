@@ -0,0 +1,130 @@
+'''
+Content-addressed on-disk cache for the outputs of the pipeline stages (lung segmentation, bronchial
+preprocessing, Hessian analysis and cavity enhancement filter).
+
+An entry is keyed by a hash of the input voxel data, the voxel spacing, the parameters of the stage (and of
+every stage before it), the dtype policy and CODE_VERSION, so a repeated run, or a run that only changes
+lesion-stage parameters, loads the earlier stages from disk instead of recomputing them. Entries are
+stage_file.py files, which are memory-mapped when loaded, so a cache hit reads only the pages that are used.
+The modification time of an entry is its last use, and the least recently used entries are evicted once the
+cache grows past its size limit (together with the .npz entries of earlier versions).
+'''
+
+import hashlib, json, os, tempfile
+
+import numpy as np
+
+import dtype_policy, stage_file
+
+# Bump this whenever a change to the code alters the output of a cached stage.
+CODE_VERSION = '2'
+DEFAULT_MAX_BYTES = 20 * 1024**3
+# entries of earlier versions, which are no longer read but are evicted
+LEGACY_EXTENSION = '.npz'
+
+
+def digest(array) -> str:
+    '''
+    Returns a hash of the shape, dtype and voxel data of an array.
+    '''
+    array = np.ascontiguousarray(array)
+    h = hashlib.blake2b(digest_size=20)
+    h.update(str((array.shape, array.dtype.str)).encode())
+    h.update(memoryview(array).cast('B'))
+    return h.hexdigest()
+
+
+class StageCache:
+    def __init__(self, directory:str, max_bytes:int=DEFAULT_MAX_BYTES) -> None:
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def digest(self, array) -> str:
+        '''
+        Returns a hash of the shape, dtype and voxel data of an array.
+        '''
+        return digest(array)
+
+    def key(self, stage:str, digest:str, **params) -> str:
+        '''
+        Returns the cache key of a stage for the input with the given digest.
+
+        Args:
+          stage:str - name of the stage, e.g. 'hessian'
+          digest:str - digest of the input volume (see StageCache.digest)
+          params: everything else the output depends on (voxel spacing, filter parameters, ...)
+        '''
+        description = json.dumps({'stage': stage, 'digest': digest, 'version': CODE_VERSION,
+                                  'dtype_policy': dtype_policy.POLICY.name, 'params': params},
+                                 sort_keys=True, default=str)
+        return stage + '-' + hashlib.blake2b(description.encode(), digest_size=20).hexdigest()
+
+    def path(self, key:str) -> str:
+        return os.path.join(self.directory, key + stage_file.EXTENSION)
+
+    def load(self, key:str):
+        '''
+        Returns the dict of arrays stored under key (memory-mapped copy-on-write, see stage_file.read), or
+        None if there is no such entry.
+        '''
+        path = self.path(key)
+        try:
+            arrays, _ = stage_file.read(path)
+            # mark as recently used (another process may have evicted the entry meanwhile: a miss)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return arrays
+
+    def store(self, key:str, arrays:dict):
+        '''
+        Stores a dict of arrays under key. The file is written to a temporary name and then renamed, so a
+        concurrent reader never sees a partial entry.
+        '''
+        handle, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            os.close(handle)
+            stage_file.write(tmp_path, arrays)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def get_or_compute(self, key:str, compute) -> dict:
+        '''
+        Returns the arrays stored under key, calling compute() (which must return a dict of arrays) and
+        storing its result if there is no entry yet.
+        '''
+        arrays = self.load(key)
+        if arrays is None:
+            arrays = compute()
+            self.store(key, arrays)
+        else:
+            print('Loaded cached stage ' + key)
+        return arrays
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits within max_bytes.
+        '''
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith((stage_file.EXTENSION, LEGACY_EXTENSION)):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
@@ -0,0 +1,191 @@
+'''
+Compact, versioned on-disk format for volumes and other stage artifacts (.lens files).
+
+A file holds one or more named arrays with a small JSON header, and is laid out as:
+
+  MAGIC (8 bytes) | format version (uint32) | header length (uint32) | JSON header | payloads
+
+The header records the shape and dtype of every array and where its payload starts, together with the voxel
+spacing and the parameters the arrays were computed with. Payloads start at multiples of ALIGNMENT bytes.
+A raw payload is the array's bytes in C order, so it is opened with np.memmap without being deserialised:
+opening a file takes milliseconds however large it is, and only the pages actually touched are read. A
+compressed payload is split into zlib-compressed chunks of whole rows (first axis) of about CHUNK_BYTES,
+which are decompressed on reading.
+
+Unlike pickles, reading a file never runs code, so files from elsewhere are safe to open. The pickled
+bronchial segmentations (.p) of earlier versions are converted with
+
+  python stage_file.py bronchial_segmentations/segmented_volumes/1.p
+
+which writes 1.lens next to it (see convert_pickle).
+'''
+
+import argparse, json, os, struct, zlib
+
+import numpy as np
+
+MAGIC = b'LENSARR\n'
+VERSION = 1
+EXTENSION = '.lens'
+ALIGNMENT = 64
+CHUNK_BYTES = 16 * 1024**2
+COMPRESSIONS = (None, 'zlib')
+PREFIX = struct.Struct('<8sII')
+
+
+def aligned(offset:int) -> int:
+    return -(-offset // ALIGNMENT) * ALIGNMENT
+
+
+def encode_chunks(array, compression:str):
+    '''
+    Returns the payload of an array and its chunks, a list of (offset, length) pairs in the payload (None if
+    the payload is raw).
+    '''
+    if compression is None:
+        return [array.reshape(-1).view(np.uint8)] if array.size else [], None
+    if compression not in COMPRESSIONS:
+        raise ValueError('Unknown compression {}, expected one of {}.'.format(compression, COMPRESSIONS))
+    row_bytes = array.nbytes // array.shape[0] if array.ndim and array.shape[0] else max(array.nbytes, 1)
+    rows = max(1, CHUNK_BYTES // max(row_bytes, 1))
+    parts, chunks, offset = [], [], 0
+    for start in range(0, array.shape[0] if array.ndim else 1, rows):
+        part = zlib.compress(array[start:start + rows].tobytes() if array.ndim else array.tobytes(), 1)
+        parts.append(part)
+        chunks.append((offset, len(part)))
+        offset += len(part)
+    return parts, chunks
+
+
+def write(path:str, arrays:dict, spacing=None, parameters:dict=None, compression:str=None):
+    '''
+    Writes a dict of arrays to path.
+
+    Args:
+      arrays:dict - name to array; object arrays cannot be stored
+      spacing - optional voxel size in mm
+      parameters:dict - optional parameters the arrays were computed with (JSON serialisable, anything else
+                        is stored as its str)
+      compression:str - None for raw, memory-mappable payloads, or 'zlib'
+    '''
+    entries, payloads, offset = {}, [], 0
+    for name, array in arrays.items():
+        array = np.asarray(array, order='C')
+        if array.dtype.hasobject:
+            raise ValueError('Cannot store the object array {}.'.format(name))
+        parts, chunks = encode_chunks(array, compression)
+        offset = aligned(offset)
+        entries[name] = {'shape': list(array.shape), 'dtype': array.dtype.str, 'offset': offset,
+                         'compression': compression, 'chunks': chunks}
+        payloads.append((offset, parts))
+        offset += sum(len(part) for part in parts)
+    header = json.dumps({'arrays': entries, 'spacing': None if spacing is None else [float(s) for s in spacing],
+                         'parameters': parameters or {}}, sort_keys=True, default=str).encode()
+    data_start = aligned(PREFIX.size + len(header))
+    with open(path, 'wb') as file:
+        file.write(PREFIX.pack(MAGIC, VERSION, len(header)))
+        file.write(header)
+        for offset, parts in payloads:
+            file.seek(data_start + offset)
+            for part in parts:
+                file.write(part)
+
+
+def is_stage_file(path:str) -> bool:
+    '''
+    Returns whether path is a file in this format.
+    '''
+    try:
+        with open(path, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def read_header(path:str) -> dict:
+    '''
+    Returns the header of a file, with the absolute offset of its payloads as 'data_start'.
+    '''
+    with open(path, 'rb') as file:
+        prefix = file.read(PREFIX.size)
+        if len(prefix) < PREFIX.size:
+            raise ValueError('{} is not a {} file.'.format(path, EXTENSION))
+        magic, version, length = PREFIX.unpack(prefix)
+        if magic != MAGIC:
+            raise ValueError('{} is not a {} file.'.format(path, EXTENSION))
+        if version > VERSION:
+            raise ValueError('{} has format version {}, this version of LENS reads up to {}.'.format(path, version, VERSION))
+        header = json.loads(file.read(length).decode())
+    header['version'] = version
+    header['data_start'] = aligned(PREFIX.size + length)
+    return header
+
+
+def read(path:str, mmap:bool=True):
+    '''
+    Returns (arrays, header) of a file. Raw arrays are memory-mapped copy-on-write if mmap: they can be
+    modified, but the file is not. Compressed arrays, and every array without mmap, are read into memory.
+    '''
+    header = read_header(path)
+    arrays = {}
+    with open(path, 'rb') as file:
+        for name, entry in header['arrays'].items():
+            shape, dtype = tuple(entry['shape']), np.dtype(entry['dtype'])
+            start = header['data_start'] + entry['offset']
+            if entry['compression'] is None:
+                count = int(np.prod(shape))
+                if mmap and count:
+                    arrays[name] = np.memmap(path, dtype=dtype, mode='c', offset=start, shape=shape)
+                else:
+                    file.seek(start)
+                    arrays[name] = np.fromfile(file, dtype=dtype, count=count).reshape(shape)
+                continue
+            array = np.empty(shape, dtype=dtype)
+            flat = array.reshape(-1).view(np.uint8)
+            position = 0
+            for offset, length in entry['chunks']:
+                file.seek(start + offset)
+                part = zlib.decompress(file.read(length))
+                flat[position:position + len(part)] = np.frombuffer(part, dtype=np.uint8)
+                position += len(part)
+            arrays[name] = array
+    return arrays, header
+
+
+def convert_pickle(src:str, dst:str=None, dtype=None, compression:str=None, spacing=None, flip:bool=True) -> str:
+    '''
+    Converts a pickled volume (e.g. a bronchial segmentation .p file from the demo files) to this format,
+    stored as the array 'cef_volume', and returns the path written (src with the EXTENSION by default). The
+    pickle is loaded, so only convert files from a trusted source.
+
+    Args:
+      dtype - dtype to store the volume in (default: its own)
+      flip:bool - reverse the slices of a 3D volume; earlier versions saved them in reverse order
+    '''
+    import pandas as pd
+    if dst is None:
+        dst = os.path.splitext(src)[0] + EXTENSION
+    volume = np.asarray(pd.read_pickle(src))
+    if flip and volume.ndim > 2:
+        volume = volume[:, :, ::-1]
+    if dtype is not None:
+        volume = volume.astype(dtype)
+    write(dst, {'cef_volume': volume}, spacing, {'source': os.path.basename(src)}, compression)
+    return dst
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert pickled bronchial segmentations (.p) to {} files.'.format(EXTENSION))
+    parser.add_argument("pickles", type=str, nargs='+', help="The .p files; each is written next to itself with the {} extension.".format(EXTENSION))
+    parser.add_argument("--dtype", type=str, default='float32',
+                       help="dtype of the stored volume (default float32, the filter dtype of the compact policy).")
+    parser.add_argument("--compress", action="store_true",
+                       help="Compress the volume (smaller, but it is then read into memory instead of memory-mapped).")
+    options = parser.parse_args()
+    for src in options.pickles:
+        dst = convert_pickle(src, dtype=options.dtype, compression='zlib' if options.compress else None)
+        print('{} ({:.1f} MB) -> {} ({:.1f} MB)'.format(src, os.path.getsize(src) / 1024**2, dst, os.path.getsize(dst) / 1024**2))
+
+
+if __name__ == '__main__':
+    main()
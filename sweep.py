@@ -0,0 +1,180 @@
+'''
+Parameter sweeps of the lesion segmentation (phase 3).
+
+Phase 3 is the step at which manual tuning takes place, but its inputs, the lung mask and the cavity
+enhancement filter volume of phases 1 and 2, take far longer to compute than the lesion segmentation itself.
+A sweep computes them once for a case (or loads them from the stage cache, see -c), puts them in shared memory
+and runs the lesion segmentation for every combination of a grid of its parameters on a pool of worker
+processes. Each worker attaches to the shared inputs, so only the parameters and the results are pickled.
+
+The tunable parameters are those of lesion.Lesion: footprint_size, hounsfield_window, frangi_sigmas and
+crop_margins. The results come back as a table (a pandas DataFrame, written as CSV by the command line) with a
+row per combination: the parameters, the lesion volumes with and without bronchial tree removal, and with
+ground truth the Dice coefficient and the other metrics of evaluation.py.
+
+Usage: python sweep.py scan.nii --truth scan_mask.nii -c cache -w 8 --footprint-sizes 1 2 3 --window-max -300 -200
+'''
+
+import argparse, itertools, multiprocessing, time
+
+import numpy as np
+import pandas as pd
+
+import lesion, reader, shared_arrays, stage_cache, dtype_policy, evaluation, hessian_filters, mesh_export
+import volume as volume_pipeline
+
+FOOTPRINT_SIZES = (1,)
+
+
+def grid(footprint_sizes=FOOTPRINT_SIZES, hounsfield_windows=(lesion.HOUNSFIELD_WINDOW,), frangi_sigmas=(lesion.FRANGI_SIGMAS,), crop_margins=(lesion.CROP_MARGINS,)) -> list:
+    '''
+    Returns every combination of the given values of the lesion parameters, as a list of keyword dicts. An
+    axis that is not given keeps the pipeline's value.
+    '''
+    combinations = itertools.product(footprint_sizes, hounsfield_windows, frangi_sigmas, crop_margins)
+    return [{'footprint_size': int(footprint_size), 'hounsfield_window': tuple(window), 'frangi_sigmas': tuple(sigmas), 'crop_margins': tuple(margins)}
+            for footprint_size, window, sigmas, margins in combinations]
+
+
+def prepare(volume, spacing, truth=None, cache=None, workers:int=1, multiresolution:int=1, crop:bool=True) -> dict:
+    '''
+    Runs (or loads from the stage cache) phases 1 and 2 of a 3D case, as Volume.process_volume does (see
+    volume.segment_lungs_and_airway), and returns the inputs of the lesion segmentation: the volume (its box
+    if cropped), the lung mask, the CEF volume, the truth (or None), the voxel size in mm and the frame of the
+    box (None without crop).
+    '''
+    _, airway, box, frame = volume_pipeline.segment_lungs_and_airway(volume, *spacing, workers=workers, cache=cache, multiresolution=multiresolution, crop=crop)
+    return {'volume': volume[box], 'lung_mask': airway.lung_mask, 'cef_volume': airway.cef_volume, 'truth': truth, 'spacing': tuple(spacing), 'frame': frame}
+
+
+def evaluate(inputs:dict, parameters:dict) -> dict:
+    '''
+    Runs the lesion segmentation of the inputs (see prepare) with one combination of parameters (see grid)
+    and returns its row of the results table.
+    '''
+    voxel_x, voxel_y, voxel_z = inputs['spacing']
+    start = time.perf_counter()
+    stage = lesion.LesionStage('sweep', inputs['volume'], inputs['lung_mask'], inputs['cef_volume'], voxel_x, voxel_y, voxel_z, parameters['footprint_size'], 0, truth=inputs['truth'],
+                               hounsfield_window=parameters['hounsfield_window'], frangi_sigmas=parameters['frangi_sigmas'], crop_margins=parameters['crop_margins'],
+                               frame=inputs.get('frame'))
+    row = dict(parameters)
+    row['lesion_volume'] = float(stage.processed.total_lesion_volume)
+    row['no_processing_lesion_volume'] = float(stage.unprocessed.total_lesion_volume)
+    if stage.processed.evaluation is not None:
+        for name in evaluation.METRICS:
+            row[name] = float(stage.processed.evaluation[name])
+    row['seconds'] = time.perf_counter() - start
+    return row
+
+
+def evaluate_job(specs:dict, spacing, frame, parameters:dict, policy:str, filters:dict) -> dict:
+    '''
+    Worker for sweep: attaches to the shared inputs and evaluates one combination of parameters.
+    '''
+    dtype_policy.set_policy(policy)
+    hessian_filters.configure(**filters)
+    mesh_export.configure(format='none')
+    shared = {name: shared_arrays.SharedArray.attach(spec) for name, spec in specs.items()}
+    try:
+        inputs = {name: array.array for name, array in shared.items()}
+        inputs.setdefault('truth', None)
+        inputs['spacing'] = spacing
+        inputs['frame'] = frame
+        return evaluate(inputs, parameters)
+    finally:
+        for array in shared.values():
+            array.close()
+
+
+def sweep(inputs:dict, combinations:list, workers:int=1):
+    '''
+    Evaluates every combination of parameters (see grid) on the inputs of a case (see prepare) and returns
+    the results table, one row per combination in the order given. With more than one worker the
+    combinations run on a process pool, sharing the inputs through shared memory; every worker needs the
+    working memory of one lesion segmentation.
+    '''
+    if workers <= 1 or len(combinations) <= 1:
+        mesh_format = mesh_export.settings()
+        mesh_export.configure(format='none')
+        try:
+            rows = [evaluate(inputs, parameters) for parameters in combinations]
+        finally:
+            mesh_export.configure(**mesh_format)
+        return pd.DataFrame(rows)
+    arrays = {name: inputs[name] for name in ('volume', 'lung_mask', 'cef_volume', 'truth') if inputs[name] is not None}
+    shared = {}
+    try:
+        for name, array in arrays.items():
+            shared[name] = shared_arrays.SharedArray.copy_of(np.asarray(array))
+        specs = {name: array.spec for name, array in shared.items()}
+        jobs = [(specs, inputs['spacing'], inputs.get('frame'), parameters, dtype_policy.POLICY.name, hessian_filters.settings()) for parameters in combinations]
+        with multiprocessing.Pool(processes=min(workers, len(jobs))) as pool:
+            rows = pool.starmap(evaluate_job, jobs, chunksize=1)
+    finally:
+        for array in shared.values():
+            array.close()
+    return pd.DataFrame(rows)
+
+
+def parse_pairs(values) -> list:
+    '''
+    Returns 'a,b' strings as (a, b) tuples of ints.
+    '''
+    return [tuple(int(part) for part in value.split(',')) for value in values]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sweep the parameters of the lesion segmentation of one 3D case.')
+    parser.add_argument("image", type=str, help="The .nii scan.")
+    parser.add_argument("--truth", type=str, default=None,
+                       help="The .nii ground truth mask; without it only the lesion volumes are reported.")
+    parser.add_argument("-c", "--cache", type=str, default=None,
+                       help="Stage cache directory (as in main.py), so that phases 1 and 2 only run once per case.")
+    parser.add_argument("-w", "--workers", type=int, default=1,
+                       help="Number of worker processes (default 1), also used for phases 1 and 2.")
+    parser.add_argument("--footprint-sizes", type=int, nargs='+', default=list(FOOTPRINT_SIZES),
+                       help="Footprint sizes of the lung mask erosion and the white top-hat (default 1).")
+    parser.add_argument("--window-min", type=int, nargs='+', default=[lesion.HOUNSFIELD_WINDOW[0]],
+                       help="Lower ends of the HU window the Frangi filter sees (default {}).".format(lesion.HOUNSFIELD_WINDOW[0]))
+    parser.add_argument("--window-max", type=int, nargs='+', default=[lesion.HOUNSFIELD_WINDOW[1]],
+                       help="Upper ends of the HU window the Frangi filter sees (default {}).".format(lesion.HOUNSFIELD_WINDOW[1]))
+    parser.add_argument("--sigmas", type=str, nargs='+', default=[','.join(str(sigma) for sigma in lesion.FRANGI_SIGMAS)],
+                       help="Frangi sigmas, each set comma separated, e.g. 1,2 1,2,3 (default 1,2).")
+    parser.add_argument("--margins", type=str, nargs='+', default=[','.join(str(margin) for margin in lesion.CROP_MARGINS)],
+                       help="Slices dropped at the start and the end of the volume, e.g. 2,12 0,0 (default 2,12).")
+    parser.add_argument("--multiresolution", type=int, default=1,
+                       help="Coarse-to-fine CEF factor for phase 2, as in main.py (default 1).")
+    parser.add_argument("--no-crop", action="store_true",
+                       help="Run phases 2 and 3 on the whole scan instead of the bounding box of the lungs, as main.py --no-crop.")
+    parser.add_argument("--cache-size", type=float, default=20,
+                       help="Maximum size of the stage cache in GB (default 20).")
+    parser.add_argument("--dtype-policy", type=str, default='compact', choices=sorted(dtype_policy.POLICIES))
+    parser.add_argument("-o", "--output", type=str, default=None,
+                       help="Write the results table to this CSV file.")
+    options = parser.parse_args()
+
+    dtype_policy.set_policy(options.dtype_policy)
+    cache = None
+    if options.cache is not None:
+        cache = stage_cache.StageCache(options.cache, int(options.cache_size * 1024**3))
+    volume, spacing, _ = reader.load_file(options.image)
+    truth = None if options.truth is None else reader.load_file(options.truth)[0]
+    inputs = prepare(volume, spacing, truth, cache, options.workers, options.multiresolution, not options.no_crop)
+
+    windows = [(low, high) for low in options.window_min for high in options.window_max if low < high]
+    sigmas = [tuple(int(sigma) for sigma in value.split(',')) for value in options.sigmas]
+    combinations = grid(options.footprint_sizes, windows, sigmas, parse_pairs(options.margins))
+    print('Sweeping {} combinations of the lesion parameters on {} worker(s) ...'.format(len(combinations), options.workers))
+    start = time.perf_counter()
+    table = sweep(inputs, combinations, options.workers)
+    print('Swept in {:.1f} s.'.format(time.perf_counter() - start))
+    if 'dice' in table:
+        table = table.sort_values('dice', ascending=False)
+    print(table.to_string(index=False))
+    if options.output is not None:
+        table.to_csv(options.output, index=False)
+        print('Results written to {}.'.format(options.output))
+
+
+if __name__ == '__main__':
+    main()
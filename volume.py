@@ -1,11 +1,45 @@
+import os
+
 import numpy as np
 
-import lesion, lung, bronchial_tree
+import lesion, lung, bronchial_tree, evaluation, helper_functions, mask_export, instrumentation
 
 VOL_TEST = True
 
+
+def segment_lungs_and_airway(volume, voxel_x, voxel_y, voxel_z, number=0, demo=False, bronchial_segmentation='', workers=1, cache=None, multiresolution=1, crop=True):
+    '''
+    Runs phases 1 and 2 of a 3D volume: the lung segmentation, then the bronchial tree on the padded bounding
+    box of the lungs if crop (see Lung.bounding_box). A demo that loads a precomputed bronchial tree is not
+    cropped, since that covers the whole scan. Used by Volume, sweep.py and benchmark.py.
+
+    Returns (lung_vol, airway, box, frame): the Lung, the BronchialTree, the box of the volume the bronchial
+    tree ran on and the frame to give LesionStage (None if the box is the whole volume).
+    '''
+    volume_digest = cache.digest(volume) if cache is not None else None
+    with instrumentation.stage('lung', volume=volume):
+        lung_vol = lung.Lung(volume, volume.shape[0], volume.shape[1], voxel_x, voxel_y, voxel_z, demo, cache, volume_digest, workers)
+    box, frame = tuple(slice(0, size) for size in volume.shape), None
+    if crop and volume.ndim == 3 and not (demo and bronchial_segmentation != ''):
+        lungs = lung_vol.bounding_box()
+        if volume[lungs].shape != volume.shape:
+            box, frame = lungs, (volume.shape, lungs)
+            print('Cropping to the lungs: {} of {} voxels.'.format(volume[box].size, volume.size))
+            if cache is not None:
+                volume_digest = cache.digest(volume[box])
+    with instrumentation.stage('bronchial_tree', volume=volume[box]):
+        airway = bronchial_tree.BronchialTree(volume[box], lung_vol.segmentations[box], voxel_x, voxel_y, number, demo, bronchial_segmentation, cef_workers=workers, cache=cache, volume_digest=volume_digest, multiresolution=multiresolution)
+    return lung_vol, airway, box, frame
+
+
 class Volume:
-    def __init__(self, src_file:str, volume:np.numarray, voxel_x, voxel_y, voxel_z, number, footprint_size, two_d=False, truth=None, demo=False, bronchial_segmentation='') -> None:
+    def __init__(self, src_file:str, volume:np.ndarray, voxel_x, voxel_y, voxel_z, number, footprint_size, two_d=False, truth=None, demo=False, bronchial_segmentation='', workers=1, cache=None, multiresolution=1, crop=True, affine=None) -> None:
+        '''
+        crop: run the bronchial tree and lesion stages of a 3D volume on the padded bounding box of the lungs
+              only (see Lung.bounding_box); the results are pasted back into full size.
+        affine: affine of the source scan, with which its masks are written (see mask_export.py); defaults
+                to the voxel size
+        '''
         self.volume = volume
         self.src_file = src_file
         self.px_height = self.volume.shape[0]
@@ -21,18 +55,101 @@ class Volume:
         self.file_dest = []
         self.demo = demo
         self.bronchial_segmentation = bronchial_segmentation
+        self.workers = workers
+        self.cache = cache
+        self.multiresolution = multiresolution
+        self.crop = crop
+        self.affine = affine if affine is not None else np.diag([voxel_x, voxel_y, voxel_z, 1])
+        # the box of the volume that the bronchial tree and lesion stages ran on
+        self.box = tuple(slice(0, size) for size in volume.shape)
+        self.confusion = None
         self.lung_volume, self.lesion_volume, self.no_processing_lesions = self.process_volume()
 
     def process_volume(self):
         print('Begin segmentation...')
-        lung_vol = lung.Lung(self.volume, self.px_height, self.px_width, self.voxel_x, self.voxel_y, self.voxel_z, self.demo)
-        meng_airway = bronchial_tree.BronchialTree(self.volume, lung_vol.segmentations, self.voxel_x, self.voxel_y, self.number, self.demo, self.bronchial_segmentation)
-
-        if self.truth is None:
-            lesion_vol = lesion.Lesion(self.src_file, self.volume, meng_airway.lung_mask, meng_airway.cef_volume, self.voxel_x, self.voxel_y, self.voxel_z, self.footprint_size, self.number, self.demo)
-            no_processing = lesion.Lesion(self.src_file, self.volume, meng_airway.lung_mask, meng_airway.cef_volume, self.voxel_x, self.voxel_y, self.voxel_z, self.footprint_size, self.number, self.demo, no_processing=True)
-        else:
-            lesion_vol = lesion.Lesion(self.src_file, self.volume, meng_airway.lung_mask, meng_airway.cef_volume, self.voxel_x, self.voxel_y, self.voxel_z, self.footprint_size, self.number, self.demo, self.two_d, self.truth)
-            no_processing = lesion.Lesion(self.src_file, self.volume, meng_airway.lung_mask, meng_airway.cef_volume, self.voxel_x, self.voxel_y, self.voxel_z, self.footprint_size, self.number, self.demo, self.two_d, self.truth, no_processing=True)
-        return lung_vol.lung_volume, lesion_vol.total_lesion_volume, no_processing.total_lesion_volume
-        
\ No newline at end of file
+        lung_vol, meng_airway, self.box, frame = segment_lungs_and_airway(self.volume, self.voxel_x, self.voxel_y, self.voxel_z, self.number, self.demo, self.bronchial_segmentation, self.workers, self.cache, self.multiresolution, self.crop)
+        volume = self.volume[self.box]
+
+        with instrumentation.stage('lesion', volume=volume):
+            if self.truth is None:
+                lesions = lesion.LesionStage(self.src_file, volume, meng_airway.lung_mask, meng_airway.cef_volume, self.voxel_x, self.voxel_y, self.voxel_z, self.footprint_size, self.number, self.demo, frame=frame)
+            else:
+                lesions = lesion.LesionStage(self.src_file, volume, meng_airway.lung_mask, meng_airway.cef_volume, self.voxel_x, self.voxel_y, self.voxel_z, self.footprint_size, self.number, self.demo, self.two_d, self.truth, frame=frame)
+        self.confusion = lesions.processed.confusion
+        self.export_masks(lung_vol, meng_airway, lesions)
+        return lung_vol.lung_volume, lesions.processed.total_lesion_volume, lesions.unprocessed.total_lesion_volume
+
+    def export_masks(self, lung_vol, airway, lesions):
+        '''
+        Queues the lung, bronchial tree and lesion masks of the case for writing at full size (see
+        mask_export.py). The bronchial tree is the CEF volume above its Otsu threshold, and the lesion mask is
+        empty in the crop_margins slices.
+        '''
+        if mask_export.FORMAT == 'none' or airway.cef_volume.shape != self.volume[self.box].shape:
+            # e.g. a demo CEF volume of another size, which the lesion stage resizes to
+            return
+        shape = self.volume.shape
+        bronchial = helper_functions.paste(helper_functions.create_binary_mask(airway.cef_volume), shape, self.box)
+        lesion_mask = lesions.processed.bronchial_mask
+        first = lesions.processed.crop_margins[0]
+        lesion_mask = helper_functions.paste(lesion_mask, shape, (slice(None), slice(None), slice(first, first + lesion_mask.shape[2])))
+        name = os.path.splitext(os.path.basename(self.src_file))[0]
+        mask_export.export({'lung': lung_vol.masks, 'bronchial': bronchial, 'lesion': lesion_mask}, name, self.affine)
+
+
+class SliceStack:
+    '''
+    Runs the 2D pipeline on a stack of independent 2D images (stacked along the last axis) in one pass: the
+    lung segmentation, bronchial tree preprocessing, Hessian analysis and cavity enhancement filter each run
+    once over the whole stack, and only the lesion segmentation runs image by image. Every image gets the
+    same result as it would on its own, and the per-image results are returned as arrays.
+    '''
+    def __init__(self, src_file:str, images:np.ndarray, voxel_x, voxel_y, numbers, footprint_size, truth=None, demo=False, bronchial_segmentation='', workers=1, cache=None) -> None:
+        '''
+        Args:
+          images - (height, width, n) stack of 2D images in HU
+          numbers - the number (slice index) of every image, used for naming output
+          truth - optional (height, width, n) stack of ground truth masks
+        '''
+        self.src_file = src_file
+        self.images = images
+        self.voxel_x = voxel_x
+        self.voxel_y = voxel_y
+        self.numbers = list(numbers)
+        self.footprint_size = footprint_size
+        self.truth = truth
+        self.demo = demo
+        self.bronchial_segmentation = bronchial_segmentation
+        self.workers = workers
+        self.cache = cache
+        # per-slice confusion counts (see evaluation.py), None without ground truth
+        self.confusion = None
+        self.lung_areas, self.lesion_areas, self.no_processing_lesion_areas, self.dice = self.process_stack()
+
+    def process_stack(self):
+        print('Begin segmentation of {} slices...'.format(self.images.shape[2]))
+        pixel_area = self.voxel_x * self.voxel_y
+        volume_digest = self.cache.digest(self.images) if self.cache is not None else None
+        with instrumentation.stage('lung', volume=self.images):
+            lung_vol = lung.Lung(self.images, self.images.shape[0], self.images.shape[1], self.voxel_x, self.voxel_y, 0, self.demo, self.cache, volume_digest, self.workers)
+        with instrumentation.stage('bronchial_tree', volume=self.images):
+            meng_airway = bronchial_tree.BronchialTree(self.images, lung_vol.segmentations, self.voxel_x, self.voxel_y, self.numbers[0], self.demo, self.bronchial_segmentation, cef_workers=self.workers, cache=self.cache, volume_digest=volume_digest, stacked=True)
+
+        count = self.images.shape[2]
+        lesion_areas = np.zeros(count)
+        no_processing_lesion_areas = np.zeros(count)
+        dice = np.full(count, np.nan)
+        confusion = []
+        for i in range(count):
+            print('Processing Slice Number: ', self.numbers[i])
+            truth = None if self.truth is None else self.truth[:, :, i]
+            lesions = lesion.LesionStage(self.src_file, self.images[:, :, i], meng_airway.lung_mask[:, :, i], meng_airway.cef_volume[:, :, i], self.voxel_x, self.voxel_y, 0, self.footprint_size, self.numbers[i], self.demo, True, truth)
+            lesion_areas[i] = lesions.processed.total_lesion_voxels * pixel_area
+            no_processing_lesion_areas[i] = lesions.unprocessed.total_lesion_voxels * pixel_area
+            if lesions.processed.confusion is not None:
+                dice[i] = lesions.processed.dice_coeff
+                confusion.append(lesions.processed.confusion)
+        if confusion and len(confusion) == count:
+            self.confusion = evaluation.ConfusionCounts(*[[getattr(counts, name) for counts in confusion] for name in ('tp', 'fp', 'fn', 'tn')])
+        lung_areas = np.count_nonzero(lung_vol.masks, axis=(0, 1)) * pixel_area
+        return lung_areas, lesion_areas, no_processing_lesion_areas, dice